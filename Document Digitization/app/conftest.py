@@ -0,0 +1,25 @@
+# Puts the app directory on sys.path for the tests, the modules import each other as
+# top-level packages (utils, model) like when the consumer runs from here
+import os
+import sys
+import types
+
+# utils.config needs the Key Vault helper and its environment, neither exists outside the
+# deployment: the tests get a stand-in and dummy values (real ones win when set)
+if "utils.access_secrets" not in sys.modules:
+    try:
+        import utils.access_secrets
+    except ImportError:
+        access_secrets = types.ModuleType("utils.access_secrets")
+        access_secrets.AccessSecrets = type("AccessSecrets", (), {"get_secret": staticmethod(lambda name: None)})
+        sys.modules["utils.access_secrets"] = access_secrets
+
+for name, value in {
+    "vault_url": "https://vault.invalid",
+    "client_id_managed_identity": "tests",
+    "azure_openai_api_key": "tests",
+    "azure_openai_api_base": "https://openai.invalid",
+    "azure_openai_api_version": "2024-02-01",
+    "AWS_DEFAULT_REGION": "us-east-1",
+}.items():
+    os.environ.setdefault(name, value)
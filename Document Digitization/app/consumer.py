@@ -1,16 +1,26 @@
 import json
+import time
 import asyncio
-import aiohttp
 from copy import deepcopy
+from functools import partial
 from bson import ObjectId
 from utils import config
 from utils.config import logger
 import utils.aws_services as aws
-from utils.mongodb import MongoDB
-from model.model import OpenAI_Extract
+from utils.resources import Resources
+from model.model import OpenAI_Extract, embedding_cache
+import model.tesseract_ocr as tesseract_ocr
+from utils.metrics import metrics
+from utils.lease import DocumentLease, lease_stats
+from utils.checkpointing import OrderedCheckpointTracker
+from utils.pipeline import Job, Stage, StagedPipeline, backoff_delay
+from utils.adaptive import throttle_info
+from utils.health import Health, start_http_server
+from utils.dead_letter import event_fingerprint, parse_event_body, UnsupportedDocument
+from utils import lanes
+from utils.fair_queue import FairScheduler
 from azure.eventhub.exceptions import EventHubError
 from azure.eventhub.aio import EventHubConsumerClient
-from tenacity import AsyncRetrying, stop_after_attempt, wait_random_exponential
 from azure.eventhub.extensions.checkpointstoreblobaio import BlobCheckpointStore
 
 async def get_consumer_client():
@@ -26,6 +36,18 @@ async def get_consumer_client():
     )
     return consumer_client
 
+# Caps the events in flight across every partition handled by this process, per lane, and
+# shares them fairly between tenants
+event_scheduler = FairScheduler(
+    lanes.split_budget(config.max_concurrent_events, config.lane_slow_share),
+    tenant_cap=config.tenant_max_concurrent_events,
+    weights=config.tenant_weights,
+    name="events",
+)
+
+# Liveness and readiness of this process, served with the metrics by main()
+health = Health(config.health_check_timeout, config.health_check_cache_seconds)
+
 async def async_range(start, stop):
     """
     Function to run 'for loop' in async
@@ -34,16 +56,72 @@ async def async_range(start, stop):
         yield(i)
         await asyncio.sleep(0)
 
-async def on_event(partition_context, event, mongo):
+async def classify_event(event, resources):
+    """
+    Method to pick the lane of an event before it is admitted, from the S3 HEAD of its file
+    and, for PDFs, the page count in the file header
+
+    Returns (lane, head), head is None when the file could not be looked up. Never raises:
+    an event that cannot be classified takes the fast lane and fails (or not) on its own.
+    """
+    try:
+        event_body = parse_event_body(event.body_as_str(encoding='UTF-8'))
+        file_name = event_body['file_name'].split(".com/")[1]
+        head = await aws.head_object_s3(resources.s3_client, config.s3_bucket_input, file_name,
+                                        executor=resources.s3_executor)
+        if head is None:
+            return lanes.FAST, None
+        pages = None if file_name.lower().endswith(".pdf") else 1
+        if pages is None and config.lane_probe_pdf_header:
+            header = await aws.get_object_range_s3(resources.s3_client, config.s3_bucket_input, file_name,
+                                                   head['ETag'], 0, lanes.PDF_HEADER_BYTES - 1,
+                                                   executor=resources.s3_executor)
+            pages = lanes.linearized_page_count(header)
+        return lanes.choose_lane(head['ContentLength'], pages), head
+    except Exception as exp:
+        logger.info(f"Could not classify event, using the fast lane: {exp}")
+        return lanes.FAST, None
+
+def event_tenant(event):
+    """
+    Method to get the tenant (uid) of an event for fair queuing, "unknown" if the body has none
+    """
+    try:
+        return str(json.loads(event.body_as_str(encoding='UTF-8')).get("uid") or "unknown")
+    except Exception:
+        return "unknown"
+
+async def on_event(partition_context, event, resources, pipeline, admission=None):
     """
     Method to handle events
     
     partition_context: contains partition context 
     event: the received event
+    resources: shared clients (HTTP session, status store, S3) created in main()
+    pipeline: StagedPipeline built by build_pipeline()
+    admission: {"lane": ..., "s3_head": ...} from classify_event(), handed to the pipeline
+
+    Returns True once the event is handled (status recorded, result delivered or event
+    quarantined) and is safe to checkpoint. Checkpointing itself is left to the caller.
     """
     
     logger.info(f"{event=}")
-    event_body = event.body_as_json(encoding='UTF-8')
+    raw_body = event.body_as_str(encoding='UTF-8')
+    dead_letters = resources.dead_letters
+    event_key = event_fingerprint(raw_body)
+    # Poison events are skipped without running the extraction again
+    if dead_letters is not None and not await dead_letters.begin(
+            event_key, raw_body, partition_context.partition_id, event.sequence_number):
+        return True
+
+    try:
+        event_body = parse_event_body(raw_body)
+    except UnsupportedDocument as exp:
+        logger.error(f"Malformed event: {exp}")
+        if dead_letters is None:
+            return False
+        return await dead_letters.fail(event_key, "parse", exp, permanent=True)
+
     logger.info(f"Processing event...")
     # logger.info(f"doc_id: {event_body['doc_id']}")
     # logger.info(f"file_name: {event_body['file_name']}")
@@ -51,174 +129,396 @@ async def on_event(partition_context, event, mongo):
     
     # payload = deepcopy(event_body)
 
+    try:
+        flag_status, error = await handle_document(event_body, resources, pipeline, admission)
+    except Exception as exp:
+        if dead_letters is not None:
+            await dead_letters.fail(event_key, "event", exp)
+        raise
+
+    if dead_letters is not None:
+        if flag_status and error is None:
+            await dead_letters.resolve(event_key)
+        else:
+            stage, exp = error or ("event", RuntimeError("event not handled"))
+            await dead_letters.fail(event_key, stage, exp, permanent=isinstance(exp, NON_RETRYABLE_ERRORS))
+    return flag_status
+
+async def handle_document(event_body, resources, pipeline, admission=None):
+    """
+    Method to process the document of an event under its lease
+
+    Returns (flag_status, error): whether the event is handled, and the (stage, exception)
+    its document failed on, if any
+    """
+    if not config.lease_enabled:
+        return await process_document(event_body, resources, pipeline, admission)
+
+    # Only one replica processes a document at a time, duplicates wait for its result
+    lease = DocumentLease(
+        resources.status_store,
+        config.mdb_collection_data,
+        query={"_id": ObjectId(event_body['_id']), "doc_id": event_body['doc_id']},
+        ttl=config.lease_ttl,
+        wait_timeout=config.lease_wait_timeout,
+        poll_interval=config.lease_poll_interval,
+    )
+    lease_outcome = await lease.acquire()
+    if lease_outcome == DocumentLease.SUPPRESSED:
+        return True, None
+    if lease_outcome == DocumentLease.TIMEOUT:
+        logger.error(f"Timed out waiting for the lease on doc_id {event_body['doc_id']}")
+        return False, None
+
     flag_status = False
+    try:
+        flag_status, error = await process_document(event_body, resources, pipeline, admission)
+    finally:
+        await lease.release(handled=flag_status)
+    return flag_status, error
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            async for attempt in AsyncRetrying(
-                wait=wait_random_exponential(multiplier=config.retry_exp_wait_multiplier,
-                                            max=config.retry_wait_max),
-                stop=stop_after_attempt(config.max_api_tries),
-                reraise=True):
-                #file_name = event_body['file_name']
-                file_name = event_body['file_name'].split(".com/")[1]
-                
-                with attempt:
-                    # Get object of file in S3 bucket
-                    file_obj = await aws.get_file_object_s3(
-                        s3_client=config.boto3_client,
-                        bucket=config.s3_bucket_input,
-                        object_name=file_name
-                    )
-
-                    # Case: File not found in bucket
-                    if file_obj is None:
-                        logger.info(f"{file_obj=}")
-
-                        # Update MongoDB
-                        response_mdb = mongo.update_document(
-                        collection_name=config.mdb_collection_data,
-                        query={
-                            "_id": ObjectId(event_body['_id']),
-                            "doc_id":event_body['doc_id']
-                            },
-                        new_values={
-                            "doc_status": "error",
-                            "msg": "File Not Found"
-                            })
-                        
-                        flag_status = True if response_mdb.acknowledged else False
-                        if flag_status:
-                            await partition_context.update_checkpoint(event)
-
-                    else: 
-
-                        # Call OpenAI API
-                        openai = OpenAI_Extract(session)
-                        response_llm = await openai.get_llm_output(file_name, file_obj)
-                        logger.info(f"op:\n{json.dumps(response_llm, indent=2, ensure_ascii=False)}")
-                        if not response_llm :
-                            doc_status = "failed"
-                        else:
-                            doc_status = "completed"
-                        # dict_op = {
-                        #     "doc_id": event_body['doc_id'],
-                        #     "file_name": event_body['file_name'],
-                        #     "doc_status": "completed",
-                        #     "extracted_details": response
-                        # }
-            async for attempt in AsyncRetrying(
-                wait=wait_random_exponential(multiplier=config.retry_exp_wait_multiplier,max=config.retry_wait_max),
-                stop=stop_after_attempt(config.max_api_tries),
-                reraise=True
-            ):
-                with attempt:                
-                    # Appian-API Call
-                
-                    payload = {
-                        "uid": event_body['uid'],
-                        "doc_id": event_body['doc_id'],
-                        "file_name": event_body['filename'],
-                        "doc_status": doc_status,
-                        "extracted_details": response_llm
-                    }                        
-                    headers = {
-                        "Content-Type": "application/json",
-                        "API-Key": config.appian_api_key
-                    }
-
-                    try:
-                        response_appian = await session.post(
-                            config.appian_api_url, 
-                            headers=headers, 
-                            # data=json.dumps(dict_data)
-                            json=payload
-                        )
-                        
-                        # Check if the request was successful
-                        #response_appian.raise_for_status()
-                        
-                        # Print the response
-                        logger.info(f"Response status code: {response_appian.status_code}")
-                        logger.info(f"Response content: {await response_appian.json()}")
-
-                    except aiohttp.ClientError as e:
-                        logger.error(f"Exception while sending data to AppianAPI: {e}")
-                        
-                        
-                        # Update MongoDB
-                        response_mdb = mongo.update_document(
-                            collection_name=config.mdb_collection_data,
-                            query={
-                                "_id":ObjectId(event_body['doc_id']) 
-                            },
-                            new_values={
-                                "doc_status": doc_status,
-                                "extracted_details": response_llm,
-                                "status_output_response": response_appian.status_code,
-                                "msg_output_response" : response_appian.text
-                            }
-                        )
-
-                        flag_status = True if response_mdb.acknowledged else False
-                        if flag_status:
-                            await partition_context.update_checkpoint(event)
+async def process_document(event_body, resources, pipeline, admission=None):
+    """
+    Method to run the document of an event through the staged pipeline
 
-        except Exception as exp:
-            logger.error(f"Exception while processing event: {exp}")
-            # Update MongoDB
-            response_mdb = mongo.update_document(
+    event_body: decoded body of the event
+    resources: shared clients (HTTP session, status store, S3) created in main()
+    pipeline: StagedPipeline built by build_pipeline()
+    admission: lane and S3 HEAD of the file found by classify_event(), if any
+
+    Returns (flag_status, error): True once the document status is recorded or the result
+    delivered, and the (stage, exception) the pipeline failed on, if any
+    """
+    job = Job({"event_body": event_body, **(admission or {})}, resources)
+    flag_status = await pipeline.submit(job)
+    return flag_status, job.error
+
+async def record_status(job, new_values):
+    """
+    Method to record the document status and finish the job with whether it was acknowledged
+    """
+    event_body = job.state["event_body"]
+    response_mdb = await job.resources.status_store.update_document(
+        collection_name=config.mdb_collection_data,
+        query={
+            "_id": ObjectId(event_body['_id']),
+            "doc_id":event_body['doc_id']
+            },
+        new_values=new_values)
+    job.result = True if response_mdb and response_mdb.acknowledged else False
+    return None
+
+async def get_persisted_file_key(job):
+    """
+    Method to read the file hash persisted on the document by an earlier attempt, if any
+    """
+    event_body = job.state["event_body"]
+    record = await job.resources.status_store.get_document(
+        config.mdb_collection_data,
+        {"_id": ObjectId(event_body['_id']), "doc_id": event_body['doc_id']},
+        {"file_sha256": 1}
+    )
+    return record.get("file_sha256") if record else None
+
+def lane_stage(job, stage_name):
+    """
+    Name of the lane's copy of a stage (ocr, index and llm run one pool per lane)
+    """
+    return f"{stage_name}_{job.state.get('lane', lanes.FAST)}"
+
+async def fetch_stage(job):
+    """
+    Stage 1: get the file from S3, finish early when it is missing or its output is cached
+    """
+    event_body = job.state["event_body"]
+    #file_name = event_body['file_name']
+    file_name = event_body['file_name'].split(".com/")[1]
+    job.state["file_name"] = file_name
+
+    extract = OpenAI_Extract(job.resources.session, cache=job.resources.extraction_cache,
+                             limiters=job.resources.limiters, ocr_cache=job.resources.ocr_cache,
+                             ocr_backend=event_body.get("ocr_backend"))
+    extract.validate_file_type(file_name)
+    job.state["extract"] = extract
+
+    # A redelivered event resumes from the outputs persisted by an earlier attempt
+    persisted_key = await get_persisted_file_key(job) if extract.cache is not None else None
+    if persisted_key:
+        response_llm = await extract.get_cached_output(persisted_key)
+        if response_llm is not None:
+            job.state.update({"file_key": persisted_key, "response_llm": response_llm, "doc_status": "completed"})
+            return "deliver"
+
+    # Get object of file in S3 bucket, a retry looks the object up again
+    with metrics.timer("s3_fetch"):
+        file_obj = await aws.get_file_object_s3(
+            s3_client=job.resources.s3_client,
+            bucket=config.s3_bucket_input,
+            object_name=file_name,
+            head=job.state.pop("s3_head", None),
+            executor=job.resources.s3_executor
+        )
+
+    # Case: File not found in bucket
+    if file_obj is None:
+        logger.info(f"{file_obj=}")
+        return await record_status(job, {"doc_status": "error", "msg": "File Not Found"})
+
+    # The pages of the downloaded file settle the lane of the remaining stages
+    pages = 1
+    if file_name.lower().endswith(".pdf"):
+        pages = await asyncio.to_thread(lanes.pdf_page_count, file_obj)
+    job.state["lane"] = lanes.choose_lane(len(file_obj), pages)
+
+    file_key = extract.get_file_key(file_obj)
+    job.state.update({"file_obj": file_obj, "file_key": file_key})
+    if file_key is None or extract.cache is None:
+        return lane_stage(job, "ocr")
+
+    if file_key != persisted_key:
+        await job.resources.status_store.update_document(
             collection_name=config.mdb_collection_data,
-            query={
-                "_id": ObjectId(event_body['_id']),
-                "doc_id":event_body['doc_id']
-                },
-            new_values={
-                "doc_status": "error",
-                "msg": str(exp)
-                })
-            
-            flag_status = True if response_mdb.acknowledged else False
-            if flag_status:
-                await partition_context.update_checkpoint(event)
+            query={"_id": ObjectId(event_body['_id']), "doc_id": event_body['doc_id']},
+            new_values={"file_sha256": file_key}
+        )
+        response_llm = await extract.get_cached_output(file_key)
+        if response_llm is not None:
+            job.state.update({"response_llm": response_llm, "doc_status": "completed"})
+            return "deliver"
+    return lane_stage(job, "ocr")
+
+async def ocr_stage(job):
+    """
+    Stage 2: OCR the file into page documents
+    """
+    state = job.state
+    logger.info("Started indexing")
+    state["documents"] = await state["extract"].data_index(state["file_name"], state["file_obj"], state["file_key"])
+    await state["extract"].classify(state["documents"])
+    state["extraction_path"] = state["extract"].extraction_path(state["documents"])
+    if state["extraction_path"] != "retrieval":
+        # the LLM gets the page text itself, whole or by page group: no embedding and no index
+        return lane_stage(job, "llm")
+    return lane_stage(job, "index")
+
+async def index_stage(job):
+    """
+    Stage 3: chunk, embed and index the pages
+    """
+    state = job.state
+    logger.info("Creating Query Engine")
+    state["query_engine"] = await state["extract"].get_query_engine(state["documents"], state["file_key"])
+    return lane_stage(job, "llm")
+
+async def llm_stage(job):
+    """
+    Stage 4: query the LLM with the extraction prompts, on the index, on the full text of a
+    short document or page group by page group for a long one
+    """
+    state = job.state
+    if "query_engine" in state:
+        response_llm = await state["extract"].query(state["query_engine"], state["file_key"])
+    elif state["extraction_path"] == "map_reduce":
+        response_llm = await state["extract"].map_reduce_query(state["documents"], state["file_key"])
+    else:
+        response_llm = await state["extract"].direct_query(state["documents"], state["file_key"])
+    logger.info(f"op:\n{json.dumps(response_llm, indent=2, ensure_ascii=False)}")
+    state["response_llm"] = response_llm
+    state["doc_status"] = "completed" if response_llm else "failed"
+    # free the file and index as soon as they are no longer needed
+    for key in ("file_obj", "documents", "query_engine"):
+        state.pop(key, None)
+    return "deliver"
+
+async def deliver_stage(job):
+    """
+    Stage 5: record the extraction on the document and queue it in the Appian outbox
+    """
+    state = job.state
+    event_body = state["event_body"]
+
+    await record_status(job, {
+        "doc_status": state["doc_status"],
+        "extracted_details": state["response_llm"],
+    })
+    if not job.result:
+        raise RuntimeError("Document status update not acknowledged")
 
+    # Appian-API payload, sent (and retried) by the outbox dispatcher
+    payload = {
+        "uid": event_body['uid'],
+        "doc_id": event_body['doc_id'],
+        "file_name": event_body['filename'],
+        "doc_status": state["doc_status"],
+        "extracted_details": state["response_llm"]
+    }
+    job.result = await job.resources.outbox.enqueue(event_body['doc_id'], payload)
+    if not job.result:
+        raise RuntimeError("Appian outbox enqueue not acknowledged")
+    return None
+
+# Errors a retry cannot fix, anything else (a JSON body cut short, a parse error) is retried
+NON_RETRYABLE_ERRORS = (UnsupportedDocument, aws.S3ObjectTooLarge)
+
+async def handle_stage_error(job, stage_name, exp):
+    """
+    Retry policy of the pipeline: a failed stage is retried on its own, from the outputs of
+    the previous stages kept on the job, up to max_api_tries attempts per stage.
+    Once exhausted (or for errors a retry cannot fix) the error is recorded on the document.
+    A throttled call is not retried before its Retry-After.
+    """
+    logger.error(f"Exception in stage {stage_name}: {exp}")
+    attempt = job.attempts.get(stage_name, 0) + 1
+    job.attempts[stage_name] = attempt
+    if attempt < config.max_api_tries and not isinstance(exp, NON_RETRYABLE_ERRORS):
+        delay = backoff_delay(attempt, config.retry_exp_wait_multiplier, config.retry_wait_max)
+        throttled = throttle_info(exp)
+        if throttled is not None and throttled[1] is not None:
+            delay = max(delay, throttled[1])
+        return stage_name, delay
+
+    logger.error(f"Exception while processing event: {exp}")
+    await record_status(job, {"doc_status": "error", "msg": str(exp)})
+    return None
+
+def build_pipeline():
+    """
+    Method to build the document pipeline: fetch -> ocr -> index -> llm -> deliver
+
+    ocr, index and llm run one pool per lane, the slow lane gets 'lane_slow_share' of the
+    stage concurrency so large documents cannot hold every slot
+    """
+    queue_size = config.pipeline_queue_size
+    laned = [
+        ("ocr", ocr_stage, config.pipeline_ocr_concurrency),
+        ("index", index_stage, config.pipeline_index_concurrency),
+        ("llm", llm_stage, config.pipeline_llm_concurrency),
+    ]
+    stages = [Stage("fetch", fetch_stage, config.pipeline_fetch_concurrency, queue_size)]
+    for name, handler, concurrency in laned:
+        for lane, budget in lanes.split_budget(concurrency, config.lane_slow_share).items():
+            stages.append(Stage(f"{name}_{lane}", handler, budget, queue_size))
+    stages.append(Stage("deliver", deliver_stage, config.pipeline_deliver_concurrency, queue_size))
+    return StagedPipeline(stages, error_handler=handle_stage_error)
+
+async def process_event(partition_context, event, resources, pipeline, index, partition_scheduler, tracker):
+    """
+    Method to process one event of a batch under the partition and process concurrency limits
+    of its lane, admitted fairly across tenants
+
+    partition_context: contains partition context
+    event: the received event
+    resources: shared clients (HTTP session, status store, S3) created in main()
+    pipeline: StagedPipeline built by build_pipeline()
+    index: position of the event in its batch
+    partition_scheduler: FairScheduler of the events in flight for this partition
+    tracker: OrderedCheckpointTracker of the batch
+    """
+    partition_id = partition_context.partition_id
+    metrics.inc("events_received", partition=partition_id)
+    tenant = event_tenant(event)
+    lane, head = await classify_event(event, resources)
+    metrics.inc("lane_events", lane=lane)
+    # one series per configured tenant only, counters are never removed
+    metrics.inc("tenant_events", tenant=tenant if tenant in config.tenant_weights else "other")
+    queued = time.perf_counter()
+    # The process-wide slot (and tenant cap) comes first: a partition slot held while queued
+    # there would keep the next events of this partition waiting behind a busy tenant
+    async with event_scheduler.slot(tenant, lane), partition_scheduler.slot(tenant, lane):
+        metrics.observe("tenant_wait", time.perf_counter() - queued)
+        metrics.add_gauge("events_in_flight", 1)
+        try:
+            with metrics.timer("event"), metrics.timer(f"event_{lane}"):
+                flag_status = await on_event(partition_context, event, resources, pipeline,
+                                             admission={"lane": lane, "s3_head": head})
+        except Exception as exp:
+            logger.error(f"Exception while handling event: {exp}")
+            flag_status = False
+        finally:
+            metrics.add_gauge("events_in_flight", -1)
+    metrics.inc("events_processed" if flag_status else "events_failed", partition=partition_id)
+
+    # A failed event only holds back the checkpoint of its own batch: the tracker is per batch,
+    # so the next batch moves past it and it is re-read only after a restart in between. It is
+    # covered only by the dead-letter store, when enabled (see on_event, replay_dead_letters.py)
+    if flag_status:
+        await tracker.complete(index)
     return flag_status
     
-async def on_event_batch(partition_context, event_batch):
+async def on_event_batch(partition_context, event_batch, resources, pipeline):
     """
     Method to handle events in event_batch
 
     partition_context: contains partition context 
     event_batch<List>: event_batch could be an empty list if max_wait_time is not None nor 0 and no event is received after max_wait_time
+    resources: shared clients (HTTP session, status store, S3) created in main()
+    pipeline: StagedPipeline built by build_pipeline()
     """
     logger.info(f"len evant_batch: {len(event_batch)}")
-    mongo = MongoDB(config.mdb_db, config.mdb_conn_str)
-
-    logger.info("f{mongo=}")
-    
 
     if len(event_batch)>0:
+        partition_scheduler = FairScheduler(
+            lanes.split_budget(config.max_concurrent_events_partition, config.lane_slow_share),
+            weights=config.tenant_weights,
+        )
+        tracker = OrderedCheckpointTracker(partition_context, event_batch, resources.checkpoints)
         tasks = [
-            await on_event(partition_context, event, mongo) for event in event_batch
+            process_event(partition_context, event, resources, pipeline, index, partition_scheduler, tracker)
+            for index, event in enumerate(event_batch)
         ]
         responses = await asyncio.gather(*tasks)
+        logger.info(f"Partition {partition_context.partition_id}: "
+                    f"{sum(responses)}/{len(responses)} events handled")
+        logger.info(f"Resource pools: {resources.stats()}")
+        logger.info(f"Document leases: {lease_stats}")
+        logger.info(f"Pipeline stages: {pipeline.stats()}")
+        logger.info(f"Tenant scheduler: {event_scheduler.stats()}")
+        if embedding_cache is not None:
+            logger.info(f"Embedding cache: {embedding_cache.stats()}")
+        logger.info(f"Appian outbox: pending={await resources.outbox.pending_count()}")
 
     else:
         logger.info(f"No new event found!")
 
-async def on_error(partition_context, error):
+async def on_error(partition_context, error, resources):
     """ 
     This method is handling errors
-    parameters: partition_context, error
+    parameters: partition_context (None for errors not tied to a partition), error, resources
     """
     logger.error(f"Error in Consumer: {error}")
-    await partition_context.update_checkpoint()
+    # write the progress made so far, never past events that are still in flight
+    if partition_context is not None:
+        await resources.checkpoints.flush(partition_context.partition_id)
 
+async def on_partition_close(partition_context, reason, resources):
+    """
+    Method to checkpoint the pending progress of a partition this consumer stops owning
+    (rebalance, shutdown), so the next owner starts from it
+    """
+    logger.info(f"Partition {partition_context.partition_id} closed: {reason}")
+    await resources.checkpoints.close(partition_context.partition_id)
 
-async def main():
+
+async def main(serve_http=True):
+    """
+    Method to run the consumer until the Event Hub client stops
+
+    serve_http: serve /metrics and the health checks on metrics_port (off in supervised workers)
+    """
+    resources = Resources()
+    pipeline = build_pipeline()
+    http_runner = None
+    health.resources = resources
+    health.running = True
     try:
+        if serve_http and config.metrics_port:
+            http_runner = await start_http_server(config.metrics_host, config.metrics_port,
+                                                  metrics.prometheus, health.liveness, health.readiness)
+        await resources.startup()
+        pipeline.start()
         # consumer_client = await azure_managed_identity_authentication()
         consumer_client = await get_consumer_client()
+        health.eventhub_client = consumer_client
 
         async with consumer_client:
             
@@ -229,13 +529,24 @@ async def main():
 
             # Process a batch of events
             await consumer_client.receive_batch(
-                on_event_batch = on_event_batch,
+                on_event_batch = partial(on_event_batch, resources=resources, pipeline=pipeline),
                 starting_position = "-1",
                 max_batch_size = config.max_event_batch_size,
-                on_error = on_error
+                on_error = partial(on_error, resources=resources),
+                on_partition_close = partial(on_partition_close, resources=resources),
+                track_last_enqueued_event_properties = True
             )
     except EventHubError as error:
         logger.error(error)
                 
     except Exception as error:
         logger.error(f"Caught exception: {error}")
+
+    finally:
+        health.running = False
+        await pipeline.stop()
+        await resources.shutdown()
+        # spawned OCR workers would outlive the consumer otherwise
+        tesseract_ocr.shutdown_pool()
+        if http_runner is not None:
+            await http_runner.cleanup()
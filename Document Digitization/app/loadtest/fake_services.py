@@ -0,0 +1,293 @@
+import json
+import math
+import time
+import random
+import asyncio
+import hashlib
+from uuid import uuid4
+
+from aiohttp import web
+
+class LatencyProfile:
+    """
+    Latency and error distribution of a fake service.
+    Latencies are log-normal around 'median' seconds, 'error_rate' of the requests fail with
+    'error_status' (429 responses carry a Retry-After header).
+    """
+    def __init__(self, median: float, sigma: float = 0.5, error_rate: float = 0.0, error_status: int = 503):
+        self.median = median
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+    def sample(self):
+        if self.median <= 0:
+            return 0
+        return random.lognormvariate(math.log(self.median), self.sigma)
+
+    async def wait(self):
+        await asyncio.sleep(self.sample())
+
+    def error_response(self):
+        if random.random() >= self.error_rate:
+            return None
+        headers = {"Retry-After": "1"} if self.error_status == 429 else {}
+        return web.json_response({"error": {"code": str(self.error_status), "message": "injected failure"}},
+                                 status=self.error_status, headers=headers)
+
+def synthetic_object(key: str, size: int) -> bytes:
+    '''
+    Deterministic pseudo-PDF content of 'size' bytes for 'key', the same key always gives
+    the same bytes so duplicate uploads hash identically
+    '''
+    seed = hashlib.sha256(key.encode("utf-8")).digest()
+    body = bytearray(b"%PDF-1.4\n")
+    block = seed
+    while len(body) < size:
+        block = hashlib.sha256(block).digest()
+        body += block
+    return bytes(body[:size])
+
+class FakeService:
+    """
+    A local aiohttp server standing in for one external dependency
+    """
+    name = "service"
+
+    def __init__(self, profile: LatencyProfile, host: str = "127.0.0.1"):
+        self.profile = profile
+        self.host = host
+        self.port = None
+        self.requests = 0
+        self.errors = 0
+        self._runner = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def routes(self):
+        raise NotImplementedError
+
+    async def start(self):
+        app = web.Application(client_max_size=1024 ** 3)
+        app.add_routes(self.routes())
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, 0)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _delay_or_fail(self):
+        self.requests += 1
+        await self.profile.wait()
+        error = self.profile.error_response()
+        if error is not None:
+            self.errors += 1
+        return error
+
+    def stats(self):
+        return {"requests": self.requests, "errors": self.errors}
+
+class FakeS3(FakeService):
+    """
+    Path-style S3 endpoint serving synthetic objects for any key (HEAD, GET and ranged GET),
+    keys under "large/" are 'large_object_size' bytes
+    """
+    name = "s3"
+
+    def __init__(self, profile: LatencyProfile, object_size: int, large_object_size: int = None,
+                 host: str = "127.0.0.1"):
+        super().__init__(profile, host)
+        self.object_size = object_size
+        self.large_object_size = large_object_size or object_size
+
+    def _size(self, key: str):
+        return self.large_object_size if key.startswith("large/") else self.object_size
+
+    def routes(self):
+        return [
+            web.head("/{bucket}/{key:.+}", self.head_object),
+            web.get("/{bucket}/{key:.+}", self.get_object, allow_head=False),
+        ]
+
+    def _headers(self, key: str):
+        return {"ETag": f'"{hashlib.md5(key.encode("utf-8")).hexdigest()}"',
+                "Content-Type": "application/pdf"}
+
+    async def head_object(self, request):
+        error = await self._delay_or_fail()
+        if error is not None:
+            return web.Response(status=error.status)
+        key = request.match_info["key"]
+        headers = self._headers(key)
+        headers["Content-Length"] = str(self._size(key))
+        return web.Response(status=200, headers=headers)
+
+    async def get_object(self, request):
+        error = await self._delay_or_fail()
+        if error is not None:
+            return error
+        key = request.match_info["key"]
+        data = synthetic_object(key, self._size(key))
+        headers = self._headers(key)
+        byte_range = request.headers.get("Range")
+        if byte_range:
+            start, end = byte_range.replace("bytes=", "").split("-")
+            start, end = int(start), min(int(end), len(data) - 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+            return web.Response(status=206, body=data[start:end + 1], headers=headers)
+        return web.Response(status=200, body=data, headers=headers)
+
+class FakeAzureRead(FakeService):
+    """
+    Azure Read (vision v3.2) stand-in: analyze returns an Operation-Location that reports
+    'running' until the sampled latency has elapsed, then 'pages' pages of text. The text
+    carries a number derived from the uploaded bytes, so distinct files never share chunks
+    (and embedding cache entries) while duplicate uploads still do
+    """
+    name = "ocr"
+
+    def __init__(self, profile: LatencyProfile, pages: int, endpoint: str, host: str = "127.0.0.1"):
+        super().__init__(profile, host)
+        self.pages = pages
+        self.endpoint = "/" + endpoint.strip("/")
+        self._operations = {}
+
+    def routes(self):
+        return [
+            web.post(self.endpoint, self.analyze),
+            web.get("/operations/{operation_id}", self.analyze_result),
+        ]
+
+    async def analyze(self, request):
+        self.requests += 1
+        document = hashlib.sha256(await request.read()).hexdigest()[:12].upper()
+        error = self.profile.error_response()
+        if error is not None:
+            self.errors += 1
+            return error
+        operation_id = uuid4().hex
+        self._operations[operation_id] = (time.monotonic() + self.profile.sample(), document)
+        return web.Response(status=202, headers={
+            "Operation-Location": f"{self.base_url}/operations/{operation_id}"
+        })
+
+    async def analyze_result(self, request):
+        operation = self._operations.get(request.match_info["operation_id"])
+        if operation is None:
+            return web.json_response({"status": "failed"}, status=404)
+        ready_at, document = operation
+        if time.monotonic() < ready_at:
+            return web.json_response({"status": "running"})
+        read_results = [
+            {"page": page, "lines": [
+                {"text": "GRAND HOTEL INVOICE"},
+                {"text": f"Folio No {document}-{page}"},
+                {"text": f"Room charge night {page} $120.00"},
+                {"text": "Breakfast $15.00"},
+                {"text": "Accommodation GST $13.50"},
+            ]}
+            for page in range(1, self.pages + 1)
+        ]
+        return web.json_response({"status": "succeeded", "analyzeResult": {"readResults": read_results}})
+
+class FakeAzureOpenAI(FakeService):
+    """
+    Azure OpenAI stand-in for the chat completions and embeddings deployments
+    """
+    name = "openai"
+
+    def __init__(self, profile: LatencyProfile, embed_profile: LatencyProfile, embed_dim: int = 16,
+                 host: str = "127.0.0.1"):
+        super().__init__(profile, host)
+        self.embed_profile = embed_profile
+        self.embed_dim = embed_dim
+        self.embedding_requests = 0
+        self.embedded_inputs = 0
+        self.completion_requests = 0
+
+    def routes(self):
+        return [
+            web.post("/openai/deployments/{deployment}/chat/completions", self.chat_completions),
+            web.post("/openai/deployments/{deployment}/completions", self.chat_completions),
+            web.post("/openai/deployments/{deployment}/embeddings", self.embeddings),
+        ]
+
+    async def chat_completions(self, request):
+        self.completion_requests += 1
+        error = await self._delay_or_fail()
+        if error is not None:
+            return error
+        body = await request.json()
+        content = json.dumps({
+            "Document Label": "Hotel",
+            "Invoice line-items": [
+                {"Quantity": "1", "Item Name": "Room charge", "Amount": "$120.00", "Category": "Hotel"},
+                {"Quantity": "1", "Item Name": "Breakfast", "Amount": "$15.00", "Category": "Food"},
+                {"Quantity": "1", "Item Name": "Accommodation GST", "Amount": "$13.50", "Category": "Tax"},
+            ],
+            "Invoice Total": "$148.50",
+        })
+        prompt_tokens = len(json.dumps(body)) // 4
+        return web.json_response({
+            "id": f"chatcmpl-{uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.match_info["deployment"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4,
+                      "total_tokens": prompt_tokens + len(content) // 4},
+        })
+
+    async def embeddings(self, request):
+        self.embedding_requests += 1
+        self.requests += 1
+        await self.embed_profile.wait()
+        error = self.embed_profile.error_response()
+        if error is not None:
+            self.errors += 1
+            return error
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        self.embedded_inputs += len(inputs)
+        data = []
+        for index, text in enumerate(inputs):
+            seed = hashlib.sha256(str(text).encode("utf-8")).digest()
+            data.append({"object": "embedding", "index": index,
+                         "embedding": [(seed[i % len(seed)] - 128) / 128 for i in range(self.embed_dim)]})
+        return web.json_response({
+            "object": "list", "data": data, "model": request.match_info["deployment"],
+            "usage": {"prompt_tokens": len(inputs), "total_tokens": len(inputs)},
+        })
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            "completion_requests": self.completion_requests,
+            "embedding_requests": self.embedding_requests,
+            "embedded_inputs": self.embedded_inputs,
+        })
+        return stats
+
+class FakeAppian(FakeService):
+    """
+    Appian API stand-in accepting the extraction payloads
+    """
+    name = "appian"
+
+    def routes(self):
+        return [web.post("/appian", self.receive)]
+
+    async def receive(self, request):
+        error = await self._delay_or_fail()
+        if error is not None:
+            return error
+        payload = await request.json()
+        return web.json_response({"status": "received", "doc_id": payload.get("doc_id")})
@@ -0,0 +1,265 @@
+"""
+Offline load test of the Document Digitization consumer.
+
+Drives consumer.on_event_batch from a file-backed fake partition source, with local fake
+servers standing in for S3, Azure Read, Azure OpenAI and Appian. MongoDB is the only real
+dependency (--mongo-uri). Reports docs/sec, per-stage p50/p95/p99 and peak RSS.
+
+Run from the 'app' directory:
+    python -m loadtest.run_load_test --generate 200 --events /tmp/events.jsonl --partitions 4
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import importlib
+from uuid import uuid4
+
+from bson import ObjectId
+
+from loadtest.fake_services import (
+    LatencyProfile, FakeS3, FakeAzureRead, FakeAzureOpenAI, FakeAppian
+)
+
+OCR_ENDPOINT = "vision/v3.2/read/analyze"
+BUCKET = "loadtest-bucket"
+
+class FakeEvent:
+    """
+    Minimal stand-in for azure.eventhub.EventData
+    """
+    def __init__(self, body: dict, sequence_number: int):
+        self.body = body
+        self.sequence_number = sequence_number
+        self.offset = str(sequence_number)
+
+    def body_as_json(self, encoding='UTF-8'):
+        return self.body
+
+    def body_as_str(self, encoding='UTF-8'):
+        return json.dumps(self.body)
+
+    def __repr__(self):
+        return f"FakeEvent(sequence_number={self.sequence_number})"
+
+class FakePartitionContext:
+    """
+    Minimal stand-in for azure.eventhub.aio.PartitionContext recording checkpoints
+    """
+    def __init__(self, partition_id: str):
+        self.partition_id = partition_id
+        self.eventhub_name = "loadtest"
+        self.consumer_group = "$Default"
+        self.checkpoints = []
+
+    async def update_checkpoint(self, event=None):
+        self.checkpoints.append(event.sequence_number if event is not None else None)
+
+def generate_events(path: str, count: int, duplicate_rate: float, tenants: int, large_rate: float = 0.0):
+    '''
+    Write 'count' synthetic event bodies to 'path', 'duplicate_rate' of them re-use the
+    file of an earlier event (re-uploads), 'large_rate' of them point to a large file
+    '''
+    keys = []
+    with open(path, "w") as f:
+        for i in range(count):
+            if keys and random.random() < duplicate_rate:
+                key = random.choice(keys)
+            else:
+                folder = "large" if random.random() < large_rate else "expenses"
+                key = f"{folder}/loadtest-{i}-{uuid4().hex[:8]}.pdf"
+                keys.append(key)
+            body = {
+                "_id": str(ObjectId()),
+                "doc_id": str(uuid4()),
+                "uid": f"tenant-{random.randrange(tenants)}",
+                "file_name": f"https://{BUCKET}.s3.amazonaws.com/{key}",
+                "filename": key,
+            }
+            f.write(json.dumps(body) + "\n")
+
+def load_partitions(path: str, partitions: int):
+    '''
+    Read event bodies from a JSONL file and spread them over the partitions, an explicit
+    "partition" field in a line pins it to that partition
+    '''
+    queues = {str(p): [] for p in range(partitions)}
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            body = json.loads(line)
+            partition_id = str(body.pop("partition", i % partitions))
+            queue = queues.setdefault(partition_id, [])
+            queue.append(FakeEvent(body, len(queue)))
+    return queues
+
+def configure_environment(args, services):
+    '''
+    Point the consumer configuration at the fake services, must run before utils.config
+    is imported
+    '''
+    s3, ocr, openai, appian = services
+    os.environ.update({
+        "vault_url": "http://localhost",
+        "client_id_managed_identity": "loadtest",
+        "mdb_conn_str": args.mongo_uri,
+        "cosmos_mdb_db": args.mongo_db,
+        "aws_s3_bucket_input": BUCKET,
+        "aws_s3_endpoint_url": s3.base_url,
+        "s3_access_key_id": "loadtest",
+        "s3_secret_access_key": "loadtest",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "azure_openai_api_key": "loadtest",
+        "azure_openai_api_base": openai.base_url,
+        "azure_openai_api_version": "2024-02-01",
+        "cognitive_services_subscription_key": "loadtest",
+        "cognitive_services_base_url": ocr.base_url + "/",
+        "cognitive_services_endpoint": OCR_ENDPOINT,
+        "appian_api_key": "loadtest",
+        "appian_api_url": appian.base_url + "/appian",
+        "eh_max_batch_size_eventhub": str(args.batch_size),
+    })
+    if args.extraction_path == "retrieval":
+        # the fake OCR pages are short: without this every document is sent whole to the LLM
+        # and the retrieval path (chunking, embedding, index) is never measured
+        os.environ.update({"direct_context_max_tokens": "0", "map_reduce_min_pages": "0"})
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+async def drive_partition(consumer, partition_context, events, batch_size, resources, pipeline):
+    # like the Event Hub client, a partition hands over its next batch once the previous one is done
+    for start in range(0, len(events), batch_size):
+        await consumer.on_event_batch(partition_context, events[start:start + batch_size],
+                                      resources=resources, pipeline=pipeline)
+
+async def run(args):
+    services = [
+        await FakeS3(LatencyProfile(args.s3_latency, args.sigma, args.s3_error_rate),
+                     object_size=args.object_size, large_object_size=args.large_object_size).start(),
+        await FakeAzureRead(LatencyProfile(args.ocr_latency, args.sigma, args.ocr_error_rate, 429),
+                            pages=args.pages, endpoint=OCR_ENDPOINT).start(),
+        await FakeAzureOpenAI(LatencyProfile(args.llm_latency, args.sigma, args.llm_error_rate, 429),
+                              LatencyProfile(args.embed_latency, args.sigma, args.llm_error_rate, 429)).start(),
+        await FakeAppian(LatencyProfile(args.appian_latency, args.sigma, args.appian_error_rate)).start(),
+    ]
+    configure_environment(args, services)
+
+    consumer = importlib.import_module("consumer")
+    from utils.metrics import metrics
+    from utils.resources import Resources
+
+    partitions = load_partitions(args.events, args.partitions)
+    total_events = sum(len(events) for events in partitions.values())
+    contexts = {partition_id: FakePartitionContext(partition_id) for partition_id in partitions}
+
+    resources = Resources()
+    await resources.startup()
+    pipeline = consumer.build_pipeline().start()
+    metrics.reset()
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*[
+            drive_partition(consumer, contexts[partition_id], events, args.batch_size, resources, pipeline)
+            for partition_id, events in partitions.items()
+        ])
+        # Appian deliveries are asynchronous, the run ends once the outbox is drained
+        while await resources.outbox.pending_count():
+            await asyncio.sleep(0.1)
+    finally:
+        elapsed = time.perf_counter() - started
+        pipeline_stats = pipeline.stats()
+        await pipeline.stop()
+        await resources.shutdown()
+        for service in services:
+            await service.stop()
+
+    processed = metrics.counter_total("events_processed")
+    openai_stats = next(service.stats() for service in services if service.name == "openai")
+    report = {
+        "events": total_events,
+        "partitions": len(partitions),
+        "elapsed_seconds": round(elapsed, 3),
+        "docs_per_second": round(total_events / elapsed, 3) if elapsed else None,
+        "processed": processed,
+        "failed": metrics.counter_total("events_failed"),
+        "stages": metrics.summary(),
+        "pipeline": pipeline_stats,
+        "services": {service.name: service.stats() for service in services},
+        "checkpoints": {partition_id: (context.checkpoints[-1] if context.checkpoints else None)
+                        for partition_id, context in contexts.items()},
+        "checkpoint_writes": sum(len(context.checkpoints) for context in contexts.values()),
+        "extraction_paths": {dict(labels)["path"]: count for (name, labels), count in metrics.counters.items()
+                             if name == "extraction_path"},
+        # embedding calls and embedded chunks per processed document (duplicates hit the cache),
+        # only the documents taking the retrieval path embed
+        "embedding_per_document": {
+            "requests": round(openai_stats["embedding_requests"] / processed, 2) if processed else None,
+            "inputs": round(openai_stats["embedded_inputs"] / processed, 2) if processed else None,
+        },
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+    return report
+
+def print_report(report):
+    print(f"\nEvents: {report['events']} over {report['partitions']} partitions "
+          f"in {report['elapsed_seconds']}s -> {report['docs_per_second']} docs/sec")
+    print(f"Processed: {report['processed']:.0f}  Failed: {report['failed']:.0f}  "
+          f"Peak RSS: {report['peak_rss_mb']} MB  Checkpoint writes: {report['checkpoint_writes']}")
+    print(f"\n{'stage':<14}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for stage, summary in sorted(report["stages"].items()):
+        print(f"{stage:<14}{summary['count']:>8}"
+              + "".join(f"{summary[q]:>10.3f}" for q in ("p50", "p95", "p99")))
+    print(f"Extraction paths: {report['extraction_paths']}")
+    print(f"Embedding per document: {report['embedding_per_document']['requests']} requests, "
+          f"{report['embedding_per_document']['inputs']} chunks")
+    print(f"\nServices: {json.dumps(report['services'])}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", required=True, help="JSONL file of event bodies (one per line)")
+    parser.add_argument("--generate", type=int, default=0, help="write this many synthetic events to --events first")
+    parser.add_argument("--duplicate-rate", type=float, default=0.1, help="share of generated events re-using a file")
+    parser.add_argument("--tenants", type=int, default=5, help="number of distinct uids in generated events")
+    parser.add_argument("--partitions", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--mongo-db", default="loadtest_documents")
+    parser.add_argument("--object-size", type=int, default=200 * 1024, help="bytes of every S3 object")
+    parser.add_argument("--large-rate", type=float, default=0.0, help="share of generated events with a large file")
+    parser.add_argument("--large-object-size", type=int, default=8 * 1024 * 1024, help="bytes of a large S3 object")
+    parser.add_argument("--pages", type=int, default=2, help="pages returned by the fake OCR")
+    parser.add_argument("--extraction-path", choices=("auto", "retrieval"), default="auto",
+                        help="'retrieval' sends every document through chunking, embedding and the index")
+    parser.add_argument("--sigma", type=float, default=0.5, help="log-normal spread of every latency")
+    parser.add_argument("--s3-latency", type=float, default=0.05)
+    parser.add_argument("--ocr-latency", type=float, default=1.5)
+    parser.add_argument("--embed-latency", type=float, default=0.2)
+    parser.add_argument("--llm-latency", type=float, default=4.0)
+    parser.add_argument("--appian-latency", type=float, default=0.1)
+    parser.add_argument("--s3-error-rate", type=float, default=0.0)
+    parser.add_argument("--ocr-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--appian-error-rate", type=float, default=0.0)
+    parser.add_argument("--report", help="also write the report as JSON to this path")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.generate:
+        generate_events(args.events, args.generate, args.duplicate_rate, args.tenants, args.large_rate)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
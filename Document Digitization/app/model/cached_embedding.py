@@ -0,0 +1,78 @@
+import asyncio
+from typing import Any, List
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.callbacks import CallbackManager
+
+from utils.embedding_cache import EmbeddingCache, chunk_key
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Embedding model answering from an EmbeddingCache and calling the wrapped model only for
+    the chunks it has never seen, in one batch per call.
+
+    It fires no callback events of its own: the wrapped model reports the chunks it actually
+    embeds, so the 'embedding_chunks' metric counts API work, not cache hits.
+    """
+    _inner: BaseEmbedding = PrivateAttr()
+    _cache: EmbeddingCache = PrivateAttr()
+
+    def __init__(self, inner: BaseEmbedding, cache: EmbeddingCache, **kwargs: Any):
+        super().__init__(
+            model_name=inner.model_name,
+            embed_batch_size=inner.embed_batch_size,
+            callback_manager=CallbackManager([]),
+            **kwargs,
+        )
+        self._inner = inner
+        self._cache = cache
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def _split(self, texts: List[str]):
+        keys = [chunk_key(self.model_name, text) for text in texts]
+        return keys, self._cache.get_many(keys)
+
+    def _merge(self, keys, found, missing, embedded):
+        self._cache.put_many(dict(zip([keys[i] for i in missing], embedded)))
+        found.update(zip([keys[i] for i in missing], embedded))
+        return [found[key] for key in keys]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        keys, found = self._split(texts)
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        embedded = self._inner.get_text_embedding_batch([texts[i] for i in missing]) if missing else []
+        return self._merge(keys, found, missing, embedded)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        keys, found = await asyncio.to_thread(self._split, texts)
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        embedded = await self._inner.aget_text_embedding_batch([texts[i] for i in missing]) if missing else []
+        return await asyncio.to_thread(self._merge, keys, found, missing, embedded)
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    # the extraction query is the same for every document, cache it too (apart from the
+    # chunks, a model may embed queries differently)
+    def _get_query_embedding(self, query: str) -> List[float]:
+        key = chunk_key(f"{self.model_name}:query", query)
+        vector = self._cache.get_many([key]).get(key)
+        if vector is None:
+            vector = self._inner.get_query_embedding(query)
+            self._cache.put_many({key: vector})
+        return vector
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        key = chunk_key(f"{self.model_name}:query", query)
+        vector = (await asyncio.to_thread(self._cache.get_many, [key])).get(key)
+        if vector is None:
+            vector = await self._inner.aget_query_embedding(query)
+            await asyncio.to_thread(self._cache.put_many, {key: vector})
+        return vector
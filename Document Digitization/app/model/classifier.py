@@ -0,0 +1,116 @@
+import re
+import math
+from contextlib import nullcontext
+
+from utils.metrics import metrics
+
+# Document labels with a compact prompt (see llm_prompts_1.compact_prompts), with the words of
+# their OCR text as (strong, weak) patterns: a strong one is worth 3 points, a weak one 1
+KEYWORDS = {
+    "Hotel": (
+        r"hotel|folio|check[- ]?in|check[- ]?out|room (?:charge|rate|no)|accommodation|no\.? of nights",
+        r"room|night|guest|arrival|departure|suite|resort|inn|lodging|city tax",
+    ),
+    "Food": (
+        r"restaurant|cafe|café|bistro|table \d+|covers|server|waiter",
+        r"menu|breakfast|lunch|dinner|coffee|burger|pizza|sandwich|salad|dessert|wine|beer|tips?|gratuity",
+    ),
+    "Ground Transport": (
+        r"taxi|cab|uber|lyft|trip fare|ride|chauffeur|car hire|car rental",
+        r"driver|pick[- ]?up|drop[- ]?off|mileage|km|miles|vehicle|toll|parking|fare",
+    ),
+    "Air Travel": (
+        r"flight|airlines?|airways|boarding pass|e-?ticket|fare basis|baggage|passenger facility charge",
+        r"airport|seat|carrier|segment|itinerary|pnr|terminal|economy|business class|departure",
+    ),
+    "Railways": (
+        r"railways?|rail|train|irctc|amtrak|eurostar|coach no|berth",
+        r"station|platform|pnr|journey|ticket|seat|class|departure",
+    ),
+}
+
+# Descriptions embedded once per process for the optional embedding classifier
+DESCRIPTIONS = {
+    "Hotel": "Hotel bill or folio: room nights, accommodation, guest, check-in and check-out dates, room service",
+    "Food": "Restaurant or cafe receipt: food and drinks ordered, table, server, tips and service charge",
+    "Ground Transport": "Taxi or ride receipt: trip fare, pick-up and drop-off, driver, distance, tolls and parking",
+    "Air Travel": "Airline ticket or flight invoice: passenger, flight segments, fare, airport taxes and fees, baggage",
+    "Railways": "Train ticket: from station to station, coach, berth or seat, class of travel, rail fare",
+}
+
+_PATTERNS = {
+    label: tuple(re.compile(rf"\b(?:{pattern})\b", re.IGNORECASE) for pattern in patterns)
+    for label, patterns in KEYWORDS.items()
+}
+
+def keyword_scores(text: str):
+    '''
+    Score of every label on the text: 3 points per distinct strong word found, 1 per weak word
+    '''
+    scores = {}
+    for label, (strong, weak) in _PATTERNS.items():
+        scores[label] = (3 * len({match.lower() for match in strong.findall(text)})
+                         + len({match.lower() for match in weak.findall(text)}))
+    return scores
+
+def _pick(scores: dict, minimum: float, better):
+    '''
+    Best label if it scores at least 'minimum' and 'better(best, runner-up)' holds, else None
+    '''
+    ranked = sorted(scores.items(), key=lambda pair: pair[1], reverse=True)
+    if not ranked or ranked[0][1] < minimum:
+        return None
+    runner_up = ranked[1][1] if len(ranked) > 1 else 0
+    return ranked[0][0] if better(ranked[0][1], runner_up) else None
+
+def _cosine(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+class DocumentClassifier:
+    """
+    Local guess of the document label from its OCR text, used to pick a compact prompt before
+    the LLM call.
+
+    Keywords come first: the best label needs 'min_score' points and twice the points of the
+    runner-up. When that is not conclusive and an 'embed_model' is given, the head of the text
+    is embedded and compared to the label descriptions, the closest one is kept if its cosine
+    similarity is at least 'min_similarity' and 'min_margin' above the runner-up. Otherwise
+    the document is unclassified and gets the full prompt.
+    """
+    _description_vectors = {}       # model name -> {label: embedding}, shared by the instances
+
+    def __init__(self, min_score=3, embed_model=None, min_similarity=0.8, min_margin=0.02, head_chars=2000):
+        self.min_score = min_score
+        self.embed_model = embed_model
+        self.min_similarity = min_similarity
+        self.min_margin = min_margin
+        self.head_chars = head_chars
+
+    async def _descriptions(self):
+        name = self.embed_model.model_name
+        vectors = self._description_vectors.get(name)
+        if vectors is None:
+            embeddings = await self.embed_model.aget_text_embedding_batch(list(DESCRIPTIONS.values()))
+            vectors = self._description_vectors[name] = dict(zip(DESCRIPTIONS, embeddings))
+        return vectors
+
+    async def classify(self, text: str, slot=None):
+        '''
+        (label, method) with method "keyword" or "embedding", (None, "none") when unclassified.
+        The embedding calls run in 'slot()' when given. Counted in the 'document_class' metric
+        '''
+        label = _pick(keyword_scores(text), self.min_score, lambda best, second: best >= 2 * second)
+        method = "keyword"
+        if label is None and self.embed_model is not None and text.strip():
+            async with (slot or nullcontext)():
+                vector = await self.embed_model.aget_text_embedding(text[:self.head_chars])
+                descriptions = await self._descriptions()
+            similarities = {name: _cosine(vector, description) for name, description in descriptions.items()}
+            label = _pick(similarities, self.min_similarity, lambda best, second: best - second >= self.min_margin)
+            method = "embedding"
+        if label is None:
+            method = "none"
+        metrics.inc("document_class", label=label or "unclassified", method=method)
+        return label, method
@@ -0,0 +1,135 @@
+import re
+import json
+from ast import literal_eval
+
+# Fields of the extraction output (see llm_prompts_1.additional_prompts)
+LABEL = "Document Label"
+TOTAL = "Invoice Total"
+LINE_ITEMS = "Invoice line-items"
+INVOICE_FIELDS = (LABEL, LINE_ITEMS, TOTAL)
+LINE_ITEM_KEYS = ("Quantity", "Item Name", "Amount", "Category")
+
+# Other spellings of the fields seen in answers (and in the older prompts)
+_ALIASES = {
+    "document label": LABEL, "document_label": LABEL, "document type": LABEL, "document_type": LABEL,
+    "invoice total": TOTAL, "invoice_total": TOTAL, "total": TOTAL,
+    "invoice line-items": LINE_ITEMS, "invoice line items": LINE_ITEMS, "invoice_line_items": LINE_ITEMS,
+    "line-items": LINE_ITEMS, "line items": LINE_ITEMS, "line_items": LINE_ITEMS,
+    "quantity": "Quantity", "item name": "Item Name", "item_name": "Item Name",
+    "amount": "Amount", "category": "Category",
+}
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+_MAX_CUTS = 200
+
+def _loads(text: str):
+    for parse in (json.loads, literal_eval):
+        try:
+            value = parse(text)
+        except Exception:
+            continue
+        if isinstance(value, dict):
+            return value
+    return None
+
+def _close(text: str):
+    '''
+    Close the arrays and objects left open at the end of a truncated answer, None when it
+    ends inside a string (a value cut in the middle is not kept)
+    '''
+    closing = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            closing.append("}" if char == "{" else "]")
+        elif char in "}]" and closing:
+            closing.pop()
+    if in_string:
+        return None
+    return text + "".join(reversed(closing))
+
+def repair_json(text):
+    '''
+    Best-effort dict from an LLM answer: strips code fences and prose around the object,
+    accepts Python literals and trailing commas, and for a truncated answer keeps every
+    complete value before the cut. None if nothing can be recovered
+    '''
+    if isinstance(text, dict):
+        return text
+    if not isinstance(text, str):
+        return None
+    start = text.find("{")
+    if start < 0:
+        return None
+    end = text.rfind("}")
+    candidates = [text[start:end + 1]] if end > start else []
+    candidates.append(text[start:].rstrip().rstrip("`").rstrip())
+    for candidate in candidates:
+        value = _loads(_TRAILING_COMMA.sub(r"\1", candidate))
+        if value is not None:
+            return value
+
+    # truncated or broken further down: cut back to the last complete value and close
+    body = candidates[-1]
+    cuts = [len(body)] + [match.start() for match in re.finditer(",", body)][::-1][:_MAX_CUTS]
+    for cut in cuts:
+        candidate = _close(body[:cut].rstrip().rstrip(","))
+        if candidate is None:
+            continue
+        value = _loads(_TRAILING_COMMA.sub(r"\1", candidate))
+        if value is not None:
+            return value
+    return None
+
+def normalise_keys(value: dict):
+    return {_ALIASES.get(str(key).strip().lower(), str(key).strip()): item for key, item in value.items()}
+
+def _is_scalar(value):
+    return isinstance(value, (str, int, float)) and not isinstance(value, bool)
+
+def _line_item(value):
+    '''
+    Line item with the expected keys, None unless it has an item name and an amount
+    '''
+    if not isinstance(value, dict):
+        return None
+    item = normalise_keys(value)
+    if not all(_is_scalar(item.get(key)) and str(item.get(key)).strip() for key in ("Item Name", "Amount")):
+        return None
+    for key in LINE_ITEM_KEYS:
+        if not _is_scalar(item.get(key)):
+            item[key] = ""
+    return item
+
+def validate_invoice(output, fields=INVOICE_FIELDS):
+    '''
+    Check 'fields' of an extraction output. Returns (valid fields, names of the missing or
+    invalid ones); invalid line items are dropped, the list is kept if any item is valid
+    '''
+    if not isinstance(output, dict):
+        return {}, list(fields)
+    output = normalise_keys(output)
+    valid, invalid = {}, []
+    for field in fields:
+        value = output.get(field)
+        if field == LINE_ITEMS:
+            items = [item for item in map(_line_item, value) if item is not None] if isinstance(value, list) else []
+            ok = bool(items)
+            value = items
+        elif field == LABEL:
+            ok = isinstance(value, str) and bool(value.strip())
+        else:
+            ok = _is_scalar(value)
+        if ok:
+            valid[field] = value
+        else:
+            invalid.append(field)
+    return valid, invalid
@@ -98,6 +98,84 @@ Rules:
 - always pick amount for respective line items in same row and nearby , give always valid line items as per context and requirement
 - Provide response always in "JSON" 
 """
+
+# Re-ask for the fields missing or invalid in an answer (see OpenAI_Extract.finish_output)
+field_prompts = {
+    "Document Label": '"Document Label": which document it is ? ex: Food, Ground Transport, Air Travel, Hotel, Railways, Miscellaneous',
+    "Invoice line-items": '"Invoice line-items": list of line items, each {"Quantity": ..., "Item Name": ..., "Amount": ..., "Category": ...} with Category one of Food, Alcohol, Taxi, Air Travel, Hotel, Non-Alcohol, Railways, Miscellaneous, Tax',
+    "Invoice Total": '"Invoice Total": total amount of the invoice with its currency symbol, ex: "$13.14"',
+}
+
+repair_prompt = """  Extract only the following fields in JSON format from text :
+{fields}
+
+Rules:
+- directly give the JSON dictionary with only these keys, nothing before or after it
+- include the currency symbol in amounts
+- Present what ever present , else leave it with blank
+"""
+
+# Compact prompts for a document already classified locally (see model.classifier), with the
+# rules of its own categories only
+compact_system_prompt = '''You are an expert in fetching information from {label} documents. do not hallucinate features.
+                    \n arrange text properly as per document order to extract key value pair and table information.
+                    \n Always Give output in given input language only
+                    Present text as exist in documents with same sequence of order and dont add your views'''
+
+compact_prompt = """  Extract following fields in JSON format from this {label} document :
+- Invoice line-items : Quantity, Item Name, Amount, Category (one of: {categories})
+- Invoice Total
+- Document Label: {label}, unless it clearly is another one of: Food, Ground Transport, Air Travel, Hotel, Railways, Miscellaneous
+
+Output Example:
+{{"Document Label": "{label}", "Invoice line-items": [{example}], "Invoice Total": "$13.14"}}
+
+Rules:
+- directly give the JSON dictionary, nothing before or after it
+- Do not add duplicates in line items
+- include the currency symbol in amounts, '$' if none is present; if only a currency denotation is present, give it (e.g: "USD", "GBP")
+- exclude credit card payments in line items, Ex: American Express, Visa Card, card transactions, UPI payments
+- extract taxes and charges as line items of Category Tax ex: {{"Quantity": "1","Item Name": "Tax","Amount": "$10.00","Category": "Tax"}}
+- Present what ever present , else leave it with blank
+{rules}"""
+
+category_prompts = {
+    "Hotel": {
+        "categories": "Hotel, Food, Alcohol, Non-Alcohol, Tax, Miscellaneous",
+        "example": '{"Quantity": "2","Item Name": "Room Charge","Amount": "$240.00","Category": "Hotel"}',
+        "rules": "- extract all line items of the bill: room nights, Food, etc\n"
+                 "- extract charges like Accommodation Service Charge, Accommodation GST, Central London Fee",
+    },
+    "Food": {
+        "categories": "Food, Alcohol, Non-Alcohol, Tax, Miscellaneous",
+        "example": '{"Quantity": "1","Item Name": "Burger","Amount": "$12.50","Category": "Food"}',
+        "rules": "- check item description, only food items are Food\n"
+                 "- extract Tips and service charges as line items",
+    },
+    "Ground Transport": {
+        "categories": "Taxi, Tax, Miscellaneous",
+        "example": '{"Quantity": "1","Item Name": "Trip fare","Amount": "£39.63","Category": "Taxi"}',
+        "rules": "- keep the currency sign of the fare, ex: £\n"
+                 "- extract Tips, tolls and Transportation Tax as line items",
+    },
+    "Air Travel": {
+        "categories": "Air Travel, Tax, Miscellaneous",
+        "example": '{"Quantity": "1","Item Name": "LHR - JFK","Amount": "$450.00","Category": "Air Travel"}',
+        "rules": "- one line item per flight, item name From - To\n"
+                 "- extract taxes like Passenger Facility Charge, Flight Segment Tax",
+    },
+    "Railways": {
+        "categories": "Railways, Tax, Miscellaneous",
+        "example": '{"Quantity": "1","Item Name": "London - Paris","Amount": "$120.00","Category": "Railways"}',
+        "rules": "- item name will be From destination -  To Destination (just give only this)",
+    },
+}
+
+compact_prompts = {
+    label: (compact_system_prompt.format(label=label),
+            compact_prompt.format(label=label, **parts))
+    for label, parts in category_prompts.items()
+}
 # New Prompts ends  
 
 ######Prompts Testing 
@@ -0,0 +1,100 @@
+import re
+from collections import Counter
+
+from model.json_repair import LABEL, TOTAL, LINE_ITEMS
+
+# Digits with their separators, the first run in the text; the dot of a currency token such
+# as "Rs." is never between two digits so it never gets in
+_NUMBER = re.compile(r"\d(?:[\d.,]*\d)?")
+# A minus sign before the number, possibly ahead of its currency ("-$5", "- Rs. 5")
+_NEGATIVE = re.compile(r"-\s*(?:[^\d\s]+\s*)?$")
+
+def parse_amount(value):
+    '''
+    Number in an amount like "$1,234.56", "1.234,56 EUR", "Rs. 1,00,000.00" or 12.5, None if
+    there is none.
+
+    With both separators the last one is the decimal one. A single separator followed by
+    exactly three digits groups thousands ("USD 1.000"), by one or two digits it is the decimal
+    one ("12,5"). A separator repeated is always a grouping one (also Indian "1,00,000").
+    '''
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    text = str(value or "")
+    match = _NUMBER.search(text)
+    if match is None:
+        return None
+    number = match.group()
+    if "," in number and "." in number:
+        decimal = "," if number.rfind(",") > number.rfind(".") else "."
+    else:
+        separator = "," if "," in number else "."
+        whole, _, fraction = number.rpartition(separator)
+        if number.count(separator) != 1 or (len(fraction) == 3 and whole != "0"):
+            decimal = None
+        else:
+            decimal = separator
+    whole, _, fraction = number.rpartition(decimal) if decimal else (number, "", "")
+    number = re.sub(r"[.,]", "", whole) + (f".{fraction}" if decimal else "")
+    if _NEGATIVE.search(text[:match.start()]):
+        number = f"-{number}"
+    try:
+        return float(number)
+    except ValueError:
+        return None
+
+def _item_key(item: dict):
+    name = " ".join(str(item.get("Item Name", "")).lower().split())
+    return name, parse_amount(item.get("Amount")), str(item.get("Quantity", "")).strip()
+
+def _total_of(items):
+    return round(sum(parse_amount(item.get("Amount")) or 0 for item in items), 2)
+
+def merge_outputs(outputs):
+    '''
+    Merge the extraction outputs of the page groups of one document, in page order.
+
+    Line items: an item repeated on several groups (e.g. a folio summary page listing the
+    charges again) is kept as often as it appears in a single group, unless keeping every
+    occurrence matches the invoice total better. Total: a group total equal to the sum of
+    the merged items, else the largest one (a grand total is never below its subtotals).
+    Label: the most common one. None if no group produced anything.
+    '''
+    outputs = [output for output in outputs if output]
+    if not outputs:
+        return None
+
+    all_items, most = [], Counter()
+    for output in outputs:
+        items = output.get(LINE_ITEMS) or []
+        all_items.extend(items)
+        most |= Counter(_item_key(item) for item in items)
+    deduped, seen = [], Counter()
+    for item in all_items:
+        key = _item_key(item)
+        if seen[key] < most[key]:
+            seen[key] += 1
+            deduped.append(item)
+
+    totals = [output.get(TOTAL) for output in outputs if str(output.get(TOTAL, "")).strip()]
+    amounts = [(parse_amount(total), total) for total in totals]
+    amounts = [(amount, total) for amount, total in amounts if amount is not None]
+
+    items = deduped
+    if amounts and len(deduped) != len(all_items):
+        grand_total = max(amount for amount, _ in amounts)
+        if abs(_total_of(all_items) - grand_total) < abs(_total_of(deduped) - grand_total):
+            items = all_items
+
+    total = ""
+    if amounts:
+        matching = [total for amount, total in amounts if abs(amount - _total_of(items)) < 0.01]
+        total = matching[-1] if matching else max(amounts, key=lambda pair: pair[0])[1]
+    elif totals:
+        total = totals[-1]
+
+    labels = Counter(str(output.get(LABEL, "")).strip() for output in outputs)
+    labels.pop("", None)
+    label = labels.most_common(1)[0][0] if labels else ""
+
+    return {LABEL: label, LINE_ITEMS: items, TOTAL: total}
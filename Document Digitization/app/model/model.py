@@ -1,25 +1,48 @@
-import json
+import asyncio
+import hashlib
+from functools import cache
+from contextlib import nullcontext
 import pandas as pd
 from utils import config
-from ast import literal_eval
 from utils.config import logger
+from utils.metrics import metrics
+from utils.extraction_cache import file_hash
+from utils.dead_letter import UnsupportedDocument
 from model.ocr_engine import OCR_Engine
+from model.tesseract_ocr import TesseractOCR
+from utils.adaptive import throttle_info, retryable, CallSize
+from utils.pipeline import backoff_delay
+from model.token_usage import TokenUsageHandler
+from model.json_repair import repair_json, validate_invoice, normalise_keys, LINE_ITEMS, LABEL
+from model.map_reduce import merge_outputs
+from model.classifier import DocumentClassifier
+from model.cached_embedding import CachedEmbedding
+from utils.embedding_cache import EmbeddingCache
 import model.llm_prompts_1 as prompts
 
 from llama_index.core.ingestion import IngestionPipeline
-from llama_index.core.node_parser import MarkdownNodeParser
+from llama_index.core.node_parser import MarkdownNodeParser, SentenceSplitter
 from llama_index.llms.azure_openai import AzureOpenAI
 from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
-from llama_index.core import Document, VectorStoreIndex, StorageContext, Settings
+from llama_index.core.schema import TextNode, MetadataMode
+from llama_index.core.utils import get_tokenizer
+from llama_index.core.prompts.default_prompt_selectors import DEFAULT_TEXT_QA_PROMPT_SEL
+from llama_index.core.callbacks import CallbackManager
+from llama_index.core import Document, VectorStoreIndex, Settings
 
 # from dotenv import load_dotenv
 # load_dotenv()
 
+# token usage of the LLM and embedding calls, exported with the consumer metrics
+callback_manager = CallbackManager([TokenUsageHandler()])
+
 llm=AzureOpenAI(
             engine=config.llm_model_name,
             api_key = config.azure_openai_api_key,
     azure_endpoint = config.azure_openai_api_base,
-    api_version = config.azure_openai_api_version
+    api_version = config.azure_openai_api_version,
+    max_retries = config.azure_openai_max_retries,
+    callback_manager = callback_manager
             )
 embed_model = AzureOpenAIEmbedding(
     model = "text-embedding-ada-002",
@@ -27,75 +50,380 @@ embed_model = AzureOpenAIEmbedding(
     api_key = config.azure_openai_api_key,
     azure_endpoint = config.azure_openai_api_base,
     api_version = config.azure_openai_api_version,
+    max_retries = config.azure_openai_max_retries,
+    callback_manager = callback_manager,
 )
+# chunks repeated across documents (headers, terms, tax footers) are embedded once
+embedding_cache = None
+if config.embedding_cache_enabled:
+    embedding_cache = EmbeddingCache(config.embedding_cache_path, config.embedding_cache_max_entries)
+    embed_model = CachedEmbedding(embed_model, embedding_cache)
 Settings.llm=llm
 Settings.embed_model = embed_model
+Settings.callback_manager = callback_manager
 Settings.chunk_size = 512
 
+# Cache keys of the embedded chunks and of the final output, a change of model, chunking or
+# prompts gives a new key so stale entries are never served
+EMBED_CACHE_KEY = f"{embed_model.model_name}-markdown-sentence-{Settings.chunk_size}"
+# chunks retrieved per query, and the rough size of a chunk in characters (about 4 a token):
+# LLM calls are sized in chunks for the adaptive limiter
+RETRIEVAL_TOP_K = 30
+CHUNK_CHARS = Settings.chunk_size * 4
+
+EXTRACTION_QUERY = f"{prompts.system_prompt}\n\nExtraction Guidelines : {prompts.additional_prompts}"
+# shorter queries for the documents classified before the LLM call, by document label
+COMPACT_QUERIES = {
+    label: f"{system}\n\nExtraction Guidelines : {guidelines}"
+    for label, (system, guidelines) in prompts.compact_prompts.items()
+}
+
+OUTPUT_CACHE_KEY = hashlib.sha256(
+    "\n".join([config.llm_model_name, EXTRACTION_QUERY, *COMPACT_QUERIES.values()]).encode("utf-8")
+).hexdigest()[:16]
+
+classifier = DocumentClassifier(
+    min_score=config.document_classifier_min_score,
+    embed_model=embed_model if config.document_classifier_embeddings else None,
+    min_similarity=config.document_classifier_min_similarity,
+    min_margin=config.document_classifier_min_margin,
+)
+
+@cache
+def prompt_tokens(query):
+    return len(get_tokenizer()(query))
+
+OCR_BACKENDS = {backend.name: backend for backend in (OCR_Engine, TesseractOCR)}
+
 class OpenAI_Extract:
-    def __init__(self, session):
+    def __init__(self, session, cache=None, limiters=None, ocr_cache=None, ocr_backend=None):
         self.session = session
+        self.cache = cache          # optional ExtractionCache
+        self.ocr_cache = ocr_cache      # optional in-process OcrResultCache
+        self.limiters = limiters or {}      # optional AdaptiveLimiter per downstream service
+        self.ocr_backend = ocr_backend or config.ocr_backend
+        self.label = None           # document label guessed before the LLM call, see classify()
+        self._group_outputs = {}    # outputs of the page groups extracted so far, see map_reduce_query()
+        if self.ocr_backend not in OCR_BACKENDS:
+            raise UnsupportedDocument(f"Unknown OCR backend {self.ocr_backend!r}, expected one of {list(OCR_BACKENDS)}")
+
+    def _slot(self, service):
+        '''
+        Call slot of the service's adaptive limiter, a no-op without one
+        '''
+        limiter = self.limiters.get(service)
+        return limiter.slot() if limiter is not None else nullcontext(CallSize())
+
+    async def ocr(self, file_bytes, file_key=None):
+        '''
+        OCR pages of the file, from the extraction cache or from the OCR backend. Returns
+        (pages, backend that produced them)
+        '''
+        # the extraction cache only holds pages of the configured backend
+        persisted = self.cache is not None and file_key and self.ocr_backend == config.ocr_backend
+        if persisted:
+            op_ocr = await self.cache.get_ocr_pages(file_key)
+            if op_ocr is not None:
+                return op_ocr, config.ocr_backend
+        op_ocr, backend = await self.run_ocr(file_bytes)
+        # a fallback result is not kept, the next upload of the file gets the usual backend
+        if persisted and backend == config.ocr_backend:
+            await self.cache.put_ocr_pages(file_key, op_ocr)
+        return op_ocr, backend
+
+    async def _ocr_to_cache(self, file_bytes, file_key):
+        op_ocr, backend = await self.ocr(file_bytes, file_key)
+        return op_ocr, backend == self.ocr_backend
+
+    def _ocr_engine(self, backend):
+        if backend == OCR_Engine.name:
+            return OCR_Engine(slot=lambda: self._slot("azure_read"))
+        return OCR_BACKENDS[backend]()
+
+    async def run_ocr(self, file_bytes):
+        '''
+        OCR the file with the document's backend, or with the fallback backend while Azure Read
+        is throttled. Returns (pages, backend used)
+        '''
+        backend = self.ocr_backend
+        fallback = config.ocr_fallback_backend if backend == OCR_Engine.name else None
+        limiter = self.limiters.get("azure_read")
+        if not (fallback and limiter is not None and limiter.paused):
+            try:
+                op_ocr = await self._ocr_engine(backend).get_ocr_output(file_bytes, self.session)
+                metrics.inc("ocr_backend", backend=backend)
+                return op_ocr, backend
+            except Exception as exp:
+                if not fallback or throttle_info(exp) is None:
+                    raise
+                logger.info(f"Azure Read throttled ({exp}), OCR with {fallback}")
+        metrics.inc("ocr_fallback", backend=fallback)
+        op_ocr = await self._ocr_engine(fallback).get_ocr_output(file_bytes, self.session)
+        metrics.inc("ocr_backend", backend=fallback)
+        return op_ocr, fallback
 
-    async def data_index(self, file_name, file_bytes):
+    async def data_index(self, file_name, file_bytes, file_key=None):
         documents = []
         # ocr_out = await ocr_output(file)
         # op_ocr = await OCR_Engine.get_ocr_output(file, self.session)
-        ocr_engine = OCR_Engine()
-        op_ocr = await ocr_engine.get_ocr_output(file_bytes, self.session)
+        if self.ocr_cache is not None and file_key:
+            # duplicate uploads in flight at the same time share one OCR call, the output of a
+            # fallback backend is not cached for the uploads coming later
+            op_ocr = await self.ocr_cache.get_or_compute(f"{file_key}:{self.ocr_backend}",
+                                                         lambda: self._ocr_to_cache(file_bytes, file_key))
+        else:
+            op_ocr, _ = await self.ocr(file_bytes, file_key)
         
         for page_num, content in op_ocr.items():
             documents.append(Document(text=content, metadata={"filename": file_name, "page_num": page_num}))
         return documents
     
-    async def get_query_engine(self, documents):
+    @staticmethod
+    def index_nodes(nodes):
+        '''
+        Query engine over chunks that already carry their embedding, VectorStoreIndex only
+        embeds nodes without one so this makes no embedding call
+        '''
+        with metrics.timer("index"):
+            index = VectorStoreIndex(nodes, embed_model=embed_model)
+        return index.as_query_engine(similarity_top_k=RETRIEVAL_TOP_K)
+
+    async def get_query_engine(self, documents, file_key=None):
+        if self.cache is not None and file_key:
+            cached_nodes = await self.cache.get_nodes(file_key, EMBED_CACHE_KEY)
+            if cached_nodes is not None:
+                # chunks are already embedded, index them as they are
+                return self.index_nodes([TextNode.from_dict(node) for node in cached_nodes])
+
+        # Chunk and embed once: markdown sections, split to the chunk size the index used to
+        # be built with, then embedded in batches (in this process, so the embedding cache applies)
         pipeline = IngestionPipeline(
-            transformations=[MarkdownNodeParser(), embed_model]
+            transformations=[MarkdownNodeParser(), SentenceSplitter(chunk_size=Settings.chunk_size), embed_model]
         )
-        nodes = await pipeline.arun(documents=documents, num_workers=8)
-        
-        index = VectorStoreIndex(nodes)
-        storage_context = StorageContext.from_defaults()
-        index = VectorStoreIndex.from_documents(
-            documents,
-            storage_context=storage_context,
-        )
-        query_engine = index.as_query_engine(similarity_top_k=30)
-        return  query_engine
+        async with self._slot("azure_openai") as call:
+            with metrics.timer("embedding"):
+                nodes = await pipeline.arun(documents=documents)
+            call.units = len(nodes)
+        if self.cache is not None and file_key:
+            await self.cache.put_nodes(file_key, EMBED_CACHE_KEY, [node.to_dict() for node in nodes])
+        return self.index_nodes(nodes)
+
+    async def classify(self, documents):
+        '''
+        Guess the document label from the OCR text so that the LLM gets the compact prompt of
+        its category (see extraction_query()), None when unsure or disabled. Documents getting
+        the compact prompt are counted once per label in 'compact_prompt', with the tokens one
+        prompt saves over the full one in 'prompt_tokens_saved'
+        '''
+        if config.document_classifier_enabled:
+            text = "\n\n".join(document.text for document in documents)
+            self.label, method = await classifier.classify(text, slot=lambda: self._slot("azure_openai"))
+            logger.info(f"Document classified as {self.label} ({method})")
+            if self.label is not None:
+                saved = prompt_tokens(EXTRACTION_QUERY) - prompt_tokens(COMPACT_QUERIES[self.label])
+                metrics.inc("compact_prompt", label=self.label)
+                metrics.inc("prompt_tokens_saved", saved, label=self.label)
+        return self.label
+
+    def extraction_query(self):
+        '''
+        Extraction prompts for the document: the compact ones of its label when it was classified
+        '''
+        if self.label is None:
+            return EXTRACTION_QUERY
+        return COMPACT_QUERIES[self.label]
+
+    def extraction_path(self, documents):
+        '''
+        How the pages are sent to the LLM, counted in the 'extraction_path' metric:
+        - "direct": the OCR text is short enough to be sent whole (see direct_query())
+        - "map_reduce": a longer document of at least 'map_reduce_min_pages' pages, extracted
+          page group by page group (see map_reduce_query())
+        - "retrieval": chunks retrieved from the vector index (see query())
+        '''
+        limit = config.direct_context_max_tokens
+        text_length = sum(len(document.text) for document in documents)
+        # a token is rarely longer than 10 characters, skip tokenizing documents far above the limit
+        if limit <= 0 or text_length > limit * 10:
+            direct = False
+        else:
+            tokenizer = get_tokenizer()
+            tokens = sum(len(tokenizer(document.text)) for document in documents)
+            direct = tokens <= limit
+        if direct:
+            path = "direct"
+        elif config.map_reduce_min_pages > 0 and len(documents) >= config.map_reduce_min_pages:
+            path = "map_reduce"
+        else:
+            path = "retrieval"
+        metrics.inc("extraction_path", path=path)
+        return path
         
-    async def get_llm_output(self, file_name, file_bytes):
+    def validate_file_type(self, file_name):
         if not ( file_name.lower().endswith(".pdf") or file_name.lower().endswith(".jpeg") or file_name.lower().endswith(".jpg") or file_name.lower().endswith(".png")):
-            raise Exception(status_code=400, detail="Only PDF, JPEG,JPG and PNG files are allowed")
+            raise UnsupportedDocument("Only PDF, JPEG,JPG and PNG files are allowed")
 
-        # with NamedTemporaryFile(delete=False) as temp_file:
-        #     temp_file.write(await file.read())
-        #     temp_file.seek(0)
-        logger.info("Started indexing")
-        documents= await self.data_index(file_name, file_bytes)
-            
-        logger.info("Creating Query Engine")
-        query_engine= await self.get_query_engine(documents)
-            
+    def get_file_key(self, file_bytes):
+        '''
+        Cache key of the file, None when no cache is configured
+        '''
+        if self.cache is None and self.ocr_cache is None:
+            return None
+        return file_hash(file_bytes)
+
+    async def get_cached_output(self, file_key):
+        if self.cache is None or not file_key:
+            return None
+        cached_op = await self.cache.get_output(file_key, OUTPUT_CACHE_KEY)
+        if cached_op is not None:
+            logger.info(f"Extraction cache hit: {file_key}")
+        return cached_op
+
+    async def query(self, query_engine, file_key=None):
+        '''
+        Run the extraction prompts on the query engine and parse the answer, None if unparsable
+        '''
         logger.info("Querying from Index")
-        full_query = f"{prompts.system_prompt}\n\nExtraction Guidelines : {prompts.additional_prompts}"
         # out_name =await llm_out(query_engine)
-        out_name = await query_engine.aquery(full_query)
-        out_name = out_name.response
-            
-        # final_out_2=fix_final_json(out_name)
-        logger.info(f"response:{out_name}")
+        async def ask(query):
+            async with self._slot("azure_openai") as call:
+                call.units = RETRIEVAL_TOP_K
+                with metrics.timer("llm"):
+                    return (await query_engine.aquery(query)).response
+        return await self.finish_output(await ask(self.extraction_query()), ask, file_key)
 
+    async def direct_query(self, documents, file_key=None, repair_attempts=None):
+        '''
+        Run the extraction prompts on the full text of the pages, with the question-answering
+        prompt of the query engine but no embedding or retrieval. Parsed answer, None if unparsable
+        '''
+        logger.info("Querying with the full document")
+        context = "\n\n".join(document.get_content(metadata_mode=MetadataMode.LLM) for document in documents)
+        async def ask(query):
+            async with self._slot("azure_openai") as call:
+                call.units = len(context) / CHUNK_CHARS
+                with metrics.timer("llm"):
+                    return await llm.apredict(DEFAULT_TEXT_QA_PROMPT_SEL, context_str=context, query_str=query)
+        return await self.finish_output(await ask(self.extraction_query()), ask, file_key, repair_attempts)
+
+    async def map_reduce_query(self, documents, file_key=None):
+        '''
+        Extract every group of 'map_reduce_pages_per_call' pages as a short document, with at
+        most 'map_reduce_concurrency' calls of the document in flight, then merge the outputs
+        locally in page order (see merge_outputs()). None if no group gave an output.
+
+        A failed group is retried on its own, up to 'map_reduce_group_retries' times. The outputs
+        of the groups already extracted are kept on this object, so a retry of the llm stage only
+        calls the LLM for the groups that are still missing
+        '''
+        size = max(1, config.map_reduce_pages_per_call)
+        groups = [documents[start:start + size] for start in range(0, len(documents), size)]
+        keys = [hashlib.sha256("\n\n".join(document.text for document in group).encode("utf-8")).hexdigest()
+                for group in groups]
+        missing = [index for index, key in enumerate(keys) if key not in self._group_outputs]
+        logger.info(f"Querying {len(missing)} of {len(groups)} page groups")
+        semaphore = asyncio.Semaphore(max(1, config.map_reduce_concurrency))
+
+        async def extract_group(index):
+            async with semaphore:
+                self._group_outputs[keys[index]] = await self._extract_group_with_retries(index, groups[index])
+
+        tasks = [asyncio.ensure_future(extract_group(index)) for index in missing]
         try:
-            op = json.loads(out_name)
-            logger.info(f"op_1::::::::::::::::::{op}")
-        except:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # a group that ran out of retries fails the stage, stop the others
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        metrics.inc("map_reduce_calls", len(missing))
+        op = merge_outputs([self._group_outputs[key] for key in keys])
+        logger.info(f"Merged_op::::::::::::::::::{op}")
+        if op is not None and self.cache is not None and file_key:
+            await self.cache.put_output(file_key, OUTPUT_CACHE_KEY, op)
+        return op
+
+    async def _extract_group_with_retries(self, index, group):
+        attempt = 0
+        while True:
             try:
-                op = out_name.json()
-                logger.info(f"op_2::::::::::::::::::{op}")
-            except:
-                try:
-                    op = literal_eval(out_name)
-                    logger.info(f"op_3::::::::::::::::::{op}")
-                except:
-                    op = None
+                # most groups have no total or no line items, that is not worth a re-ask
+                return await self.direct_query(group, repair_attempts=0)
+            except Exception as exp:
+                if attempt >= config.map_reduce_group_retries or not retryable(exp):
+                    raise
+                info = throttle_info(exp)
+                delay = max(backoff_delay(attempt, config.retry_exp_wait_multiplier, config.retry_wait_max),
+                            (info[1] or 0) if info else 0)
+                metrics.inc("map_reduce_group_retries")
+                logger.info(f"Extraction of page group {index} failed ({exp}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def finish_output(self, out_name, ask, file_key=None, repair_attempts=None):
+        '''
+        Parse and validate the answer of the LLM, keeping every valid field of a malformed or
+        incomplete answer, and re-ask 'ask' (same index or context) for the missing or invalid
+        fields only. Fields still invalid after 'repair_attempts' re-asks (by default
+        'llm_repair_attempts') are left blank.
+        Caches and returns the output, None if no field could be extracted
+        '''
+        # final_out_2=fix_final_json(out_name)
+        logger.info(f"response:{out_name}")
+        op = repair_json(out_name)
+        valid, invalid = validate_invoice(op)
+        if invalid:
+            metrics.inc("llm_output_invalid")
+        if repair_attempts is None:
+            repair_attempts = config.llm_repair_attempts
+        for attempt in range(repair_attempts):
+            if not invalid:
+                break
+            logger.info(f"Re-asking the LLM for {invalid}")
+            metrics.inc("llm_field_repairs", len(invalid))
+            fields = "\n".join(f"- {prompts.field_prompts[field]}" for field in invalid)
+            answer = await ask(f"{prompts.system_prompt}\n\n{prompts.repair_prompt.format(fields=fields)}")
+            repaired, invalid = validate_invoice(repair_json(answer), fields=invalid)
+            valid.update(repaired)
+        if not valid:
+            logger.info("Final_op::::::::::::::::::None")
+            return None
+        if self.label is not None and valid.get(LABEL, self.label) != self.label:
+            # the classifier guessed wrong, or the label is not one of the usual ones
+            metrics.inc("document_class_mismatch", label=self.label)
+        if invalid:
+            metrics.inc("llm_output_incomplete")
+            logger.info(f"Fields left blank after repair: {invalid}")
+
+        extra = normalise_keys(op) if isinstance(op, dict) else {}
+        op = {**extra, **{field: [] if field == LINE_ITEMS else "" for field in invalid}, **valid}
         logger.info(f"Final_op::::::::::::::::::{op}")
+        if self.cache is not None and file_key:
+            await self.cache.put_output(file_key, OUTPUT_CACHE_KEY, op)
         return op
+
+    async def get_llm_output(self, file_name, file_bytes):
+        self.validate_file_type(file_name)
+
+        # with NamedTemporaryFile(delete=False) as temp_file:
+        #     temp_file.write(await file.read())
+        #     temp_file.seek(0)
+        file_key = self.get_file_key(file_bytes)
+        cached_op = await self.get_cached_output(file_key)
+        if cached_op is not None:
+            return cached_op
+
+        logger.info("Started indexing")
+        documents= await self.data_index(file_name, file_bytes, file_key)
+        await self.classify(documents)
+        path = self.extraction_path(documents)
+        if path == "direct":
+            return await self.direct_query(documents, file_key)
+        if path == "map_reduce":
+            return await self.map_reduce_query(documents, file_key)
+            
+        logger.info("Creating Query Engine")
+        query_engine= await self.get_query_engine(documents, file_key)
+            
+        return await self.query(query_engine, file_key)
@@ -1,21 +1,137 @@
 # import requests
+import io
 import time
-from functools import cache
 import json
 import asyncio
+from contextlib import nullcontext
+
+from pypdf import PdfReader, PdfWriter
 
 from utils import config
 from utils.config import logger
+from utils.metrics import metrics
+from utils.pipeline import backoff_delay
+from utils.adaptive import parse_retry_after, throttle_info, retryable, CallSize
+
+def split_pdf(data, pages_per_shard: int, min_pages: int):
+    '''
+    Split a PDF into documents of 'pages_per_shard' pages, None when it has fewer than
+    'min_pages' pages or cannot be read (it is then OCR'd whole)
+    '''
+    try:
+        reader = PdfReader(io.BytesIO(data))
+        total = len(reader.pages)
+        if total < min_pages:
+            return None
+        shards = []
+        for start in range(0, total, pages_per_shard):
+            writer = PdfWriter()
+            for index in range(start, min(start + pages_per_shard, total)):
+                writer.add_page(reader.pages[index])
+            buffer = io.BytesIO()
+            writer.write(buffer)
+            shards.append(buffer.getvalue())
+        return shards
+    except Exception as exp:
+        logger.info(f"Could not split the PDF into page ranges: {exp}")
+        return None
 
-class OCR_Engine:
-    def __init__(self):
+class OCRBackend:
+    """
+    Interface of the OCR backends: get_ocr_output() returns the text of every page of a file
+    as {"Page_N": text}, pages numbered from 1 in document order
+    """
+    name = None
+
+    async def get_ocr_output(self, input_file, session):
+        raise NotImplementedError
+
+class OCR_Engine(OCRBackend):
+    """
+    Azure Read (Computer Vision v3.2) backend
+    """
+    name = "azure"
+
+    def __init__(self, slot=None):
         self._vision_subscription_key = config.cognitive_services_subscription_key
         self._vision_base_url = config.cognitive_services_base_url
         self._vision_endpoint = config.cognitive_services_endpoint
+        # call slot of the shared Azure Read limiter, taken per analysis job
+        self._slot = slot or (lambda: nullcontext(CallSize()))
 
-    
-    @cache
     async def get_ocr_output(self, input_file, session):
+        '''
+        Page texts ("Page_N" -> text) of the file. PDFs of at least 'ocr_shard_min_pages' pages
+        are split into ranges of 'ocr_shard_pages' pages, analysed as concurrent jobs (each
+        retried on its own) and merged back in page order
+        '''
+        shards = None
+        if config.ocr_shard_pages > 0 and bytes(input_file[:5]) == b"%PDF-":
+            shards = await asyncio.to_thread(split_pdf, input_file, config.ocr_shard_pages,
+                                             config.ocr_shard_min_pages)
+        if shards:
+            read_results = await self._analyze_shards(shards, session)
+        else:
+            # not a PDF, too short to split, or unreadable: one job for the whole file
+            async with self._slot() as call:
+                read_results = await self._analyze(input_file, session)
+                call.units = len(read_results)
+
+        count = 0
+        op_dict = {}
+        for i in read_results:
+            info = " ".join([line["text"] for line in i["lines"]])      # Page wise text corpus
+            count += 1
+            op_dict[f"Page_{count}"] = info
+
+        return op_dict
+
+    async def _analyze_shards(self, shards, session):
+        '''
+        readResults of every shard in page order, at most 'ocr_shard_concurrency' jobs of the
+        document in flight (and the shared limiter across documents)
+        '''
+        semaphore = asyncio.Semaphore(config.ocr_shard_concurrency)
+        metrics.inc("ocr_shards", len(shards))
+
+        async def analyze_shard(index, shard):
+            async with semaphore:
+                return await self._analyze_with_retries(index, shard, session)
+
+        tasks = [asyncio.ensure_future(analyze_shard(index, shard)) for index, shard in enumerate(shards)]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # a range that ran out of retries fails the document, stop the others
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return [page for shard_pages in results for page in shard_pages]
+
+    async def _analyze_with_retries(self, index, shard, session):
+        attempt = 0
+        while True:
+            try:
+                async with self._slot() as call:
+                    read_results = await self._analyze(shard, session)
+                    call.units = len(read_results)
+                    return read_results
+            except Exception as exp:
+                if attempt >= config.ocr_shard_retries or not retryable(exp):
+                    raise
+                info = throttle_info(exp)
+                delay = max(backoff_delay(attempt, config.retry_exp_wait_multiplier, config.retry_wait_max),
+                            (info[1] or 0) if info else 0)
+                metrics.inc("ocr_shard_retries")
+                logger.info(f"OCR of page range {index} failed ({exp}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _analyze(self, input_file, session):
+        '''
+        Submit one Azure Read job and poll it, returns its readResults (one per page)
+        '''
         # with open(tmp_file, "rb") as f:
         #     # subscription_key = os.getenv("key")
         #     # vision_base_url = os.getenv("service_url")
@@ -24,18 +140,31 @@ class OCR_Engine:
             "Ocp-Apim-Subscription-Key": self._vision_subscription_key,
             "Content-Type": "application/octet-stream",
         }
-        response = await session.post(text_recognition_url, headers=headers, data=input_file)
-        response.raise_for_status()
-        logger.info(response.text)
-        
-        operation_url = response.headers["Operation-Location"]
+        with metrics.timer("ocr_submit"):
+            async with session.post(text_recognition_url, headers=headers, data=input_file) as response:
+                response.raise_for_status()
+                logger.info(f"Azure Read job submitted: {response.status}")
+                operation_url = response.headers["Operation-Location"]
+
         analysis = {}
         poll = True
         counter = 0
+        poll_start = time.perf_counter()
         while poll:
-            response_final = await session.get(operation_url, headers=headers)
-            # analysis = response_final.json()
-            analysis = json.loads(await response_final.content.read())
+            # the response goes back to the pool before any wait
+            async with session.get(operation_url, headers=headers) as response_final:
+                throttled = response_final.status == 429
+                if throttled:
+                    retry_after = parse_retry_after(response_final.headers) or 1
+                else:
+                    response_final.raise_for_status()
+                    # analysis = response_final.json()
+                    analysis = json.loads(await response_final.read())
+            if throttled:
+                # throttled while polling, come back when the service asks us to
+                metrics.inc("ocr_poll_throttled")
+                await asyncio.sleep(retry_after)
+                continue
             if "analyzeResult" in analysis:
                 poll = False
             if ("status" in analysis) and (analysis["status"] == "Failed"):
@@ -44,13 +173,8 @@ class OCR_Engine:
                     poll = False
             if poll:
                 await asyncio.sleep(0.5)
+        metrics.observe("ocr_poll", time.perf_counter() - poll_start)
+        if "analyzeResult" not in analysis:
+            raise RuntimeError(f"Azure Read analysis failed: {analysis.get('status')}")
 
-        op = analysis["analyzeResult"]["readResults"]       # Page wise segregation
-        count = 0
-        op_dict = {}
-        for i in op:
-            info = " ".join([line["text"] for line in i["lines"]])      # Page wise text corpus
-            count += 1
-            op_dict[f"Page_{count}"] = info
-
-        return op_dict
+        return analysis["analyzeResult"]["readResults"]       # Page wise segregation
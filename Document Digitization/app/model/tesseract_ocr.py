@@ -0,0 +1,61 @@
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import config
+from utils.config import logger
+from utils.metrics import metrics
+from model.ocr_engine import OCRBackend, split_pdf
+from model.tesseract_worker import ocr_page
+
+_pool = None
+
+def get_pool():
+    '''
+    Process pool of the Tesseract backend, created on first use. Workers are spawned, not
+    forked, as the consumer runs threads (S3, MongoDB) that a fork would copy mid-operation
+    '''
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=config.tesseract_workers,
+                                    mp_context=multiprocessing.get_context("spawn"))
+        logger.info(f"Started {config.tesseract_workers} Tesseract workers")
+    return _pool
+
+def shutdown_pool():
+    '''
+    Stop the Tesseract workers, if any were started, dropping the pages not yet OCR'd
+    '''
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+        logger.info("Stopped the Tesseract workers")
+
+class TesseractOCR(OCRBackend):
+    """
+    Local OCR with Tesseract. PDFs are split into single pages, each page is rasterised and
+    OCR'd as its own task in the process pool, images are one task.
+    """
+    name = "tesseract"
+
+    async def get_ocr_output(self, input_file, session=None):
+        is_pdf = bytes(input_file[:5]) == b"%PDF-"
+        if is_pdf:
+            pages = await asyncio.to_thread(split_pdf, input_file, 1, 1)
+            if not pages:
+                raise ValueError("The PDF could not be read for OCR")
+        else:
+            pages = [bytes(input_file)]
+
+        loop = asyncio.get_running_loop()
+        pool = get_pool()
+        start = time.perf_counter()
+        texts = await asyncio.gather(*[
+            loop.run_in_executor(pool, ocr_page, page, is_pdf, config.tesseract_dpi, config.tesseract_lang)
+            for page in pages
+        ])
+        metrics.observe("ocr_tesseract", time.perf_counter() - start)
+        metrics.inc("ocr_tesseract_pages", len(pages))
+        return {f"Page_{count}": text for count, text in enumerate(texts, 1)}
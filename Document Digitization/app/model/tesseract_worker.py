@@ -0,0 +1,23 @@
+import io
+
+import pytesseract
+import pypdfium2 as pdfium
+from PIL import Image
+
+# Runs in the Tesseract process pool: keep the imports of this module light
+
+def ocr_page(data: bytes, is_pdf: bool, dpi: int, lang: str) -> str:
+    '''
+    Text of one page: a single-page PDF (rasterised at 'dpi') or an image, with its lines joined
+    by spaces like the Azure Read output
+    '''
+    if is_pdf:
+        pdf = pdfium.PdfDocument(data)
+        try:
+            image = pdf[0].render(scale=dpi / 72).to_pil()
+        finally:
+            pdf.close()
+    else:
+        image = Image.open(io.BytesIO(data))
+    text = pytesseract.image_to_string(image, lang=lang)
+    return " ".join(line.strip() for line in text.splitlines() if line.strip())
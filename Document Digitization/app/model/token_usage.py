@@ -0,0 +1,40 @@
+from llama_index.core.callbacks import CBEventType, EventPayload
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+
+from utils.metrics import metrics
+
+def _usage_field(usage, name):
+    return usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+
+class TokenUsageHandler(BaseCallbackHandler):
+    """
+    llama_index callback counting the tokens reported by Azure OpenAI for every LLM call
+    (llm_prompt_tokens / llm_completion_tokens) and the chunks sent for embedding
+    (embedding_chunks) into the metrics registry
+    """
+    def __init__(self):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+
+    def on_event_start(self, event_type, payload=None, event_id="", parent_id="", **kwargs):
+        return event_id
+
+    def on_event_end(self, event_type, payload=None, event_id="", **kwargs):
+        if not payload:
+            return
+        if event_type == CBEventType.LLM:
+            response = payload.get(EventPayload.RESPONSE) or payload.get(EventPayload.COMPLETION)
+            raw = getattr(response, "raw", None)
+            usage = raw.get("usage") if isinstance(raw, dict) else getattr(raw, "usage", None)
+            if usage is None:
+                return
+            metrics.inc("llm_calls")
+            metrics.inc("llm_prompt_tokens", _usage_field(usage, "prompt_tokens") or 0)
+            metrics.inc("llm_completion_tokens", _usage_field(usage, "completion_tokens") or 0)
+        elif event_type == CBEventType.EMBEDDING:
+            metrics.inc("embedding_chunks", len(payload.get(EventPayload.CHUNKS) or ()))
+
+    def start_trace(self, trace_id=None):
+        pass
+
+    def end_trace(self, trace_id=None, trace_map=None):
+        pass
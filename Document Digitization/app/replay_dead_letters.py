@@ -0,0 +1,89 @@
+"""
+List quarantined (dead-lettered) events, and re-inject them into the Event Hub once the
+cause is fixed. A replayed event gets its attempts reset, so the consumer processes it again.
+
+Run from the 'app' directory:
+    python replay_dead_letters.py --list [--fingerprint <fingerprint>]
+    python replay_dead_letters.py --id <event key> [--id <event key> ...]
+    python replay_dead_letters.py --all [--fingerprint <fingerprint>] [--dry-run]
+"""
+import asyncio
+import argparse
+from collections import Counter
+
+from azure.eventhub import EventData
+from azure.eventhub.aio import EventHubProducerClient
+
+from utils import config
+from utils.config import logger
+from utils.mongodb import MongoDB, AsyncMongoDB
+from utils.dead_letter import DeadLetterStore
+
+async def send_events(bodies):
+    '''
+    Send the raw event bodies to the Event Hub in as few batches as possible
+    '''
+    producer = EventHubProducerClient.from_connection_string(
+        conn_str = config.eventhub_conn_str_send,
+        eventhub_name = config.eventhub_name,
+    )
+    async with producer:
+        batch = await producer.create_batch()
+        for body in bodies:
+            try:
+                batch.add(EventData(body))
+            except ValueError:
+                # batch full, send it and start the next one
+                await producer.send_batch(batch)
+                batch = await producer.create_batch()
+                batch.add(EventData(body))
+        if len(batch):
+            await producer.send_batch(batch)
+
+async def run(args):
+    mongo = MongoDB(config.mdb_db, config.mdb_conn_str)
+    store = AsyncMongoDB(mongo)
+    dead_letters = DeadLetterStore(store, config.mdb_collection_dead_letter,
+                                   max_attempts=config.dead_letter_max_attempts)
+    try:
+        records = await dead_letters.quarantined(fingerprint=args.fingerprint)
+        if args.id:
+            records = [record for record in records if record["_id"] in set(args.id)]
+
+        if args.list:
+            fingerprints = Counter(record["last_error"]["fingerprint"] for record in records)
+            for record in records:
+                error = record["last_error"]
+                print(f"{record['_id']}  attempts={record['attempts']}  {error['fingerprint']}  "
+                      f"{error['stage']}: {error['error'][:120]}")
+            print(f"\n{len(records)} quarantined event(s), by fingerprint: {dict(fingerprints)}")
+            return
+
+        if args.dry_run:
+            print(f"Would replay {len(records)} event(s)")
+            return
+
+        # reset first so the consumer does not skip the events it is about to receive
+        replayed = [record for record in records if await dead_letters.mark_replayed(record["_id"])]
+        await send_events([record["body"] for record in replayed])
+        logger.info(f"Replayed {len(replayed)} dead-lettered event(s)")
+        print(f"Replayed {len(replayed)} event(s)")
+    finally:
+        await store.close()
+        mongo.close_connection()
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument("--list", action="store_true", help="list the quarantined events")
+    action.add_argument("--id", action="append", help="replay this event key (repeatable)")
+    action.add_argument("--all", action="store_true", help="replay every quarantined event")
+    parser.add_argument("--fingerprint", help="only events whose last failure has this fingerprint")
+    parser.add_argument("--dry-run", action="store_true", help="count the events to replay, send nothing")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    asyncio.run(run(parse_args(argv)))
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,54 @@
+import signal
 import asyncio
-import consumer
 
-# from utils.config import logger
+from utils import config
+from utils.config import logger
+from utils.supervisor import Supervisor, report_metrics, worker_count
 
 
-loop = asyncio.get_event_loop()
-print(loop)
+def run_worker(worker_id, reports, report_interval):
+    '''
+    Worker process of the supervisor: one event loop running consumer.main()
+    '''
+    # the supervisor handles Ctrl+C and stops the workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import consumer
 
-loop.run_until_complete(consumer.main())
+    async def main():
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        reporter = asyncio.create_task(
+            report_metrics(reports, worker_id, report_interval, consumer.health.readiness)
+        )
+        try:
+            # the supervisor serves the metrics endpoint for every worker
+            await consumer.main(serve_http=False)
+        finally:
+            reporter.cancel()
+
+    try:
+        asyncio.run(main())
+    except asyncio.CancelledError:
+        logger.info(f"Consumer worker {worker_id} stopped")
+
+
+if __name__ == "__main__":
+    workers = worker_count(config.consumer_workers)
+    if workers > 1:
+        supervisor = Supervisor(
+            run_worker,
+            workers,
+            report_interval=config.supervisor_report_interval,
+            heartbeat_timeout=config.supervisor_heartbeat_timeout,
+            restart_backoff_max=config.supervisor_restart_backoff_max,
+            shutdown_timeout=config.supervisor_shutdown_timeout,
+        )
+        if config.metrics_port:
+            supervisor.serve_http(config.metrics_host, config.metrics_port)
+        supervisor.run()
+    else:
+        import consumer
+
+        loop = asyncio.get_event_loop()
+        print(loop)
+
+        loop.run_until_complete(consumer.main())
@@ -0,0 +1,84 @@
+import asyncio
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from utils.adaptive import AdaptiveLimiter, parse_retry_after, throttle_info, retryable
+
+class HttpError(Exception):
+    def __init__(self, status, headers=None):
+        super().__init__(f"HTTP {status}")
+        self.status = status
+        self.headers = headers or {}
+
+def test_parse_retry_after():
+    assert parse_retry_after({"retry-after-ms": "1500", "Retry-After": "9"}) == 1.5
+    assert parse_retry_after({"Retry-After": "3"}) == 3.0
+    later = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert 25 < parse_retry_after({"Retry-After": later}) <= 30
+    assert parse_retry_after({"Retry-After": "soon"}) is None
+    assert parse_retry_after(None) is None
+
+def test_throttling_and_retryable_errors():
+    assert throttle_info(HttpError(429, {"Retry-After": "2"})) == (429, 2.0)
+    assert throttle_info(HttpError(400)) is None
+    assert retryable(HttpError(503)) and retryable(ConnectionError())
+    assert not retryable(HttpError(404))
+
+def _limiter(**kwargs):
+    return AdaptiveLimiter("test", **{"initial_limit": 4, "min_limit": 1, "max_limit": 8, "cooldown": 60, **kwargs})
+
+def test_limit_grows_on_success_and_halves_once_per_cooldown():
+    limiter = _limiter()
+    for _ in range(4):
+        limiter.on_success(0.1)
+    assert limiter.limit == pytest.approx(5, abs=0.2)
+    limiter.on_throttle()
+    limiter.on_throttle()
+    # the second 429 of the same window does not cut again
+    assert limiter.stats()["limit"] == 2 and limiter.decreases == 1
+
+def test_retry_after_holds_back_new_calls():
+    limiter = _limiter()
+    limiter.on_throttle(60)
+    assert limiter.paused and limiter.stats()["paused_for"] > 59
+
+def test_latency_is_compared_per_unit_of_work():
+    limiter = _limiter(latency_tolerance=2.0)
+    for _ in range(20):
+        limiter.on_success(0.1)
+    # a 40-page call at the same latency per page leaves the limit alone
+    async def run():
+        async with limiter.slot() as call:
+            call.units = 40
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert limiter.decreases == 0
+    for _ in range(5):
+        limiter.on_success(1.0)
+    assert limiter.decreases == 1
+
+def test_calls_wait_for_a_free_slot():
+    async def run():
+        limiter = _limiter(initial_limit=1, max_limit=1)
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        limiter.release()
+        await asyncio.wait_for(waiting, 1)
+        assert limiter.in_flight == 1
+
+    asyncio.run(run())
+
+def test_throttled_call_is_fed_back():
+    async def run():
+        limiter = _limiter()
+        with pytest.raises(HttpError):
+            async with limiter.slot():
+                raise HttpError(429, {"Retry-After": "1"})
+        assert limiter.throttled == 1 and limiter.in_flight == 0 and limiter.paused
+
+    asyncio.run(run())
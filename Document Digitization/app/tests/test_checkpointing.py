@@ -0,0 +1,80 @@
+import asyncio
+from types import SimpleNamespace
+
+from utils.checkpointing import CheckpointCoalescer, OrderedCheckpointTracker
+from utils.metrics import Metrics, metrics
+
+class FakePartition:
+    """
+    Partition context recording its checkpoint writes
+    """
+    def __init__(self, partition_id="0", last_sequence_number=None):
+        self.partition_id = partition_id
+        self.last_enqueued_event_properties = {"sequence_number": last_sequence_number}
+        self.checkpoints = []
+
+    async def update_checkpoint(self, event):
+        self.checkpoints.append(event.sequence_number)
+
+def _events(*sequence_numbers):
+    return [SimpleNamespace(sequence_number=number) for number in sequence_numbers]
+
+def test_tracker_only_advances_over_completed_events():
+    async def run():
+        partition = FakePartition()
+        coalescer = CheckpointCoalescer(max_events=1, interval=0)
+        tracker = OrderedCheckpointTracker(partition, _events(10, 11, 12, 13), coalescer)
+        await tracker.complete(2)
+        await tracker.complete(1)
+        # event 10 is still in flight
+        assert partition.checkpoints == []
+        await tracker.complete(0)
+        assert partition.checkpoints == [12]
+        await tracker.complete(3)
+        assert partition.checkpoints == [12, 13]
+
+    asyncio.run(run())
+
+def test_coalescer_batches_writes_and_never_goes_back():
+    async def run():
+        partition = FakePartition()
+        coalescer = CheckpointCoalescer(max_events=3, interval=0)
+        first, second, third = _events(5, 4, 6)
+        await coalescer.advance(partition, first)
+        await coalescer.advance(partition, second)
+        assert partition.checkpoints == []
+        await coalescer.advance(partition, third)
+        assert partition.checkpoints == [6]
+        # an older event completing after the write does not move the checkpoint back
+        await coalescer.advance(partition, second)
+        await coalescer.flush_all()
+        assert partition.checkpoints == [6]
+
+    asyncio.run(run())
+
+def test_close_drops_the_lag_of_the_partition():
+    async def run():
+        partition = FakePartition("7", last_sequence_number=20)
+        coalescer = CheckpointCoalescer(max_events=10, interval=0)
+        await coalescer.advance(partition, _events(15)[0])
+        await coalescer.flush("7")
+        assert metrics.gauges[("checkpoint_lag", (("partition", "7"),))] == 5
+        await coalescer.advance(partition, _events(18)[0])
+        await coalescer.close("7")
+        assert partition.checkpoints == [15, 18]
+        assert ("checkpoint_lag", (("partition", "7"),)) not in metrics.gauges
+
+    asyncio.run(run())
+
+def test_merge_keeps_the_highest_shared_gauge():
+    workers = []
+    for lag, in_flight in ((5, 2), (3, 1)):
+        worker = Metrics()
+        worker.set_gauge("checkpoint_lag", lag, partition="0")
+        worker.add_gauge("events_in_flight", in_flight)
+        workers.append(worker.snapshot())
+    merged = Metrics()
+    for snapshot in workers:
+        merged.merge(snapshot)
+    assert merged.gauges[("checkpoint_lag", (("partition", "0"),))] == 5
+    assert merged.gauges[("events_in_flight", ())] == 3
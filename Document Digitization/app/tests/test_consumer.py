@@ -0,0 +1,29 @@
+import json
+import asyncio
+
+import pytest
+
+from utils.dead_letter import UnsupportedDocument
+from utils.pipeline import Job
+
+# the consumer pulls the whole stack (llama_index, Event Hub), skipped where it is not installed
+consumer = pytest.importorskip("consumer")
+
+def test_stage_error_retry_policy(monkeypatch):
+    statuses = []
+
+    async def record_status(job, status):
+        statuses.append(status["doc_status"])
+
+    monkeypatch.setattr(consumer, "record_status", record_status)
+
+    async def run():
+        job = Job({})
+        # an HTML error page or a body cut short is retried
+        exp = json.JSONDecodeError("Expecting value", "<html>", 0)
+        stage, delay = await consumer.handle_stage_error(job, "ocr", exp)
+        assert stage == "ocr" and delay >= 0
+        assert await consumer.handle_stage_error(job, "fetch", UnsupportedDocument("a.txt")) is None
+
+    asyncio.run(run())
+    assert statuses == ["error"]
@@ -0,0 +1,49 @@
+import json
+import asyncio
+
+import pytest
+
+from utils.dead_letter import DeadLetterStore, UnsupportedDocument, parse_event_body
+
+EVENT = {"_id": "65f1c0ffee0000000000abcd", "doc_id": "doc", "uid": "tenant",
+         "file_name": "https://bucket.s3.amazonaws.com/invoices/a.pdf", "filename": "a.pdf"}
+
+class FakeStore:
+    """
+    In-memory stand-in of AsyncMongoDB for the updates of the dead-letter store
+    """
+    def __init__(self):
+        self.records = {}
+
+    async def find_one_and_update(self, collection_name, query, new_values, upsert=False, operators=None):
+        record = self.records.get(query["_id"])
+        if record is None:
+            if not upsert:
+                return None
+            record = self.records[query["_id"]] = {"_id": query["_id"], **(operators or {}).get("$setOnInsert", {})}
+        record.update(new_values)
+        for key, value in (operators or {}).get("$inc", {}).items():
+            record[key] = record.get(key, 0) + value
+        return dict(record)
+
+def test_parse_event_body():
+    assert parse_event_body(json.dumps(EVENT)) == EVENT
+    for body in ("<html>", "[]", json.dumps({**EVENT, "_id": "42"}), json.dumps({"doc_id": "doc"})):
+        with pytest.raises(UnsupportedDocument):
+            parse_event_body(body)
+
+def test_quarantine_on_permanent_error_or_out_of_attempts():
+    async def run():
+        store = DeadLetterStore(FakeStore(), "dead_letters", max_attempts=2)
+        assert await store.begin("transient", "{}", "0", 1)
+        # a truncated response is retried
+        assert not await store.fail("transient", "ocr", json.JSONDecodeError("Expecting value", "{\"a\"", 4))
+        assert await store.begin("transient", "{}", "0", 2)
+        assert await store.fail("transient", "ocr", json.JSONDecodeError("Expecting value", "{\"a\"", 4))
+        assert not await store.begin("transient", "{}", "0", 3)
+
+        assert await store.begin("unsupported", "{}", "0", 4)
+        assert await store.fail("unsupported", "fetch", UnsupportedDocument("a.txt"), permanent=True)
+        assert not await store.begin("unsupported", "{}", "0", 5)
+
+    asyncio.run(run())
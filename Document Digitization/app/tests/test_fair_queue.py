@@ -0,0 +1,62 @@
+import asyncio
+
+from utils.fair_queue import FairScheduler
+
+async def _admission_order(scheduler, tenants, pool="fast"):
+    '''
+    Tenants in the order their events get the slots, all of them queued behind a held slot
+    '''
+    order = []
+
+    async def event(tenant):
+        async with scheduler.slot(tenant, pool):
+            order.append(tenant)
+            await asyncio.sleep(0)
+
+    await scheduler.acquire("holder", pool)
+    tasks = [asyncio.ensure_future(event(tenant)) for tenant in tenants]
+    await asyncio.sleep(0)
+    scheduler.release("holder", pool)
+    await asyncio.gather(*tasks)
+    return order
+
+def test_tenants_take_turns():
+    scheduler = FairScheduler({"fast": 1})
+    order = asyncio.run(_admission_order(scheduler, ["a"] * 3 + ["b"] * 3))
+    assert order == ["a", "b", "a", "b", "a", "b"]
+    assert scheduler.stats() == {"in_flight": {"fast": 0}, "waiting": {"fast": 0}, "tenants_active": 0}
+
+def test_weights_share_the_slots():
+    scheduler = FairScheduler({"fast": 1}, weights={"a": 2})
+    order = asyncio.run(_admission_order(scheduler, ["a"] * 6 + ["b"] * 6))
+    # twice the admissions of 'b' while both have events queued
+    assert order[:6].count("a") == 4
+
+def test_tenant_cap_leaves_the_slot_to_others():
+    async def run():
+        scheduler = FairScheduler({"fast": 2}, tenant_cap=1)
+        await scheduler.acquire("a", "fast")
+        second = asyncio.ensure_future(scheduler.acquire("a", "fast"))
+        await asyncio.sleep(0)
+        assert not second.done()
+        # the free slot goes to another tenant
+        await asyncio.wait_for(scheduler.acquire("b", "fast"), 1)
+        scheduler.release("a", "fast")
+        await asyncio.wait_for(second, 1)
+        assert scheduler.stats()["in_flight"] == {"fast": 2}
+
+    asyncio.run(run())
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        scheduler = FairScheduler({"fast": 1, "slow": 1})
+        await scheduler.acquire("a", "fast")
+        waiting = asyncio.ensure_future(scheduler.acquire("b", "fast"))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert scheduler.stats()["waiting"] == {"fast": 0, "slow": 0}
+        scheduler.release("a", "fast")
+        assert scheduler.stats()["in_flight"] == {"fast": 0, "slow": 0}
+
+    asyncio.run(run())
@@ -0,0 +1,30 @@
+from model.json_repair import LABEL, TOTAL, LINE_ITEMS, repair_json, normalise_keys, validate_invoice
+
+def test_repair_strips_fences_prose_and_trailing_commas():
+    answer = 'Here is the JSON:\n```json\n{"Document Label": "Food", "Invoice Total": "12.50",}\n```'
+    assert repair_json(answer) == {LABEL: "Food", TOTAL: "12.50"}
+    assert repair_json("{'Document Label': 'Hotel', 'Invoice Total': None}") == {LABEL: "Hotel", TOTAL: None}
+
+def test_repair_keeps_the_complete_values_of_a_truncated_answer():
+    answer = ('{"Document Label": "Hotel", "Invoice line-items": ['
+              '{"Item Name": "Room", "Amount": "100"}, {"Item Name": "Break')
+    assert repair_json(answer) == {LABEL: "Hotel", LINE_ITEMS: [{"Item Name": "Room", "Amount": "100"}]}
+
+def test_repair_gives_up_without_an_object():
+    assert repair_json("Sorry, I cannot read this document.") is None
+    assert repair_json(None) is None
+
+def test_normalise_keys():
+    assert normalise_keys({"document_type": "Food", " total ": 3}) == {LABEL: "Food", TOTAL: 3}
+
+def test_validate_invoice_drops_invalid_items():
+    output = {
+        "document label": "Food",
+        "line items": [{"item name": "Soup", "amount": "4.00"}, {"Item Name": "", "Amount": "1"}, "tip"],
+        "Invoice Total": {"value": 4},
+    }
+    valid, invalid = validate_invoice(output)
+    assert valid == {LABEL: "Food", LINE_ITEMS: [
+        {"Item Name": "Soup", "Amount": "4.00", "Quantity": "", "Category": ""}]}
+    assert invalid == [TOTAL]
+    assert validate_invoice("not json") == ({}, [LABEL, LINE_ITEMS, TOTAL])
@@ -0,0 +1,21 @@
+import pytest
+
+from utils.lanes import FAST, SLOW, split_budget, choose_lane, linearized_page_count
+
+def test_split_budget_never_exceeds_the_total():
+    for total in range(2, 40):
+        budget = split_budget(total, 0.25)
+        assert budget[FAST] >= 1 and budget[SLOW] >= 1
+        assert budget[FAST] + budget[SLOW] == total
+    assert split_budget(16, 0.25) == {FAST: 12, SLOW: 4}
+    assert split_budget(2, 0.9) == {FAST: 1, SLOW: 1}
+
+def test_split_budget_rejects_a_single_slot():
+    for total in (0, 1):
+        with pytest.raises(ValueError):
+            split_budget(total, 0.25)
+
+def test_choose_lane():
+    assert linearized_page_count(b"%PDF-1.7\n1 0 obj\n<< /Linearized 1 /L 1234 /N 12 /T 99 >>") == 12
+    assert choose_lane(10 * 1024 * 1024, pages=1) == FAST
+    assert choose_lane(1024, pages=50) == SLOW
@@ -0,0 +1,75 @@
+import asyncio
+
+from utils.lease import DocumentLease
+
+class FakeStore:
+    """
+    In-memory stand-in of AsyncMongoDB for the few queries the lease makes
+    """
+    def __init__(self):
+        self.records = []
+
+    @staticmethod
+    def _matches(record, query):
+        for key, expected in query.items():
+            if key == "$or":
+                if not any(FakeStore._matches(record, option) for option in expected):
+                    return False
+            elif isinstance(expected, dict) and "$lt" in expected:
+                value = record.get(key)
+                if value is None or not value < expected["$lt"]:
+                    return False
+            elif record.get(key) != expected:
+                return False
+        return True
+
+    async def find_one_and_update(self, collection_name, query, new_values, upsert=False, operators=None):
+        for record in self.records:
+            if self._matches(record, query):
+                record.update(new_values)
+                return dict(record)
+        return None
+
+    async def get_document(self, collection_name, query={}, projection=None):
+        return next((dict(record) for record in self.records if self._matches(record, query)), None)
+
+    async def insert_row(self, collection_name, data):
+        if any(record["_id"] == data["_id"] for record in self.records):
+            return False
+        self.records.append(dict(data))
+        return True
+
+def _lease(store):
+    return DocumentLease(store, "documents", {"_id": 1, "doc_id": "doc"}, ttl=60, wait_timeout=5,
+                         poll_interval=0.01)
+
+def test_same_process_duplicates_are_single_flight():
+    async def run():
+        store = FakeStore()
+        first, second = _lease(store), _lease(store)
+        assert await first.acquire() == DocumentLease.ACQUIRED
+
+        waiting = asyncio.ensure_future(second.acquire())
+        await asyncio.sleep(0.05)
+        # the duplicate waits while the first event holds the lease
+        assert not waiting.done()
+
+        await first.release(handled=True)
+        assert await waiting == DocumentLease.SUPPRESSED
+
+    asyncio.run(run())
+
+def test_unhandled_release_hands_the_lease_over():
+    async def run():
+        store = FakeStore()
+        first, second = _lease(store), _lease(store)
+        assert await first.acquire() == DocumentLease.ACQUIRED
+        waiting = asyncio.ensure_future(second.acquire())
+        await asyncio.sleep(0.05)
+
+        await first.release(handled=False)
+        assert await waiting == DocumentLease.ACQUIRED
+        assert store.records[0]["lease_owner"] == second.owner
+        await second.release(handled=True)
+
+    asyncio.run(run())
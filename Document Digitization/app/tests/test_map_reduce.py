@@ -0,0 +1,50 @@
+import pytest
+
+from model.json_repair import LABEL, TOTAL, LINE_ITEMS
+from model.map_reduce import parse_amount, merge_outputs
+
+@pytest.mark.parametrize("value, expected", [
+    ("$1,234.56", 1234.56),
+    ("1.234,56 EUR", 1234.56),
+    ("12,5", 12.5),
+    ("USD 1.000", 1000.0),
+    ("INR 2,500", 2500.0),
+    ("Rs. 1,00,000.00", 100000.0),
+    ("1,00,000", 100000.0),
+    ("1.234.567", 1234567.0),
+    ("0,125", 0.125),
+    ("-$5.00", -5.0),
+    (12, 12.0),
+    ("n/a", None),
+    (None, None),
+])
+def test_parse_amount(value, expected):
+    assert parse_amount(value) == expected
+
+def _item(name, amount):
+    return {"Item Name": name, "Amount": amount, "Quantity": "1"}
+
+def test_merge_drops_items_repeated_on_a_summary_page():
+    room, tax = _item("Room charge", "100.00"), _item("City tax", "5.00")
+    outputs = [
+        {LABEL: "Hotel", LINE_ITEMS: [room, tax], TOTAL: ""},
+        None,
+        # the summary page lists the charges again with the grand total
+        {LABEL: "Hotel", LINE_ITEMS: [room, tax], TOTAL: "105.00"},
+    ]
+    assert merge_outputs(outputs) == {LABEL: "Hotel", LINE_ITEMS: [room, tax], TOTAL: "105.00"}
+
+def test_merge_keeps_repeated_items_that_match_the_total():
+    night = _item("Room charge", "100.00")
+    outputs = [
+        {LABEL: "Hotel", LINE_ITEMS: [night], TOTAL: "100.00"},
+        {LABEL: "Food", LINE_ITEMS: [night], TOTAL: "200.00"},
+        {LABEL: "Hotel", LINE_ITEMS: [], TOTAL: ""},
+    ]
+    merged = merge_outputs(outputs)
+    assert merged[LINE_ITEMS] == [night, night]
+    assert merged[TOTAL] == "200.00"
+    assert merged[LABEL] == "Hotel"
+
+def test_merge_of_nothing():
+    assert merge_outputs([None, {}]) is None
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+
+from utils.ocr_cache import OcrResultCache
+
+def _counting(pages, keep=True, delay=0.01):
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        return pages, keep
+
+    return compute, calls
+
+def test_concurrent_requests_share_one_call():
+    async def run():
+        cache = OcrResultCache(max_bytes=1024, ttl=60)
+        compute, calls = _counting({"1": "text"})
+        first, second = await asyncio.gather(cache.get_or_compute("a:azure", compute),
+                                             cache.get_or_compute("a:azure", compute))
+        assert first == second == {"1": "text"}
+        assert await cache.get_or_compute("a:azure", compute) == {"1": "text"}
+        assert len(calls) == 1
+        assert cache.stats()["hits"] == 1 and cache.stats()["shared"] == 1
+
+    asyncio.run(run())
+
+def test_results_not_kept_and_failures_are_not_cached():
+    async def run():
+        cache = OcrResultCache(max_bytes=1024, ttl=60)
+        # e.g. the output of the fallback backend
+        compute, calls = _counting({"1": "fallback"}, keep=False)
+        assert await cache.get_or_compute("a:azure", compute) == {"1": "fallback"}
+        await cache.get_or_compute("a:azure", compute)
+        assert len(calls) == 2
+
+        async def failing():
+            raise RuntimeError("throttled")
+
+        with pytest.raises(RuntimeError):
+            await cache.get_or_compute("b:azure", failing)
+        assert cache.get("b:azure") is None and cache.stats()["in_flight"] == 0
+
+    asyncio.run(run())
+
+def test_call_completes_when_its_event_is_cancelled():
+    async def run():
+        cache = OcrResultCache(max_bytes=1024, ttl=60)
+        compute, calls = _counting({"1": "text"}, delay=0.05)
+        request = asyncio.ensure_future(cache.get_or_compute("a:azure", compute))
+        await asyncio.sleep(0.01)
+        request.cancel()
+        await asyncio.sleep(0.1)
+        assert cache.get("a:azure") == {"1": "text"}
+
+    asyncio.run(run())
+
+def test_least_recently_used_and_expired_entries_go():
+    cache = OcrResultCache(max_bytes=20, ttl=60)
+    cache.put("a", {"1": "aaaaaaaa"})
+    cache.put("b", {"1": "bbbbbbbb"})
+    cache.get("a")
+    cache.put("c", {"1": "cccccccc"})
+    assert cache.get("b") is None and cache.get("a") and cache.get("c")
+    assert cache.size <= 20
+    # larger than the whole cache, never stored
+    cache.put("d", {"1": "d" * 30})
+    assert cache.get("d") is None
+
+    expired = OcrResultCache(max_bytes=1024, ttl=0)
+    expired.put("a", {"1": "text"})
+    assert expired.get("a") is None and expired.size == 0
@@ -0,0 +1,119 @@
+import asyncio
+from types import SimpleNamespace
+
+from utils.outbox import AppianOutbox
+
+class FakeStore:
+    """
+    In-memory stand-in of AsyncMongoDB for the queries of the outbox
+    """
+    def __init__(self):
+        self.records = {}
+
+    @staticmethod
+    def _matches(record, query):
+        for key, expected in query.items():
+            if key == "$or":
+                if not any(FakeStore._matches(record, option) for option in expected):
+                    return False
+            elif isinstance(expected, dict):
+                value = record.get(key)
+                if value is None:
+                    return False
+                if "$lt" in expected and not value < expected["$lt"]:
+                    return False
+                if "$lte" in expected and not value <= expected["$lte"]:
+                    return False
+            elif record.get(key) != expected:
+                return False
+        return True
+
+    async def get_document(self, collection_name, query={}, projection=None):
+        record = self.records.get(query["_id"])
+        return dict(record) if record else None
+
+    async def update_document(self, collection_name, query, new_values):
+        self.records.setdefault(query["_id"], {"_id": query["_id"]}).update(new_values)
+        return SimpleNamespace(acknowledged=True)
+
+    async def find_one_and_update(self, collection_name, query, new_values, upsert=False, operators=None):
+        for record in self.records.values():
+            if self._matches(record, query):
+                record.update(new_values)
+                return dict(record)
+        return None
+
+class FakeAppian:
+    """
+    aiohttp session stand-in answering every post with the next status of 'statuses'
+    """
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.payloads = []
+
+    async def post(self, url, headers=None, json=None):
+        self.payloads.append(json)
+        status = self.statuses.pop(0) if self.statuses else 200
+        async def text():
+            return "ok" if status < 400 else "error"
+        return SimpleNamespace(status=status, text=text)
+
+def _outbox(store, appian, max_attempts=3):
+    return AppianOutbox(store, appian, "appian_outbox", "http://appian.invalid", "key", max_attempts=max_attempts,
+                        concurrency=2, poll_interval=0.01, claim_timeout=60, retry_multiplier=0,
+                        retry_wait_max=0)
+
+async def _drain(outbox, store, doc_id, status):
+    for _ in range(200):
+        if store.records.get(doc_id, {}).get("status") == status:
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"{doc_id} never reached {status}: {store.records.get(doc_id)}")
+
+def test_same_result_is_delivered_once_and_a_changed_one_again():
+    async def run():
+        store, appian = FakeStore(), FakeAppian()
+        outbox = _outbox(store, appian).start()
+        assert await outbox.enqueue("doc", {"doc_status": "completed", "total": 1})
+        await _drain(outbox, store, "doc", "delivered")
+        # a redelivered event with the same result
+        assert await outbox.enqueue("doc", {"total": 1, "doc_status": "completed"})
+        await asyncio.sleep(0.05)
+        # re-extracted after a replay
+        assert await outbox.enqueue("doc", {"doc_status": "completed", "total": 2})
+        await _drain(outbox, store, "doc", "delivered")
+        await outbox.stop()
+        assert [payload["total"] for payload in appian.payloads] == [1, 2]
+
+    asyncio.run(run())
+
+def test_failed_deliveries_are_retried_then_given_up():
+    async def run():
+        store, appian = FakeStore(), FakeAppian(500, 503, 500)
+        outbox = _outbox(store, appian, max_attempts=2).start()
+        await outbox.enqueue("retried", {"total": 1})
+        await _drain(outbox, store, "retried", "failed")
+        await outbox.enqueue("delivered", {"total": 2})
+        await _drain(outbox, store, "delivered", "delivered")
+        await outbox.stop()
+        assert store.records["retried"]["attempts"] == 2
+        assert store.records["retried"]["last_error"].startswith("HTTP 503")
+        assert store.records["delivered"]["attempts"] == 2
+
+    asyncio.run(run())
+
+def test_result_replaced_while_on_the_wire_is_sent_after_it():
+    async def run():
+        store, appian = FakeStore(), FakeAppian()
+        outbox = _outbox(store, appian)
+        await outbox.enqueue("doc", {"total": 1})
+        sending = await outbox._claim()
+        await outbox.enqueue("doc", {"total": 2})
+        # not due before the send on the wire ends
+        assert await outbox._claim() is None
+        await outbox._finish(sending, {"status": "delivered", "attempts": 1})
+        record = store.records["doc"]
+        assert record["status"] == "pending" and record["payload"] == {"total": 2}
+        assert (await outbox._claim())["payload"] == {"total": 2}
+
+    asyncio.run(run())
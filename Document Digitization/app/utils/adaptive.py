@@ -0,0 +1,194 @@
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from utils.config import logger
+from utils.metrics import metrics
+
+# Responses meaning the service wants less traffic
+THROTTLE_STATUSES = (429, 503)
+
+def parse_retry_after(headers):
+    '''
+    Seconds to wait from the Retry-After (or Azure OpenAI retry-after-ms) header, None if absent
+    '''
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+def throttle_info(exp):
+    '''
+    (status, retry_after) of a throttled call from an aiohttp or openai exception,
+    None when 'exp' is not a throttling response
+    '''
+    status = getattr(exp, "status", None) or getattr(exp, "status_code", None)
+    if status not in THROTTLE_STATUSES:
+        return None
+    headers = getattr(exp, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(exp, "response", None), "headers", None)
+    return status, parse_retry_after(headers)
+
+def retryable(exp):
+    '''
+    Whether a failed call is worth retrying: throttled, a server error, or no HTTP status at
+    all (connection error, timeout)
+    '''
+    status = getattr(exp, "status", None) or getattr(exp, "status_code", None)
+    return status is None or status == 429 or status >= 500
+
+class CallSize:
+    """
+    Amount of work done in one call slot (pages OCR'd, chunks embedded or sent to the LLM),
+    set by the caller when known. The limiter compares latencies per unit of work, so a large
+    document is not mistaken for a slow service.
+    """
+    def __init__(self, units: float = 1):
+        self.units = units
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on the calls in flight to one downstream service (Azure Read, Azure OpenAI).
+
+    Every successful call grows the limit additively (by about one per 'limit' successes, up to
+    'max_limit'). A 429/503 cuts it by 'backoff_factor' (at most once per 'cooldown' seconds, so
+    a burst of 429s from the same window counts once), and a Retry-After on a throttled response
+    holds back every new call until it has elapsed. Latency is a secondary signal: the average
+    latency per unit of work (see CallSize) rising above 'latency_tolerance' times its long-run
+    baseline cuts the limit too, 0 disables it. The limit is published as the 'adaptive_limit'
+    gauge.
+    """
+    def __init__(self, name: str, initial_limit: int, min_limit: int, max_limit: int,
+                 backoff_factor: float = 0.5, latency_tolerance: float = 2.0, cooldown: float = 5.0):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.backoff_factor = backoff_factor
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.successes = 0
+        self.throttled = 0
+        self.decreases = 0
+        self._latency = None
+        self._baseline = None
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._changed = asyncio.Event()
+        self._publish()
+
+    def _publish(self):
+        metrics.set_gauge("adaptive_limit", self.limit, service=self.name)
+        metrics.set_gauge("adaptive_in_flight", self.in_flight, service=self.name)
+
+    def _notify(self):
+        # wake every waiter to re-check the limit, then arm a fresh event for the next change
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def acquire(self):
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            if self.in_flight < int(self.limit):
+                break
+            await self._changed.wait()
+        self.in_flight += 1
+        self._publish()
+
+    def release(self):
+        self.in_flight -= 1
+        self._publish()
+        self._notify()
+
+    @property
+    def paused(self):
+        '''
+        Whether new calls are held back by a Retry-After
+        '''
+        return self._paused_until > time.monotonic()
+
+    def on_success(self, latency: float):
+        '''
+        Feed back a successful call, 'latency' in seconds per unit of work
+        '''
+        self.successes += 1
+        self._latency = latency if self._latency is None else 0.7 * self._latency + 0.3 * latency
+        self._baseline = latency if self._baseline is None else 0.95 * self._baseline + 0.05 * latency
+        if (self.latency_tolerance > 0 and self.successes > 10
+                and self._latency > self.latency_tolerance * self._baseline):
+            self._decrease("latency")
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._publish()
+
+    def on_throttle(self, retry_after: float = None):
+        self.throttled += 1
+        metrics.inc("adaptive_throttled", service=self.name)
+        if retry_after:
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        self._decrease("throttled")
+
+    def _decrease(self, reason: str):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.decreases += 1
+        self.limit = max(self.min_limit, self.limit * self.backoff_factor)
+        metrics.inc("adaptive_limit_decreases", service=self.name, reason=reason)
+        logger.info(f"{self.name} concurrency limit lowered to {int(self.limit)} ({reason})")
+        self._publish()
+
+    @asynccontextmanager
+    async def slot(self):
+        '''
+        Hold one call slot for the enclosed block and feed its outcome back into the limit. The
+        block gets a CallSize to set the units of work of the call on
+        '''
+        await self.acquire()
+        start = time.perf_counter()
+        size = CallSize()
+        try:
+            yield size
+        except Exception as exp:
+            info = throttle_info(exp)
+            if info is not None:
+                self.on_throttle(info[1])
+            raise
+        else:
+            self.on_success((time.perf_counter() - start) / max(1.0, size.units))
+        finally:
+            self.release()
+
+    def stats(self):
+        return {
+            "limit": int(self.limit),
+            "in_flight": self.in_flight,
+            "successes": self.successes,
+            "throttled": self.throttled,
+            "decreases": self.decreases,
+            "paused_for": round(max(0.0, self._paused_until - time.monotonic()), 3),
+        }
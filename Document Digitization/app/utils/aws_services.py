@@ -1,26 +1,124 @@
+import os
+import mmap
+import asyncio
+import tempfile
+from functools import partial
 from botocore.exceptions import ClientError
 
+from utils import config
 from utils.config import logger
 
-async def get_file_object_s3(s3_client, bucket: str, object_name: str):
+class S3ObjectTooLarge(Exception):
+    pass
+
+async def _run(executor, func, *args, **kwargs):
+    '''
+    Run a blocking boto3 call on 'executor', the S3 thread pool of the shared resources (the
+    loop's default executor when None)
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+def _read_range(s3_client, bucket: str, object_name: str, etag: str, start: int, end: int) -> bytes:
+    response = s3_client.get_object(
+        Bucket=bucket,
+        Key=object_name,
+        Range=f"bytes={start}-{end}",
+        IfMatch=etag        # fail instead of mixing parts of two versions of the object
+    )
+    return response['Body'].read()
+
+def _write_at(fd: int, data: bytes, offset: int):
+    # os.pwrite does not move the file offset, so parts can be written from several threads
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+async def _fetch_ranges(s3_client, bucket: str, object_name: str, etag: str, size: int, write_part,
+                        executor=None):
+    semaphore = asyncio.Semaphore(config.s3_max_part_concurrency)
+
+    async def fetch_part(start):
+        end = min(start + config.s3_part_size, size) - 1
+        async with semaphore:
+            data = await _run(executor, _read_range, s3_client, bucket, object_name, etag, start, end)
+            await _run(executor, write_part, data, start)
+
+    await asyncio.gather(*[fetch_part(start) for start in range(0, size, config.s3_part_size)])
+
+async def head_object_s3(s3_client, bucket: str, object_name: str, executor=None):
+    '''
+    HEAD of an object in the S3 bucket (ContentLength, ETag, ...), None if the key does not exist
+    '''
+    try:
+        return await _run(executor, s3_client.head_object, Bucket=bucket, Key=object_name)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', '404', 'NotFound'):
+            return None
+        raise
+
+async def get_object_range_s3(s3_client, bucket: str, object_name: str, etag: str, start: int, end: int,
+                              executor=None):
     '''
-    Retrieve file object from S3 bucket
+    Bytes 'start' to 'end' (inclusive) of an object, e.g. to read a file header without the file
+    '''
+    return await _run(executor, _read_range, s3_client, bucket, object_name, etag, start, end)
+
+async def get_file_object_s3(s3_client, bucket: str, object_name: str, head: dict = None, executor=None):
+    '''
+    Retrieve file object from S3 bucket without blocking the event loop
     Param-
     s3_client: AWS S3 client created using boto3
     bucket: Name of the S3 bucket
     object_name: Name of the file in S3 bucket
+    head: HEAD of the object if the caller already has it, saves a request
+    executor: thread pool running the blocking S3 calls, the loop's default executor if None
+
+    Objects up to 's3_multipart_threshold' are read with a single GET, larger ones with
+    parallel ranged GETs. Objects above 's3_spool_threshold' are spooled to an anonymous
+    temp file and returned as a read-only memoryview over an mmap of it, smaller ones as bytes.
+    Raises S3ObjectTooLarge above 's3_max_object_size'. Returns None if the key does not exist.
     '''
     # create object of file in S3 bucket
     try:
-        s3_response_object = s3_client.get_object(
-            Bucket=bucket,
-            Key=object_name
-        )
-        object_content = s3_response_object['Body'].read()
-        return object_content
+        if head is None:
+            head = await _run(executor, s3_client.head_object, Bucket=bucket, Key=object_name)
+        size = head['ContentLength']
+        etag = head['ETag']
+        if size > config.s3_max_object_size:
+            raise S3ObjectTooLarge(
+                f"{object_name} is {size} bytes, above the limit of {config.s3_max_object_size} bytes"
+            )
+
+        if size <= config.s3_multipart_threshold:
+            s3_response_object = await _run(
+                executor, s3_client.get_object, Bucket=bucket, Key=object_name, IfMatch=etag
+            )
+            return await _run(executor, s3_response_object['Body'].read)
+
+        logger.info(f"Fetching {object_name} ({size} bytes) with ranged GETs")
+        if size <= config.s3_spool_threshold:
+            buffer = bytearray(size)
+
+            def write_part(data, offset):
+                buffer[offset:offset + len(data)] = data
+
+            await _fetch_ranges(s3_client, bucket, object_name, etag, size, write_part, executor)
+            return bytes(buffer)
+
+        with tempfile.TemporaryFile() as spool:
+            spool.truncate(size)
+            fd = spool.fileno()
+            await _fetch_ranges(s3_client, bucket, object_name, etag, size,
+                                lambda data, offset: _write_at(fd, data, offset), executor)
+            # the mapping stays valid after the temp file is closed and removed
+            return memoryview(mmap.mmap(fd, size, access=mmap.ACCESS_READ))
+
     except ClientError as e:
         logger.error(f"ClientError: get_file_object_s3, {e}")
-        if e.response['Error']['Code'] == 'NoSuchKey':
+        if e.response['Error']['Code'] in ('NoSuchKey', '404', 'NotFound'):
             logger.info('No object found - returning empty')
             return None
         else:
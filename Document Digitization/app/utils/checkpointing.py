@@ -0,0 +1,150 @@
+import asyncio
+from collections import defaultdict
+
+from utils.config import logger
+from utils.metrics import metrics
+
+class CheckpointCoalescer:
+    """
+    Coalesces the checkpoint writes (one blob write each) of every partition.
+
+    Trackers report the latest safe event of a partition with advance(); it is written when
+    'max_events' events have completed since the last write, every 'interval' seconds, and on
+    flush() (consumer shutdown) or close() (partition closed by a rebalance). Writes of one
+    partition are serialised and only ever move forward, so an older offset never overwrites a
+    newer one.
+    """
+    def __init__(self, max_events: int, interval: float):
+        self.max_events = max_events
+        self.interval = interval
+        self._pending = {}      # partition_id -> [partition_context, event, completed events]
+        self._written = {}      # partition_id -> sequence number of the last checkpoint written
+        self._locks = defaultdict(asyncio.Lock)
+        self._timer = None
+
+    def start(self):
+        if self.interval > 0:
+            self._timer = asyncio.create_task(self._flush_periodically())
+        return self
+
+    async def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            await asyncio.gather(self._timer, return_exceptions=True)
+            self._timer = None
+        await self.flush_all()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush_all()
+
+    async def advance(self, partition_context, event, completed: int = 1):
+        '''
+        Record 'event' as the new safe checkpoint of its partition after 'completed' more events
+        '''
+        partition_id = partition_context.partition_id
+        if event.sequence_number <= self._written.get(partition_id, -1):
+            return
+        pending = self._pending.get(partition_id)
+        if pending is None:
+            pending = self._pending[partition_id] = [partition_context, event, 0]
+        elif event.sequence_number > pending[1].sequence_number:
+            pending[0], pending[1] = partition_context, event
+        pending[2] += completed
+        if pending[2] >= self.max_events:
+            await self.flush(partition_id)
+
+    async def flush(self, partition_id: str):
+        '''
+        Write the pending checkpoint of the partition, if any
+        '''
+        async with self._locks[partition_id]:
+            pending = self._pending.pop(partition_id, None)
+            if pending is None:
+                return
+            partition_context, event, completed = pending
+            try:
+                with metrics.timer("checkpoint_flush"):
+                    await partition_context.update_checkpoint(event)
+            except Exception as e:
+                logger.error(f"Exception while updating checkpoint of partition {partition_id}: {e}")
+                # keep it for the next flush unless a newer one arrived meanwhile
+                newer = self._pending.get(partition_id)
+                if newer is None:
+                    self._pending[partition_id] = pending
+                else:
+                    newer[2] += completed
+                return
+            self._written[partition_id] = event.sequence_number
+            metrics.inc("checkpoint_flushes", partition=partition_id)
+            metrics.inc("checkpoint_events", completed, partition=partition_id)
+            self._record_lag(partition_context, event)
+
+    async def close(self, partition_id: str):
+        '''
+        Write the pending checkpoint of a partition this consumer stops owning and drop its lag
+        gauge, the next owner reports its own
+        '''
+        await self.flush(partition_id)
+        self._written.pop(partition_id, None)
+        metrics.clear_gauge("checkpoint_lag", partition=partition_id)
+
+    async def flush_all(self):
+        await asyncio.gather(*[self.flush(partition_id) for partition_id in list(self._pending)])
+
+    @staticmethod
+    def _record_lag(partition_context, event):
+        '''
+        Events enqueued on the partition after the checkpoint, from the last enqueued event
+        properties the receiver tracks
+        '''
+        properties = getattr(partition_context, "last_enqueued_event_properties", None) or {}
+        last_sequence_number = properties.get("sequence_number")
+        if last_sequence_number is not None:
+            metrics.set_gauge("checkpoint_lag", max(0, last_sequence_number - event.sequence_number),
+                              partition=partition_context.partition_id)
+
+class OrderedCheckpointTracker:
+    """
+    Tracks completion of the events of one batch processed concurrently and advances the
+    partition checkpoint only up to the highest contiguous completed event, so a slow document
+    never gets skipped by faster ones that were received after it.
+    """
+    def __init__(self, partition_context, event_batch, coalescer: CheckpointCoalescer):
+        self.partition_context = partition_context
+        self.coalescer = coalescer
+        self._events = list(event_batch)
+        self._done = [False] * len(self._events)
+        self._next_index = 0        # index of the first event not yet safe to checkpoint
+
+    @property
+    def safe_event(self):
+        '''
+        Latest event up to which every event of the batch has completed, None if there is none
+        '''
+        if self._next_index == 0:
+            return None
+        return self._events[self._next_index - 1]
+
+    def mark_done(self, index: int):
+        '''
+        Mark the event at 'index' as completed and return the new safe event if the contiguous
+        completed prefix advanced, else None
+        '''
+        self._done[index] = True
+        advanced = False
+        while self._next_index < len(self._events) and self._done[self._next_index]:
+            self._next_index += 1
+            advanced = True
+        return self.safe_event if advanced else None
+
+    async def complete(self, index: int):
+        '''
+        Mark the event at 'index' as completed and hand the new safe event, if it advanced, to
+        the checkpoint coalescer
+        '''
+        before = self._next_index
+        event = self.mark_done(index)
+        if event is not None:
+            await self.coalescer.advance(self.partition_context, event, self._next_index - before)
@@ -7,64 +7,210 @@ logger = get_logger("Documents Digitization Process", file_handler=False)
 
 from utils.access_secrets import AccessSecrets
 
+# Plain settings come first, so they are defined even when the secrets below are missing
+
+# MongoDB Configs
+mdb_db = os.getenv("cosmos_mdb_db", "skns_db_tvlbuddy")
+mdb_collection_data = os.getenv("cosmos_mdb_collection_data", "documents")
+mdb_conn_str = os.getenv("mdb_conn_str")
+#mdb_conn_str = AccessSecrets.get_secret("cosmos-mdb-conn-str")
+mdb_max_pool_size = int(os.getenv("mdb_max_pool_size", "50"))
+mdb_executor_workers = int(os.getenv("mdb_executor_workers", "8"))
+mdb_flush_interval_ms = int(os.getenv("mdb_flush_interval_ms", "50"))
+mdb_max_bulk_size = int(os.getenv("mdb_max_bulk_size", "100"))
+
+# Single-flight lease on documents across consumer replicas
+lease_enabled = os.getenv("lease_enabled", "true").lower() == "true"
+lease_ttl = int(os.getenv("lease_ttl_seconds", "120"))
+lease_wait_timeout = int(os.getenv("lease_wait_timeout_seconds", "900"))
+lease_poll_interval = float(os.getenv("lease_poll_interval_seconds", "2"))
+
+# Extraction cache (keyed by file SHA-256)
+extraction_cache_enabled = os.getenv("extraction_cache_enabled", "true").lower() == "true"
+mdb_collection_cache = os.getenv("cosmos_mdb_collection_cache", "extraction_cache")
+extraction_cache_ttl = int(os.getenv("extraction_cache_ttl_hours", "720")) * 3600
+extraction_cache_max_entries = int(os.getenv("extraction_cache_max_entries", "50000"))
+
+# In-process OCR result cache (keyed by file SHA-256) in front of the extraction cache
+ocr_cache_enabled = os.getenv("ocr_cache_enabled", "true").lower() == "true"
+ocr_cache_max_bytes = int(os.getenv("ocr_cache_max_mb", "64")) * 1024 * 1024
+ocr_cache_ttl = int(os.getenv("ocr_cache_ttl_seconds", "3600"))
+
+# Embedding cache (keyed by model and chunk text), a local SQLite file shared by the workers
+# of a host; an ada-002 entry takes about 6 KB
+embedding_cache_enabled = os.getenv("embedding_cache_enabled", "true").lower() == "true"
+embedding_cache_path = os.getenv("embedding_cache_path", "/tmp/document_digitization/embeddings.sqlite3")
+embedding_cache_max_entries = int(os.getenv("embedding_cache_max_entries", "100000"))
+
+# AWS S3 Configs
+s3_bucket_input = os.getenv("aws_s3_bucket_input", "travelbuddyappian")
+s3_access_key_id = os.getenv("s3_access_key_id")
+#s3_access_key_id = AccessSecrets.get_secret("aws-s3-access-key-id")
+s3_secret_access_key = os.getenv("s3_secret_access_key")
+#s3_secret_access_key = AccessSecrets.get_secret("aws-s3-secret-access-key")
+s3_endpoint_url = os.getenv("aws_s3_endpoint_url")       # None for AWS, set for S3-compatible stores
+s3_max_pool_connections = int(os.getenv("aws_s3_max_pool_connections", "20"))
+# threads running the blocking S3 calls, enough to use the whole connection pool
+s3_executor_workers = int(os.getenv("aws_s3_executor_workers", str(s3_max_pool_connections)))
+s3_multipart_threshold = int(os.getenv("aws_s3_multipart_threshold_mb", "8")) * 1024 * 1024
+s3_part_size = int(os.getenv("aws_s3_part_size_mb", "8")) * 1024 * 1024
+s3_max_part_concurrency = int(os.getenv("aws_s3_max_part_concurrency", "4"))
+s3_spool_threshold = int(os.getenv("aws_s3_spool_threshold_mb", "32")) * 1024 * 1024
+s3_max_object_size = int(os.getenv("aws_s3_max_object_size_mb", "200")) * 1024 * 1024
+
+# storage account
+storage_ac_conn_str = os.getenv("storage_ac_conn_str")
+#storage_ac_conn_str = AccessSecrets.get_secret("storage-ac-conn-str")  
+
+# event hub
+eventhub_name = os.getenv("eventhub_name")
+eventhub_checkpoint_container = os.getenv("eventhub_checkpoint_container")
+eventhub_conn_str_listen = os.getenv("eventhub_conn_str_listen")
+#eventhub_conn_str_listen = AccessSecrets.get_secret("eventhub-conn-str-listen")
+# send rights, only needed to replay dead-lettered events (replay_dead_letters.py)
+eventhub_conn_str_send = os.getenv("eventhub_conn_str_send")
+
+max_event_batch_size = int(os.getenv("eh_max_batch_size_eventhub", "10"))
+max_concurrent_events_partition = int(os.getenv("eh_max_concurrent_events_partition", "4"))
+max_concurrent_events = int(os.getenv("eh_max_concurrent_events", "16"))
+
+# Fair queuing of events across tenants (uid): cap on the events of one tenant in flight
+# (0 = none) and weights as "uid=weight,uid=weight" (default weight 1)
+tenant_max_concurrent_events = int(os.getenv("tenant_max_concurrent_events", "8"))
+tenant_weights = {
+    uid.strip(): float(weight)
+    for uid, weight in (item.split("=", 1) for item in os.getenv("tenant_weights", "").split(",") if item.strip())
+}
+max_api_tries = int(os.getenv("eh_max_api_tries","3"))
+backoff_factor = int(os.getenv("eh_backoff_factor","10"))
+# a partition checkpoint is written every N completed events or T seconds (and on close)
+checkpoint_flush_events = int(os.getenv("eh_checkpoint_flush_events", "50"))
+checkpoint_flush_interval = float(os.getenv("eh_checkpoint_flush_interval_seconds", "10"))
+retry_exp_wait_multiplier = int(os.environ.get("eh_retry_exp_wait_multiplier","1"))
+retry_wait_max = int(os.getenv("eh_retry_wait_max","60"))
+
+# Metrics and health endpoint (/metrics, /health/live, /health/ready), port 0 disables it
+metrics_host = os.getenv("metrics_host", "0.0.0.0")
+metrics_port = int(os.getenv("metrics_port", "9090"))
+health_check_timeout = float(os.getenv("health_check_timeout_seconds", "5"))
+health_check_cache_seconds = float(os.getenv("health_check_cache_seconds", "10"))
+
+# Supervisor (run.py): worker processes sharing the partitions, 0 means one per CPU
+consumer_workers = int(os.getenv("consumer_workers", "1"))
+supervisor_report_interval = float(os.getenv("supervisor_report_interval_seconds", "15"))
+supervisor_heartbeat_timeout = float(os.getenv("supervisor_heartbeat_timeout_seconds", "120"))
+supervisor_restart_backoff_max = float(os.getenv("supervisor_restart_backoff_max_seconds", "60"))
+supervisor_shutdown_timeout = float(os.getenv("supervisor_shutdown_timeout_seconds", "60"))
+
+# Shortest-job-first lanes: documents up to these limits take the fast lane, the slow lane
+# gets 'lane_slow_share' of every concurrency budget (at least one slot)
+lane_fast_max_pages = int(os.getenv("lane_fast_max_pages", "3"))
+lane_fast_max_bytes = int(os.getenv("lane_fast_max_mb", "2")) * 1024 * 1024
+lane_slow_share = float(os.getenv("lane_slow_share", "0.25"))
+lane_probe_pdf_header = os.getenv("lane_probe_pdf_header", "true").lower() == "true"
+
+# Staged pipeline (fetch -> ocr -> index -> llm -> deliver)
+pipeline_queue_size = int(os.getenv("pipeline_queue_size", "16"))
+pipeline_fetch_concurrency = int(os.getenv("pipeline_fetch_concurrency", "8"))
+pipeline_ocr_concurrency = int(os.getenv("pipeline_ocr_concurrency", "8"))
+pipeline_index_concurrency = int(os.getenv("pipeline_index_concurrency", "4"))
+pipeline_llm_concurrency = int(os.getenv("pipeline_llm_concurrency", "8"))
+pipeline_deliver_concurrency = int(os.getenv("pipeline_deliver_concurrency", "8"))
+
+# OCR backend of the documents whose event names none ("azure" or "tesseract"), and the
+# backend used while Azure Read is throttled ("" = wait for Azure)
+ocr_backend = os.getenv("ocr_backend", "azure")
+ocr_fallback_backend = os.getenv("ocr_fallback_backend", "tesseract")
+tesseract_workers = int(os.getenv("tesseract_workers", "2"))
+tesseract_dpi = int(os.getenv("tesseract_dpi", "300"))
+tesseract_lang = os.getenv("tesseract_lang", "eng")
+
+# PDFs of at least 'ocr_shard_min_pages' pages are OCR'd as concurrent jobs of
+# 'ocr_shard_pages' pages (0 = never split), each retried 'ocr_shard_retries' times
+ocr_shard_pages = int(os.getenv("ocr_shard_pages", "10"))
+ocr_shard_min_pages = int(os.getenv("ocr_shard_min_pages", "20"))
+ocr_shard_concurrency = int(os.getenv("ocr_shard_concurrency", "4"))
+ocr_shard_retries = int(os.getenv("ocr_shard_retries", "2"))
+
+# Adaptive (AIMD) limits on the calls in flight to Azure Read and Azure OpenAI
+adaptive_initial_limit = int(os.getenv("adaptive_initial_limit", "2"))
+adaptive_min_limit = int(os.getenv("adaptive_min_limit", "1"))
+adaptive_backoff_factor = float(os.getenv("adaptive_backoff_factor", "0.5"))
+# latency per page or chunk above this multiple of its baseline lowers the limit, 0 = only 429/503
+adaptive_latency_tolerance = float(os.getenv("adaptive_latency_tolerance", "2.0"))
+adaptive_cooldown = float(os.getenv("adaptive_cooldown_seconds", "5"))
+azure_read_max_concurrency = int(os.getenv("azure_read_max_concurrency", str(pipeline_ocr_concurrency)))
+azure_openai_max_concurrency = int(os.getenv("azure_openai_max_concurrency",
+                                             str(pipeline_index_concurrency + pipeline_llm_concurrency)))
+# retries of the openai client itself, 0 leaves them to the pipeline (and its limiter)
+azure_openai_max_retries = int(os.getenv("azure_openai_max_retries", "0"))
+
+# module specific configs
+llm_model_name = os.getenv("llm_model_name", "azure/gpt-35-turbo-16k")
+# documents with up to this many OCR tokens are sent whole to the LLM, without embedding
+# and retrieval (0 = always retrieve)
+direct_context_max_tokens = int(os.getenv("direct_context_max_tokens", "6000"))
+# longer documents of at least 'map_reduce_min_pages' pages (0 = never) are extracted in
+# concurrent calls of 'map_reduce_pages_per_call' pages each, merged locally
+map_reduce_min_pages = int(os.getenv("map_reduce_min_pages", "4"))
+map_reduce_pages_per_call = int(os.getenv("map_reduce_pages_per_call", "2"))
+map_reduce_concurrency = int(os.getenv("map_reduce_concurrency", "4"))
+map_reduce_group_retries = int(os.getenv("map_reduce_group_retries", "2"))
+# documents classified locally before the LLM call get the shorter prompt of their label:
+# by keywords ('min_score' points, twice the runner-up), else optionally by embedding the
+# head of the text (cosine 'min_similarity', 'min_margin' above the runner-up)
+document_classifier_enabled = os.getenv("document_classifier_enabled", "true").lower() == "true"
+document_classifier_min_score = int(os.getenv("document_classifier_min_score", "4"))
+document_classifier_embeddings = os.getenv("document_classifier_embeddings", "false").lower() == "true"
+document_classifier_min_similarity = float(os.getenv("document_classifier_min_similarity", "0.8"))
+document_classifier_min_margin = float(os.getenv("document_classifier_min_margin", "0.02"))
+# re-asks of the LLM for the fields missing or invalid in its answer
+llm_repair_attempts = int(os.getenv("llm_repair_attempts", "1"))
+
+azure_openai_api_key = os.getenv("azure_openai_api_key")
+#azure_openai_api_key = AccessSecrets.get_secret("azure-openai-api-key")
+azure_openai_api_base = os.getenv("azure_openai_api_base")
+azure_openai_api_version = os.getenv("azure_openai_api_version")
+
+cognitive_services_subscription_key = os.getenv("cognitive_services_subscription_key")
+#cognitive_services_subscription_key = AccessSecrets.get_secret("cognitive-services-subscription-key")
+cognitive_services_base_url = os.getenv("cognitive_services_base_url")
+cognitive_services_endpoint = os.getenv("cognitive_services_endpoint")
+
+# Dead-letter records of failed events, quarantined after this many attempts
+dead_letter_enabled = os.getenv("dead_letter_enabled", "true").lower() == "true"
+mdb_collection_dead_letter = os.getenv("cosmos_mdb_collection_dead_letter", "dead_letters")
+dead_letter_max_attempts = int(os.getenv("dead_letter_max_attempts", "3"))
+
+# Appian API Details
+appian_api_key = os.getenv("appian_api_key")
+appian_api_url = os.getenv("appian_api_url")
+mdb_collection_outbox = os.getenv("cosmos_mdb_collection_outbox", "appian_outbox")
+appian_max_attempts = int(os.getenv("appian_max_attempts", "8"))
+appian_outbox_concurrency = int(os.getenv("appian_outbox_concurrency", "8"))
+appian_outbox_poll_interval = float(os.getenv("appian_outbox_poll_interval_seconds", "5"))
+appian_outbox_claim_timeout = int(os.getenv("appian_outbox_claim_timeout_seconds", "120"))
+
+# Shared HTTP session (OCR and Appian calls)
+http_pool_limit = int(os.getenv("http_pool_limit", "100"))
+http_pool_limit_per_host = int(os.getenv("http_pool_limit_per_host", "20"))
+http_keepalive_timeout = int(os.getenv("http_keepalive_timeout", "30"))
+http_request_timeout = int(os.getenv("http_request_timeout", "300"))
+
 try:
     # loop = asyncio.get_event_loop()
     vault_url = os.environ["vault_url"]
     client_id_managed_identity = os.environ["client_id_managed_identity"]
 
-    # MongoDB Configs
-    mdb_db = os.getenv("cosmos_mdb_db", "skns_db_tvlbuddy")
-    mdb_collection_data = os.getenv("cosmos_mdb_collection_data", "documents")
-    mdb_conn_str = os.getenv("mdb_conn_str")
-    #mdb_conn_str = AccessSecrets.get_secret("cosmos-mdb-conn-str")
-
-    # AWS S3 Configs
-    s3_bucket_input = os.getenv("aws_s3_bucket_input", "travelbuddyappian")
-    s3_access_key_id = os.getenv("s3_access_key_id")
-    #s3_access_key_id = AccessSecrets.get_secret("aws-s3-access-key-id")
-    s3_secret_access_key = os.getenv("s3_secret_access_key")
-    #s3_secret_access_key = AccessSecrets.get_secret("aws-s3-secret-access-key")
     boto3_client = boto3.client(
         's3',
         aws_access_key_id = s3_access_key_id,
         aws_secret_access_key = s3_secret_access_key
     )
 
-    # storage account
-    storage_ac_conn_str = os.getenv("storage_ac_conn_str")
-    #storage_ac_conn_str = AccessSecrets.get_secret("storage-ac-conn-str")  
-
-    # event hub
-    eventhub_name = os.getenv("eventhub_name")
-    eventhub_checkpoint_container = os.getenv("eventhub_checkpoint_container")
-    eventhub_conn_str_listen = os.getenv("eventhub_conn_str_listen")
-    #eventhub_conn_str_listen = AccessSecrets.get_secret("eventhub-conn-str-listen")
-
-    max_event_batch_size = int(os.getenv("eh_max_batch_size_eventhub", "10"))
-    max_api_tries = int(os.getenv("eh_max_api_tries","3"))
-    backoff_factor = int(os.getenv("eh_backoff_factor","10"))
-    retry_exp_wait_multiplier = int(os.environ.get("eh_retry_exp_wait_multiplier","1"))
-    retry_wait_max = int(os.getenv("eh_retry_wait_max","60"))
-
-    # module specific configs
-    llm_model_name = os.getenv("llm_model_name", "azure/gpt-35-turbo-16k")
-
-    azure_openai_api_key = os.getenv("azure_openai_api_key")
-    #azure_openai_api_key = AccessSecrets.get_secret("azure-openai-api-key")
-    azure_openai_api_base = os.getenv("azure_openai_api_base")
-    azure_openai_api_version = os.getenv("azure_openai_api_version")
     os.environ["AZURE_API_KEY"] = azure_openai_api_key
     os.environ["AZURE_API_BASE"] = azure_openai_api_base
     os.environ["AZURE_API_VERSION"] = azure_openai_api_version
 
-    cognitive_services_subscription_key = os.getenv("cognitive_services_subscription_key")
-    #cognitive_services_subscription_key = AccessSecrets.get_secret("cognitive-services-subscription-key")
-    cognitive_services_base_url = os.getenv("cognitive_services_base_url")
-    cognitive_services_endpoint = os.getenv("cognitive_services_endpoint")
-
-    # Appian API Details
-    appian_api_key = os.getenv("appian_api_key")
-    appian_api_url = os.getenv("appian_api_url")
-
 except:
     logger.error("Exception while retrieving environment variables!")
@@ -0,0 +1,153 @@
+import re
+import json
+import hashlib
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from utils.config import logger
+from utils.metrics import metrics
+from utils.mongodb import AsyncMongoDB
+
+# Keys every event body must carry
+REQUIRED_EVENT_KEYS = ("_id", "doc_id", "uid", "file_name", "filename")
+
+class UnsupportedDocument(Exception):
+    """
+    An event that can never be processed, whatever the retries: malformed body or unsupported
+    file type. Quarantined on its first failure.
+    """
+
+def event_fingerprint(raw_body: str):
+    '''
+    Identity of an event: the same body re-read after a restart (or sent twice) maps to one record
+    '''
+    return hashlib.sha256(raw_body.encode("utf-8")).hexdigest()
+
+def failure_fingerprint(stage: str, exp: Exception):
+    '''
+    Identity of a failure: stage, exception type and message with ids and numbers masked, so
+    the same cause on different documents gives the same fingerprint
+    '''
+    message = re.sub(r"[0-9a-fA-F]{8,}|\d+", "#", str(exp))
+    return hashlib.sha256(f"{stage}:{type(exp).__name__}:{message}".encode("utf-8")).hexdigest()[:16]
+
+def parse_event_body(raw_body: str):
+    '''
+    Decode and validate an event body, raises UnsupportedDocument when it can never be processed
+    '''
+    try:
+        event_body = json.loads(raw_body)
+    except json.JSONDecodeError as e:
+        raise UnsupportedDocument(f"Event body is not JSON: {e}")
+    if not isinstance(event_body, dict):
+        raise UnsupportedDocument("Event body is not a JSON object")
+    missing = [key for key in REQUIRED_EVENT_KEYS if key not in event_body]
+    if missing:
+        raise UnsupportedDocument(f"Event body misses {missing}")
+    try:
+        ObjectId(event_body["_id"])
+    except (InvalidId, TypeError):
+        raise UnsupportedDocument(f"Event _id is not an ObjectId: {event_body['_id']!r}")
+    if ".com/" not in str(event_body["file_name"]):
+        raise UnsupportedDocument(f"Event file_name is not an S3 URL: {event_body['file_name']!r}")
+    return event_body
+
+class DeadLetterStore:
+    """
+    Dead-letter records of the events that failed, in MongoDB, one per event body.
+
+    begin() counts an attempt before an event is processed, so an event that crashes the
+    consumer is counted even though it never reports a failure. An event is quarantined when it
+    can never succeed (malformed body, permanent error) or after 'max_attempts' attempts; a
+    quarantined event is skipped, without OCR or LLM calls, until it is replayed. Successful
+    events drop their record. Failures are grouped by fingerprint (see failure_fingerprint()).
+    """
+    IN_PROGRESS = "in_progress"
+    FAILED = "failed"
+    QUARANTINED = "quarantined"
+    REPLAYED = "replayed"
+
+    def __init__(self, store: AsyncMongoDB, collection_name: str, max_attempts: int):
+        self.store = store
+        self.collection_name = collection_name
+        self.max_attempts = max_attempts
+
+    async def ensure_indexes(self):
+        await self.store.create_index(self.collection_name, [("status", 1), ("last_seen", -1)],
+                                      name="status_last_seen")
+
+    async def begin(self, key: str, raw_body: str, partition_id: str, sequence_number: int):
+        '''
+        Count an attempt of the event, returns False when it must be skipped (quarantined)
+        '''
+        now = datetime.now(timezone.utc)
+        record = await self.store.find_one_and_update(
+            self.collection_name,
+            {"_id": key},
+            {"last_seen": now, "partition": partition_id, "sequence_number": sequence_number},
+            upsert=True,
+            operators={
+                "$inc": {"attempts": 1},
+                "$setOnInsert": {"body": raw_body, "first_seen": now, "status": self.IN_PROGRESS},
+            },
+        )
+        if record is None:
+            # the store is unreachable, process the event rather than drop it
+            return True
+        if record.get("status") == self.QUARANTINED:
+            metrics.inc("dead_letter_skipped")
+            logger.info(f"Skipping quarantined event {key}")
+            return False
+        if record["attempts"] > self.max_attempts:
+            await self.fail(key, "attempts", RuntimeError(
+                f"{record['attempts'] - 1} attempts did not complete"), permanent=True)
+            return False
+        return True
+
+    async def fail(self, key: str, stage: str, exp: Exception, permanent: bool = False):
+        '''
+        Record a failed attempt, quarantine the event if 'permanent' or out of attempts.
+        Returns True when the event is quarantined.
+        '''
+        fingerprint = failure_fingerprint(stage, exp)
+        last_error = {"stage": stage, "type": type(exp).__name__, "error": str(exp)[:1000],
+                      "fingerprint": fingerprint, "at": datetime.now(timezone.utc)}
+        record = await self.store.find_one_and_update(
+            self.collection_name,
+            {"_id": key},
+            {"status": self.FAILED, "last_error": last_error},
+            operators={"$inc": {f"fingerprints.{fingerprint}": 1}},
+        )
+        if record is None or not (permanent or record.get("attempts", 0) >= self.max_attempts):
+            return False
+        await self.store.find_one_and_update(
+            self.collection_name,
+            {"_id": key},
+            {"status": self.QUARANTINED, "quarantined_at": datetime.now(timezone.utc)},
+        )
+        metrics.inc("dead_letter_quarantined", stage=stage)
+        logger.error(f"Quarantined event {key} after {record.get('attempts')} attempt(s), "
+                     f"{stage}: {last_error['error']} ({fingerprint})")
+        return True
+
+    async def resolve(self, key: str):
+        await self.store.delete_document(self.collection_name, {"_id": key})
+
+    async def quarantined(self, fingerprint: str = None, limit: int = 0):
+        query = {"status": self.QUARANTINED}
+        if fingerprint:
+            query["last_error.fingerprint"] = fingerprint
+        return await self.store.get_documents(self.collection_name, query,
+                                              sort=[("last_seen", -1)], limit=limit) or []
+
+    async def mark_replayed(self, key: str):
+        '''
+        Reset the attempts of a re-injected event so it is processed again
+        '''
+        return await self.store.find_one_and_update(
+            self.collection_name,
+            {"_id": key, "status": self.QUARANTINED},
+            {"status": self.REPLAYED, "attempts": 0, "replayed_at": datetime.now(timezone.utc)},
+        )
@@ -0,0 +1,115 @@
+import os
+import re
+import time
+import array
+import sqlite3
+import hashlib
+import threading
+
+from utils.config import logger
+from utils.metrics import metrics
+
+def chunk_key(model_name: str, text: str) -> str:
+    '''
+    Cache key of a chunk: the embedding model and the SHA-256 of its text with whitespace
+    collapsed, so the same footer OCR'd with different line breaks maps to one entry
+    '''
+    normalised = re.sub(r"\s+", " ", text).strip()
+    return hashlib.sha256(f"{model_name}\n{normalised}".encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """
+    Persistent cache of chunk embeddings in a local SQLite file, keyed by chunk_key().
+
+    Vectors are stored as float32. Hits refresh 'last_used' and, once more than 'max_entries'
+    are stored, the least recently used tenth is evicted (checked every 'evict_every' writes).
+    The file is opened in WAL mode so the worker processes of one host can share it. Calls are
+    blocking, run them off the event loop.
+    """
+    def __init__(self, path: str, max_entries: int, evict_every: int = 500):
+        self.path = path
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+
+    def get_many(self, keys):
+        '''
+        Embeddings of the keys found in the cache, as {key: [float, ...]}
+        '''
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            # stay well under SQLite's limit of bound parameters per statement
+            for start in range(0, len(unique), 500):
+                batch = unique[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    vector = array.array("f")
+                    vector.frombytes(blob)
+                    found[key] = vector.tolist()
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                       [(now, key) for key in found])
+        hits = sum(1 for key in keys if key in found)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        metrics.inc("embedding_cache_hits", hits)
+        metrics.inc("embedding_cache_misses", len(keys) - hits)
+        return found
+
+    def put_many(self, items: dict):
+        '''
+        Store {key: embedding} and evict the least recently used entries above 'max_entries'
+        '''
+        if not items:
+            return
+        now = time.time()
+        rows = [(key, array.array("f", vector).tobytes(), now) for key, vector in items.items()]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                                   rows)
+            self._writes += len(rows)
+            if self._writes >= self.evict_every:
+                self._writes = 0
+                self._evict()
+
+    def _evict(self):
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count > self.max_entries:
+            excess = count - self.max_entries + self.max_entries // 10
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (excess,)
+            )
+            count -= excess
+            metrics.inc("embedding_cache_evictions", excess)
+            logger.info(f"Embedding cache: evicted {excess} least recently used entries")
+        metrics.set_gauge("embedding_cache_entries", count)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,107 @@
+import json
+import hashlib
+from datetime import datetime, timezone
+
+from utils.config import logger
+from utils.mongodb import AsyncMongoDB
+
+def file_hash(file_bytes) -> str:
+    '''
+    SHA-256 of the file content, the key of the extraction cache
+    '''
+    return hashlib.sha256(file_bytes).hexdigest()
+
+class ExtractionCache:
+    """
+    Content-addressed cache of the extraction pipeline, stored in MongoDB.
+
+    One record per file, keyed by the SHA-256 of its bytes:
+    - ocr_pages: OCR output ("Page_N" -> text)
+    - nodes.<embed_key>: embedded chunks (JSON) for an embedding/chunking setup
+    - outputs.<output_key>: final LLM JSON for a prompt + model version
+    Records expire 'ttl' seconds after their last use (TTL index on 'last_used') and the least
+    recently used ones are evicted once the collection grows past 'max_entries'.
+    """
+    def __init__(self, store: AsyncMongoDB, collection_name: str, ttl: int, max_entries: int,
+                 evict_every: int = 100):
+        self.store = store
+        self.collection_name = collection_name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._new_records = 0
+        self.hits = {"ocr": 0, "nodes": 0, "output": 0}
+        self.misses = {"ocr": 0, "nodes": 0, "output": 0}
+
+    async def ensure_indexes(self):
+        await self.store.create_index(self.collection_name, [("last_used", 1)],
+                                      name="last_used_ttl", expireAfterSeconds=self.ttl)
+
+    async def _get(self, key: str, field: str):
+        record = await self.store.get_document(self.collection_name, {"_id": key}, {field: 1})
+        value = record
+        for part in field.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        return value
+
+    async def _set(self, key: str, values: dict):
+        values["last_used"] = datetime.now(timezone.utc)
+        return await self.store.update_document(self.collection_name, {"_id": key}, values)
+
+    def _count(self, kind: str, value):
+        if value is None:
+            self.misses[kind] += 1
+        else:
+            self.hits[kind] += 1
+        return value
+
+    async def get_output(self, key: str, output_key: str):
+        '''
+        Final extraction JSON for the file and prompt/model version, None on a miss
+        '''
+        value = await self._get(key, f"outputs.{output_key}")
+        if value is not None:
+            value = json.loads(value)
+            await self._set(key, {})
+        return self._count("output", value)
+
+    async def get_ocr_pages(self, key: str):
+        return self._count("ocr", await self._get(key, "ocr_pages"))
+
+    async def get_nodes(self, key: str, embed_key: str):
+        '''
+        Embedded chunks as a list of node dicts, None on a miss
+        '''
+        value = await self._get(key, f"nodes.{embed_key}")
+        return self._count("nodes", json.loads(value) if value is not None else None)
+
+    async def put_ocr_pages(self, key: str, ocr_pages: dict):
+        await self._set(key, {"ocr_pages": ocr_pages})
+        self._new_records += 1
+        if self._new_records % self.evict_every == 0:
+            await self.evict()
+
+    async def put_nodes(self, key: str, embed_key: str, nodes: list):
+        await self._set(key, {f"nodes.{embed_key}": json.dumps(nodes)})
+
+    async def put_output(self, key: str, output_key: str, output):
+        await self._set(key, {f"outputs.{output_key}": json.dumps(output)})
+
+    async def evict(self):
+        '''
+        Remove the least recently used records above 'max_entries'
+        '''
+        count = await self.store.count_documents(self.collection_name)
+        if not count or count <= self.max_entries:
+            return 0
+        oldest = await self.store.get_documents(self.collection_name, {}, {"_id": 1},
+                                                sort=[("last_used", 1)],
+                                                limit=count - self.max_entries)
+        ids = [record["_id"] for record in oldest or []]
+        if ids:
+            await self.store.delete_documents(self.collection_name, {"_id": {"$in": ids}})
+            logger.info(f"Extraction cache: evicted {len(ids)} records")
+        return len(ids)
+
+    def stats(self):
+        return {"hits": dict(self.hits), "misses": dict(self.misses)}
@@ -0,0 +1,130 @@
+import asyncio
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+
+from utils.metrics import metrics
+
+class FairScheduler:
+    """
+    Weighted fair admission of events across tenants (the 'uid' of an event) into pools of
+    slots, e.g. one pool per lane.
+
+    Waiting events are queued per tenant. When a slot frees up, it goes to the waiting tenant
+    with the lowest virtual time, and every admission moves a tenant's virtual time forward by
+    1 / weight. Tenants with the same weight therefore take turns, however many events each has
+    queued, and a tenant that was idle rejoins at the current virtual time (no saved-up credit).
+    'tenant_cap' (0 = none) bounds the events of one tenant in flight across all pools. With a
+    'name', per-tenant queue depth and in-flight gauges are published to the metrics registry.
+    """
+    def __init__(self, budgets: dict, tenant_cap: int = 0, weights: dict = None, name: str = None):
+        self.budgets = dict(budgets)
+        self.tenant_cap = tenant_cap
+        self.weights = weights or {}
+        self.name = name
+        self._in_flight = {pool: 0 for pool in self.budgets}
+        self._waiters = {pool: {} for pool in self.budgets}     # pool -> tenant -> deque of futures
+        self._active = defaultdict(int)                          # tenant -> events in flight
+        self._finish = {}                                        # tenant -> virtual finish time
+        self._vtime = 0.0
+
+    def _weight(self, tenant: str):
+        return max(self.weights.get(tenant, 1.0), 1e-3)
+
+    def _start_tag(self, tenant: str):
+        return max(self._finish.get(tenant, self._vtime), self._vtime)
+
+    def _eligible(self, tenant: str):
+        return not self.tenant_cap or self._active[tenant] < self.tenant_cap
+
+    def _queue_depth(self, tenant: str):
+        return sum(len(waiters.get(tenant, ())) for waiters in self._waiters.values())
+
+    def _publish(self, tenant: str):
+        if self.name is None:
+            return
+        depth, in_flight = self._queue_depth(tenant), self._active.get(tenant, 0)
+        if depth or in_flight:
+            metrics.set_gauge("tenant_queue_depth", depth, scheduler=self.name, tenant=tenant)
+            metrics.set_gauge("tenant_in_flight", in_flight, scheduler=self.name, tenant=tenant)
+        else:
+            # idle tenants drop their series, so the gauges do not grow with every uid ever seen
+            metrics.clear_gauge("tenant_queue_depth", scheduler=self.name, tenant=tenant)
+            metrics.clear_gauge("tenant_in_flight", scheduler=self.name, tenant=tenant)
+
+    def _grant(self, tenant: str, pool: str):
+        start = self._start_tag(tenant)
+        self._finish[tenant] = start + 1 / self._weight(tenant)
+        self._vtime = max(self._vtime, start)
+        self._in_flight[pool] += 1
+        self._active[tenant] += 1
+
+    def _dispatch(self, pool: str):
+        waiters = self._waiters[pool]
+        while self._in_flight[pool] < self.budgets[pool]:
+            candidates = [tenant for tenant in waiters if self._eligible(tenant)]
+            if not candidates:
+                return
+            tenant = min(candidates, key=self._start_tag)
+            queue = waiters[tenant]
+            future = queue.popleft()
+            if not queue:
+                del waiters[tenant]
+            self._grant(tenant, pool)
+            future.set_result(None)
+            self._publish(tenant)
+
+    async def acquire(self, tenant: str, pool: str):
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[pool].setdefault(tenant, deque()).append(future)
+        self._dispatch(pool)
+        if not future.done():
+            self._publish(tenant)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # admitted in the same step as the cancellation, hand the slot on
+                self.release(tenant, pool)
+            else:
+                queue = self._waiters[pool].get(tenant)
+                if queue is not None and future in queue:
+                    queue.remove(future)
+                    if not queue:
+                        del self._waiters[pool][tenant]
+                self._publish(tenant)
+            raise
+
+    def release(self, tenant: str, pool: str):
+        self._in_flight[pool] -= 1
+        self._active[tenant] -= 1
+        if self._active[tenant] <= 0:
+            del self._active[tenant]
+            if not self._queue_depth(tenant) and self._finish.get(tenant, 0) <= self._vtime:
+                self._finish.pop(tenant, None)
+        # the freed tenant slot may unblock this tenant in any pool
+        for name in self.budgets:
+            self._dispatch(name)
+        if not self._active and not any(self._waiters.values()):
+            # idle, no tenant is owed anything
+            self._finish.clear()
+            self._vtime = 0.0
+        self._publish(tenant)
+
+    @asynccontextmanager
+    async def slot(self, tenant: str, pool: str):
+        '''
+        Hold one slot of 'pool' for 'tenant' over the enclosed block
+        '''
+        await self.acquire(tenant, pool)
+        try:
+            yield
+        finally:
+            self.release(tenant, pool)
+
+    def stats(self):
+        return {
+            "in_flight": dict(self._in_flight),
+            "waiting": {pool: sum(len(queue) for queue in waiters.values())
+                        for pool, waiters in self._waiters.items()},
+            "tenants_active": len(self._active),
+        }
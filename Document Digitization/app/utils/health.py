@@ -0,0 +1,88 @@
+import time
+import asyncio
+
+from aiohttp import web
+
+from utils.config import logger
+
+class Health:
+    """
+    Liveness and readiness of the consumer.
+
+    Live while the event loop answers and consumer.main() runs. Ready when MongoDB answers a ping
+    and the Event Hub answers a properties request, each within 'check_timeout' seconds. Probe
+    results are cached for 'cache_seconds' so frequent health checks do not load either service.
+    """
+    def __init__(self, check_timeout: float, cache_seconds: float):
+        self.check_timeout = check_timeout
+        self.cache_seconds = cache_seconds
+        self.resources = None
+        self.eventhub_client = None
+        self.running = False
+        self.started_at = time.monotonic()
+        self._cache = {}
+        self._tasks = {}
+
+    async def _probe(self, name: str, probe):
+        cached = self._cache.get(name)
+        if cached is not None and time.monotonic() - cached[0] < self.cache_seconds:
+            return cached[1]
+        # a probe stuck past the timeout keeps running and is awaited again by the next check,
+        # so a hung service never piles up probes (and blocked MongoDB executor threads)
+        task = self._tasks.get(name)
+        if task is None or task.done():
+            task = self._tasks[name] = asyncio.ensure_future(probe())
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout=self.check_timeout)
+            result = {"ok": True}
+        except asyncio.TimeoutError:
+            result = {"ok": False, "error": f"no answer within {self.check_timeout}s"}
+        except Exception as e:
+            result = {"ok": False, "error": str(e) or type(e).__name__}
+        self._cache[name] = (time.monotonic(), result)
+        return result
+
+    async def liveness(self):
+        return {
+            "ok": self.running,
+            "uptime_seconds": round(time.monotonic() - self.started_at, 1),
+        }
+
+    async def readiness(self):
+        if self.resources is None or self.resources.status_store is None:
+            mongo = {"ok": False, "error": "not started"}
+        else:
+            mongo = await self._probe("mongo", self.resources.status_store.ping)
+        if self.eventhub_client is None:
+            eventhub = {"ok": False, "error": "not started"}
+        else:
+            eventhub = await self._probe("eventhub", self.eventhub_client.get_eventhub_properties)
+        return {"ok": self.running and mongo["ok"] and eventhub["ok"], "mongo": mongo, "eventhub": eventhub}
+
+async def start_http_server(host: str, port: int, render_metrics, liveness, readiness):
+    '''
+    Serve /metrics (Prometheus text format), /health/live and /health/ready (200 or 503 with a
+    JSON body). 'render_metrics' returns the metrics text, 'liveness' and 'readiness' are
+    coroutines returning a dict with an "ok" flag. Returns the runner, cleanup() stops it.
+    '''
+    async def metrics_handler(request):
+        return web.Response(text=render_metrics(),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+    def health_handler(check):
+        async def handler(request):
+            status = await check()
+            return web.json_response(status, status=200 if status["ok"] else 503)
+        return handler
+
+    app = web.Application()
+    app.add_routes([
+        web.get("/metrics", metrics_handler),
+        web.get("/health/live", health_handler(liveness)),
+        web.get("/health/ready", health_handler(readiness)),
+    ])
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics and health endpoint listening on {host}:{port}")
+    return runner
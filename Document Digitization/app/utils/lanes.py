@@ -0,0 +1,50 @@
+import re
+
+from utils import config
+
+# Lanes of the consumer: small documents go through the fast lane, large ones through the slow lane
+FAST = "fast"
+SLOW = "slow"
+LANES = (FAST, SLOW)
+
+# Bytes read from the start of a PDF to find its page count before downloading it
+PDF_HEADER_BYTES = 1024
+
+_LINEARIZED_PAGES = re.compile(rb"/Linearized\b.*?/N\s+(\d+)", re.S)
+_PAGE_OBJECT = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+
+def split_budget(total: int, slow_share: float):
+    '''
+    Split a concurrency budget between the lanes, each lane gets at least one slot so the
+    slow lane is never starved and the fast lane never waits behind it. The lanes never get
+    more than 'total' together, so a budget below 2 is a configuration error
+    '''
+    if total < 2:
+        raise ValueError(f"A concurrency budget of {total} cannot be split between the lanes {LANES}, "
+                         f"it needs at least 2 slots")
+    slow = min(total - 1, max(1, round(total * slow_share)))
+    return {FAST: total - slow, SLOW: slow}
+
+def linearized_page_count(header: bytes):
+    '''
+    Page count announced in the linearization dictionary at the start of a PDF, None if absent
+    '''
+    match = _LINEARIZED_PAGES.search(header)
+    return int(match.group(1)) if match else None
+
+def pdf_page_count(data):
+    '''
+    Page objects in a downloaded PDF (bytes or memoryview), None if none is found (e.g. pages
+    inside compressed object streams)
+    '''
+    count = len(_PAGE_OBJECT.findall(data))
+    return count or None
+
+def choose_lane(size: int, pages: int = None):
+    '''
+    Lane of a document from its page count when known (OCR and LLM time follow the pages),
+    else from its size in bytes
+    '''
+    if pages is not None:
+        return SLOW if pages > config.lane_fast_max_pages else FAST
+    return SLOW if size > config.lane_fast_max_bytes else FAST
@@ -0,0 +1,145 @@
+import os
+import socket
+import asyncio
+from uuid import uuid4
+from datetime import datetime, timedelta, timezone
+
+from utils.config import logger
+from utils.mongodb import AsyncMongoDB
+
+# Identifies this consumer process, each lease adds its own token to it
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid4().hex[:8]}"
+
+# Process-wide lease counters
+lease_stats = {
+    "acquired": 0,
+    "waited": 0,
+    "suppressed": 0,
+    "timeouts": 0,
+    "renewals": 0,
+    "lost": 0,
+}
+
+class DocumentLease:
+    """
+    Single-flight lease on a document record, shared by every consumer replica.
+
+    The lease lives on the document itself ('lease_owner', 'lease_expires_at') and is taken
+    with an atomic find_one_and_update, so exactly one worker processes a document at a time.
+    The holder renews it every ttl/3 while processing. A worker that finds the document leased
+    waits; if the holder releases it as handled, the waiter reuses that result instead of
+    processing the document again.
+
+    Every lease has its own owner token, so two events of one document handled by the same
+    process (duplicates in a batch, a redelivery) exclude each other like any two replicas.
+    """
+    ACQUIRED = "acquired"
+    SUPPRESSED = "suppressed"
+    TIMEOUT = "timeout"
+
+    def __init__(self, store: AsyncMongoDB, collection_name: str, query: dict, ttl: int,
+                 wait_timeout: int, poll_interval: float = 2.0, owner: str = None):
+        self.store = store
+        self.collection_name = collection_name
+        self.query = query
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.owner = owner or f"{WORKER_ID}-{uuid4().hex}"
+        self.lost = False
+        self._renew_task = None
+
+    def _expiry(self):
+        return datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+
+    async def _try_acquire(self):
+        now = datetime.now(timezone.utc)
+        lease_filter = {
+            **self.query,
+            "$or": [
+                {"lease_owner": None},              # also matches a missing field
+                {"lease_expires_at": {"$lt": now}},
+            ]
+        }
+        record = await self.store.find_one_and_update(
+            self.collection_name,
+            lease_filter,
+            {"lease_owner": self.owner, "lease_expires_at": self._expiry()}
+        )
+        if record is not None:
+            return True
+
+        # No record yet: create it holding the lease, a concurrent insert loses on the _id
+        if await self.store.get_document(self.collection_name, self.query, {"_id": 1}) is None:
+            inserted = await self.store.insert_row(
+                self.collection_name,
+                {**self.query, "lease_owner": self.owner, "lease_expires_at": self._expiry()}
+            )
+            return bool(inserted)
+        return False
+
+    async def acquire(self):
+        '''
+        Take the lease, waiting up to 'wait_timeout' seconds while another worker holds it.
+        Returns ACQUIRED, SUPPRESSED (the other holder handled the document) or TIMEOUT.
+        '''
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.wait_timeout
+        waited = False
+        while True:
+            if await self._try_acquire():
+                lease_stats["acquired"] += 1
+                self._renew_task = loop.create_task(self._renew())
+                return self.ACQUIRED
+
+            if not waited:
+                waited = True
+                lease_stats["waited"] += 1
+                logger.info(f"Document {self.query} is leased by another worker, waiting")
+
+            await asyncio.sleep(self.poll_interval)
+            record = await self.store.get_document(
+                self.collection_name, self.query,
+                {"lease_owner": 1, "lease_handled": 1}
+            )
+            if record and record.get("lease_owner") is None and record.get("lease_handled"):
+                lease_stats["suppressed"] += 1
+                logger.info(f"Document {self.query} handled by another worker, reusing its result")
+                return self.SUPPRESSED
+
+            if loop.time() > deadline:
+                lease_stats["timeouts"] += 1
+                return self.TIMEOUT
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            record = await self.store.find_one_and_update(
+                self.collection_name,
+                {**self.query, "lease_owner": self.owner},
+                {"lease_expires_at": self._expiry()}
+            )
+            if record is None:
+                self.lost = True
+                lease_stats["lost"] += 1
+                logger.warning(f"Lease lost on document {self.query}")
+                return
+            lease_stats["renewals"] += 1
+
+    async def release(self, handled: bool):
+        '''
+        Release the lease, 'handled' tells waiting workers whether they can reuse the result
+        '''
+        if self._renew_task is not None:
+            self._renew_task.cancel()
+            self._renew_task = None
+        await self.store.find_one_and_update(
+            self.collection_name,
+            {**self.query, "lease_owner": self.owner},
+            {
+                "lease_owner": None,
+                "lease_expires_at": None,
+                "lease_handled": handled,
+                "lease_released_at": datetime.now(timezone.utc),
+            }
+        )
@@ -0,0 +1,175 @@
+import time
+from bisect import bisect_left
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets, the last bucket is +Inf
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Gauges of a state the worker processes share (a partition, the embedding cache file of the
+# host), merged with the max across workers; the others (events in flight, queue depths) add up
+SHARED_GAUGES = ("checkpoint_lag", "embedding_cache_entries")
+
+def _format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in items) + "}"
+
+class Metrics:
+    """
+    In-process registry of the consumer's counters and per-stage latencies.
+
+    Counters and gauges are keyed by name and optional labels (e.g. partition=...). Latency samples are
+    kept per stage in a bounded window, which is enough for percentiles in logs and load tests, and
+    counted in cumulative histogram buckets for Prometheus (see prometheus()).
+    """
+    def __init__(self, max_samples: int = 10000):
+        self.max_samples = max_samples
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.latencies = defaultdict(lambda: deque(maxlen=self.max_samples))
+        # per-bucket (non-cumulative) counts of every stage, and the sum of its samples
+        self.histograms = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+        self.latency_sums = defaultdict(float)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def add_gauge(self, name: str, delta: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def clear_gauge(self, name: str, **labels):
+        self.gauges.pop((name, tuple(sorted(labels.items()))), None)
+
+    def observe(self, stage: str, seconds: float):
+        self.latencies[stage].append(seconds)
+        self.histograms[stage][bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.latency_sums[stage] += seconds
+
+    @contextmanager
+    def timer(self, stage: str):
+        '''
+        Time the enclosed block (sync or async code) as one sample of 'stage'
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def counter(self, name: str, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def counter_total(self, name: str):
+        return sum(value for (counter_name, _), value in self.counters.items() if counter_name == name)
+
+    @staticmethod
+    def _percentile(sorted_samples, q: float):
+        if not sorted_samples:
+            return None
+        index = min(len(sorted_samples) - 1, max(0, round(q / 100 * len(sorted_samples)) - 1))
+        return sorted_samples[index]
+
+    def summary(self):
+        '''
+        count, mean, p50, p95 and p99 (seconds) of every stage
+        '''
+        stages = {}
+        for stage, samples in self.latencies.items():
+            ordered = sorted(samples)
+            stages[stage] = {
+                "count": len(ordered),
+                "mean": sum(ordered) / len(ordered) if ordered else None,
+                "p50": self._percentile(ordered, 50),
+                "p95": self._percentile(ordered, 95),
+                "p99": self._percentile(ordered, 99),
+            }
+        return stages
+
+    def snapshot(self, max_samples: int = 1000):
+        '''
+        Picklable copy of the registry (latest 'max_samples' latencies per stage), see merge()
+        '''
+        return {
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "latencies": {stage: list(samples)[-max_samples:] for stage, samples in self.latencies.items()},
+            "histograms": {stage: list(buckets) for stage, buckets in self.histograms.items()},
+            "latency_sums": dict(self.latency_sums),
+        }
+
+    def merge(self, snapshot: dict):
+        '''
+        Add a snapshot of another process into this registry, counters and gauges are summed
+        except the SHARED_GAUGES, which keep the highest value
+        '''
+        for key, value in snapshot["counters"].items():
+            self.counters[key] += value
+        for key, value in snapshot["gauges"].items():
+            if key[0] in SHARED_GAUGES:
+                self.gauges[key] = max(self.gauges.get(key, value), value)
+            else:
+                self.gauges[key] = self.gauges.get(key, 0) + value
+        for stage, samples in snapshot["latencies"].items():
+            self.latencies[stage].extend(samples)
+        for stage, buckets in snapshot.get("histograms", {}).items():
+            merged = self.histograms[stage]
+            for index, count in enumerate(buckets):
+                merged[index] += count
+        for stage, total in snapshot.get("latency_sums", {}).items():
+            self.latency_sums[stage] += total
+
+    def prometheus(self, prefix: str = "document_digitization"):
+        '''
+        The registry in the Prometheus text exposition format
+        '''
+        lines = []
+        counters = defaultdict(list)
+        for (name, labels), value in sorted(self.counters.items()):
+            counters[name].append((labels, value))
+        for name, series in counters.items():
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.extend(f"{prefix}_{name}_total{_format_labels(labels)} {_format_value(value)}"
+                         for labels, value in series)
+
+        gauges = defaultdict(list)
+        for (name, labels), value in sorted(self.gauges.items()):
+            gauges[name].append((labels, value))
+        for name, series in gauges.items():
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.extend(f"{prefix}_{name}{_format_labels(labels)} {_format_value(value)}"
+                         for labels, value in series)
+
+        histogram = f"{prefix}_stage_latency_seconds"
+        if self.histograms:
+            lines.append(f"# TYPE {histogram} histogram")
+        for stage, buckets in sorted(self.histograms.items()):
+            labels = (("stage", stage),)
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+                cumulative += count
+                lines.append(f"{histogram}_bucket{_format_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{histogram}_sum{_format_labels(labels)} {_format_value(self.latency_sums[stage])}")
+            lines.append(f"{histogram}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        self.counters.clear()
+        self.gauges.clear()
+        self.latencies.clear()
+        self.histograms.clear()
+        self.latency_sums.clear()
+
+# Process-wide registry
+metrics = Metrics()
@@ -1,14 +1,75 @@
-from pymongo import MongoClient
+import asyncio
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import MongoClient, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError
+from pymongo.results import BulkWriteResult
 from urllib import parse
 
 from utils.config import logger
 
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+    """
+    Keeps counters of the MongoClient connection pool usage
+    """
+    def __init__(self):
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.check_out_failed = 0
+
+    def stats(self):
+        return {
+            "open": self.created - self.closed,
+            "in_use": self.checked_out,
+            "created": self.created,
+            "check_out_failed": self.check_out_failed,
+        }
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.closed += 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.check_out_failed += 1
+
+    def connection_checked_out(self, event):
+        self.checked_out += 1
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+
 class MongoDB:
-    def __init__(self, db_name, mdb_conn_str):
+    def __init__(self, db_name, mdb_conn_str, **client_kwargs):
         logger.info("Starting MongoDB Connection...")
 
         try:
-            self.client = MongoClient(mdb_conn_str)
+            self.pool_stats = PoolStatsListener()
+            self.client = MongoClient(
+                mdb_conn_str,
+                event_listeners=[self.pool_stats],
+                **client_kwargs
+            )
             self.db = self.client[db_name]
         except Exception as e:
             logger.error(f"Exception: Failed to connect to MongoDB!, {e}")
@@ -45,10 +106,10 @@ class MongoDB:
             logger.error(f"Exception: get_document, {e}")
             return None
 
-    def get_documents(self, collection_name, query={}, projection={}):
+    def get_documents(self, collection_name, query={}, projection={}, sort=None, limit=0):
         try:
             collection = self.create_collection(collection_name)
-            return list(collection.find(query, projection))
+            return list(collection.find(query, projection, sort=sort, limit=limit))
             # return list(collection.find(query))
         except Exception as e:
             logger.error(f"Exception: get_documents, {e}")
@@ -70,6 +131,31 @@ class MongoDB:
             logger.error(f"Exception: update_documents, {e}")
             return False
     
+    def find_one_and_update(self, collection_name, query, new_values, upsert=False, operators=None):
+        try:
+            collection = self.create_collection(collection_name)
+            # other update operators ($inc, $setOnInsert, ...) go along with the '$set'
+            update = {"$set": new_values} if new_values else {}
+            update.update(operators or {})
+            return collection.find_one_and_update(query, update, upsert=upsert,
+                                                  return_document=ReturnDocument.AFTER)
+        except Exception as e:
+            logger.error(f"Exception: find_one_and_update, {e}")
+            return None
+
+    def bulk_write(self, collection_name, requests, ordered=False):
+        # BulkWriteError is left to the caller so partial failures can be resolved per request
+        collection = self.create_collection(collection_name)
+        return collection.bulk_write(requests, ordered=ordered)
+
+    def create_index(self, collection_name, keys, **kwargs):
+        try:
+            collection = self.create_collection(collection_name)
+            return collection.create_index(keys, **kwargs)
+        except Exception as e:
+            logger.error(f"Exception: create_index, {e}")
+            return None
+
     def delete_document(self, collection_name, query):
         try:
             collection = self.create_collection(collection_name)
@@ -78,10 +164,18 @@ class MongoDB:
             logger.error(f"Exception: delete_document, {e}")
             return False
 
-    def count_documents(self, collection_name):
+    def delete_documents(self, collection_name, query):
+        try:
+            collection = self.create_collection(collection_name)
+            return collection.delete_many(query)
+        except Exception as e:
+            logger.error(f"Exception: delete_documents, {e}")
+            return False
+
+    def count_documents(self, collection_name, query={}):
         try:
             collection = self.create_collection(collection_name)
-            return collection.count_documents({})
+            return collection.count_documents(query)
         except Exception as e:
             logger.error(f"Exception: count_documents, {e}")
             return None
@@ -98,6 +192,12 @@ class MongoDB:
             logger.error(f"MongoDB not alive: {e}")
             return False
         
+    def ping(self):
+        '''
+        Round trip to the server, raises when it cannot be reached
+        '''
+        return self.client.admin.command("ping")
+
     def close_connection(self):
         try:
             logger.info(f"Closing MongoDB Connections...")
@@ -106,3 +206,131 @@ class MongoDB:
         except Exception as e:
             logger.error(f"Error while closing MongoDB Connection: {e}")
             return False
+
+
+class AsyncMongoDB:
+    """
+    Asyncio status store on top of MongoDB.
+
+    Every pymongo call runs on a dedicated thread pool so Mongo round-trips never block the
+    consumer's event loop. Status updates issued within 'flush_interval' seconds of each other
+    (typically the events of one batch) are coalesced into a single unordered bulk_write.
+    """
+    def __init__(self, mongo: MongoDB, max_workers: int = 8, flush_interval: float = 0.05,
+                 max_bulk_size: int = 100):
+        self.mongo = mongo
+        self.flush_interval = flush_interval
+        self.max_bulk_size = max_bulk_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mongodb")
+        self._pending = {}          # collection_name -> [(UpdateOne, future)]
+        self._pending_count = 0
+        self._flush_task = None
+        self.bulk_writes = 0
+        self.coalesced_updates = 0
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    async def ping(self):
+        return await self._run(self.mongo.ping)
+
+    async def ensure_indexes(self, collection_name):
+        '''
+        Create the indexes the consumer's status queries rely on
+        '''
+        await self._run(self.mongo.create_index, collection_name,
+                        [("_id", 1), ("doc_id", 1)], name="id_doc_id")
+        await self._run(self.mongo.create_index, collection_name, [("doc_id", 1)], name="doc_id")
+
+    async def get_document(self, collection_name, query={}, projection=None):
+        return await self._run(self.mongo.get_document, collection_name, query, projection)
+
+    async def get_documents(self, collection_name, query={}, projection=None, sort=None, limit=0):
+        return await self._run(self.mongo.get_documents, collection_name, query, projection,
+                               sort=sort, limit=limit)
+
+    async def count_documents(self, collection_name, query={}):
+        return await self._run(self.mongo.count_documents, collection_name, query)
+
+    async def create_index(self, collection_name, keys, **kwargs):
+        return await self._run(self.mongo.create_index, collection_name, keys, **kwargs)
+
+    async def find_one_and_update(self, collection_name, query, new_values, upsert=False, operators=None):
+        '''
+        Atomic '$set' (plus 'operators') on the first match, not coalesced.
+        Returns the updated record or None.
+        '''
+        return await self._run(self.mongo.find_one_and_update, collection_name, query, new_values,
+                               upsert=upsert, operators=operators)
+
+    async def insert_row(self, collection_name, data):
+        return await self._run(self.mongo.insert_row, collection_name, data)
+
+    async def delete_document(self, collection_name, query):
+        return await self._run(self.mongo.delete_document, collection_name, query)
+
+    async def delete_documents(self, collection_name, query):
+        return await self._run(self.mongo.delete_documents, collection_name, query)
+
+    async def update_document(self, collection_name, query, new_values):
+        '''
+        Queue a '$set' upsert and wait for the bulk_write that carries it.
+        Returns the BulkWriteResult (with 'acknowledged') or False on failure.
+        '''
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        request = UpdateOne(query, {"$set": new_values}, upsert=True)
+        self._pending.setdefault(collection_name, []).append((request, future))
+        self._pending_count += 1
+
+        if self._pending_count >= self.max_bulk_size:
+            loop.create_task(self.flush())
+        elif self._flush_task is None:
+            self._flush_task = loop.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        '''
+        Write every queued status update, one bulk_write per collection
+        '''
+        pending, self._pending = self._pending, {}
+        self._pending_count = 0
+        if self._flush_task is not None and self._flush_task is not asyncio.current_task():
+            self._flush_task.cancel()
+        self._flush_task = None
+
+        for collection_name, items in pending.items():
+            requests = [request for request, _ in items]
+            results = [False] * len(items)
+            try:
+                result = await self._run(self.mongo.bulk_write, collection_name, requests)
+                results = [result] * len(items)
+            except BulkWriteError as e:
+                logger.error(f"Exception: bulk_write, {e.details.get('writeErrors')}")
+                failed = {error["index"] for error in e.details.get("writeErrors", [])}
+                partial_result = BulkWriteResult(e.details, True)
+                results = [False if i in failed else partial_result for i in range(len(items))]
+            except Exception as e:
+                logger.error(f"Exception: bulk_write, {e}")
+
+            self.bulk_writes += 1
+            self.coalesced_updates += len(items)
+            for (_, future), result in zip(items, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def stats(self):
+        return {
+            "pending_updates": self._pending_count,
+            "bulk_writes": self.bulk_writes,
+            "coalesced_updates": self.coalesced_updates,
+        }
+
+    async def close(self):
+        await self.flush()
+        self._executor.shutdown(wait=True)
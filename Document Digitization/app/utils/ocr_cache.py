@@ -0,0 +1,103 @@
+import time
+import asyncio
+from functools import partial
+from collections import OrderedDict
+
+from utils.metrics import metrics
+
+class OcrResultCache:
+    """
+    In-process cache of OCR results (page number -> text) keyed by the SHA-256 of the file and
+    the OCR backend, in front of the persistent ExtractionCache.
+
+    Concurrent requests for the same file share a single OCR call (single flight): the call runs
+    in its own task, so it completes and is cached even if the event that started it is
+    cancelled. Entries expire 'ttl' seconds after they were stored, and the least recently used
+    ones are evicted to keep the cached page text under 'max_bytes'. Failed calls, and results
+    the call marks as not to be kept, are only shared with the requests already waiting.
+    """
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self._entries = OrderedDict()       # key -> (expires_at, size, pages)
+        self._in_flight = {}                # key -> task computing the pages
+
+    @staticmethod
+    def _size(pages: dict):
+        return sum(len(page) + len(text) for page, text in pages.items())
+
+    def get(self, key: str):
+        '''
+        Cached pages of the file, None on a miss or when the entry has expired
+        '''
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return dict(entry[2])
+
+    def put(self, key: str, pages: dict):
+        size = self._size(pages)
+        if size > self.max_bytes:
+            return
+        self._drop(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, dict(pages))
+        self.size += size
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            metrics.inc("ocr_cache_evictions")
+        metrics.set_gauge("ocr_cache_bytes", self.size)
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    async def get_or_compute(self, key: str, compute):
+        '''
+        Pages of the file from the cache, from a call already in flight for it, or else from
+        'compute', a coroutine function returning (pages, whether to cache them)
+        '''
+        pages = self.get(key)
+        if pages is not None:
+            self.hits += 1
+            metrics.inc("ocr_cache_hits")
+            return pages
+        task = self._in_flight.get(key)
+        if task is None:
+            self.misses += 1
+            metrics.inc("ocr_cache_misses")
+            task = asyncio.ensure_future(compute())
+            self._in_flight[key] = task
+            task.add_done_callback(partial(self._on_done, key))
+        else:
+            self.shared += 1
+            metrics.inc("ocr_cache_shared")
+        pages, _ = await asyncio.shield(task)
+        return dict(pages)
+
+    def _on_done(self, key: str, task):
+        self._in_flight.pop(key, None)
+        # retrieving the exception also keeps asyncio from logging it when nobody awaits the task
+        if task.cancelled() or task.exception() is not None:
+            return
+        pages, keep = task.result()
+        if keep:
+            self.put(key, pages)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "in_flight": len(self._in_flight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+        }
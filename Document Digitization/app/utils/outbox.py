@@ -0,0 +1,204 @@
+import json
+import asyncio
+import hashlib
+from datetime import datetime, timedelta, timezone
+
+import aiohttp
+
+from utils.config import logger
+from utils.metrics import metrics
+from utils.lease import WORKER_ID
+from utils.mongodb import AsyncMongoDB
+from utils.pipeline import backoff_delay
+
+def payload_hash(payload: dict) -> str:
+    '''
+    SHA-256 of the payload, to tell a new extraction result from a redelivery of the same one
+    '''
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+class AppianOutbox:
+    """
+    Persistent outbox of Appian deliveries, stored in MongoDB.
+
+    The consumer only enqueues a payload (one record per doc_id); a background dispatcher
+    claims due records atomically, posts them to Appian and retries failures with backoff,
+    independently of the extraction. A claim expires after 'claim_timeout' seconds so records
+    held by a crashed replica are picked up again.
+
+    A record remembers the hash of its payload: the same result enqueued again is not sent
+    twice, a different one (e.g. re-extracted after a dead-letter replay) replaces it and is
+    sent after any delivery of the previous one still on the wire.
+    """
+    def __init__(self, store: AsyncMongoDB, session: aiohttp.ClientSession, collection_name: str,
+                 url: str, api_key: str, max_attempts: int, concurrency: int, poll_interval: float,
+                 claim_timeout: int, retry_multiplier: float, retry_wait_max: float):
+        self.store = store
+        self.session = session
+        self.collection_name = collection_name
+        self.url = url
+        self.api_key = api_key
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self.retry_multiplier = retry_multiplier
+        self.retry_wait_max = retry_wait_max
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self._sends = set()
+
+    async def ensure_indexes(self):
+        await self.store.create_index(self.collection_name, [("status", 1), ("next_attempt_at", 1)],
+                                      name="status_next_attempt_at")
+
+    async def enqueue(self, doc_id: str, payload: dict):
+        '''
+        Queue the payload of a document for delivery. The same payload already delivered (or
+        being sent) is not queued again, a changed one is. Returns True once the record is stored.
+        '''
+        digest = payload_hash(payload)
+        record = await self.store.get_document(self.collection_name, {"_id": doc_id},
+                                               {"status": 1, "payload_hash": 1, "claim_expires_at": 1})
+        now = datetime.now(timezone.utc)
+        next_attempt_at = now
+        if record and record.get("status") in ("delivered", "sending"):
+            if record.get("payload_hash") == digest:
+                logger.info(f"Appian outbox: {doc_id} already {record['status']} with this result")
+                metrics.inc("appian_outbox_skipped")
+                return True
+            logger.info(f"Appian outbox: result of {doc_id} changed since it was {record['status']}, re-queuing it")
+            metrics.inc("appian_outbox_requeued")
+            if record["status"] == "sending" and record.get("claim_expires_at"):
+                # not before the send on the wire, which moves it forward when it finishes
+                next_attempt_at = record["claim_expires_at"]
+
+        response = await self.store.update_document(
+            self.collection_name,
+            {"_id": doc_id},
+            {
+                "payload": payload,
+                "payload_hash": digest,
+                "status": "pending",
+                "attempts": 0,
+                "next_attempt_at": next_attempt_at,
+                "enqueued_at": now,
+            }
+        )
+        self._wakeup.set()
+        metrics.inc("appian_outbox_enqueued")
+        return True if response and response.acknowledged else False
+
+    def start(self):
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        return self
+
+    async def stop(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        # let deliveries already on the wire finish
+        await asyncio.gather(*self._sends, return_exceptions=True)
+
+    async def _claim(self):
+        now = datetime.now(timezone.utc)
+        return await self.store.find_one_and_update(
+            self.collection_name,
+            {"$or": [
+                {"status": "pending", "next_attempt_at": {"$lte": now}},
+                {"status": "sending", "claim_expires_at": {"$lt": now}},
+            ]},
+            {
+                "status": "sending",
+                "claimed_by": WORKER_ID,
+                "claim_expires_at": now + timedelta(seconds=self.claim_timeout),
+            }
+        )
+
+    async def _dispatch(self):
+        while True:
+            await self._semaphore.acquire()
+            # cleared before claiming so an enqueue racing with an empty claim still wakes us
+            self._wakeup.clear()
+            try:
+                record = await self._claim()
+            except Exception as e:
+                logger.error(f"Exception while claiming Appian outbox records: {e}")
+                record = None
+            if record is None:
+                self._semaphore.release()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = asyncio.create_task(self._send(record))
+            self._sends.add(task)
+            task.add_done_callback(self._sends.discard)
+
+    async def _send(self, record: dict):
+        try:
+            doc_id = record["_id"]
+            attempts = record.get("attempts", 0) + 1
+            headers = {
+                "Content-Type": "application/json",
+                "API-Key": self.api_key
+            }
+            error = None
+            try:
+                with metrics.timer("appian"):
+                    response = await self.session.post(self.url, headers=headers, json=record["payload"])
+                    body = await response.text()
+                logger.info(f"Appian response for {doc_id}: {response.status} {body}")
+                if response.status >= 400:
+                    error = f"HTTP {response.status}: {body[:500]}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = str(e) or type(e).__name__
+
+            if error is None:
+                metrics.inc("appian_outbox_delivered")
+                await self._finish(record, {
+                    "status": "delivered",
+                    "attempts": attempts,
+                    "delivered_at": datetime.now(timezone.utc),
+                })
+                return
+
+            logger.error(f"Appian delivery of {doc_id} failed (attempt {attempts}): {error}")
+            if attempts >= self.max_attempts:
+                metrics.inc("appian_outbox_failed")
+                new_values = {"status": "failed", "attempts": attempts, "last_error": error}
+            else:
+                metrics.inc("appian_outbox_retried")
+                delay = backoff_delay(attempts, self.retry_multiplier, self.retry_wait_max)
+                new_values = {
+                    "status": "pending",
+                    "attempts": attempts,
+                    "last_error": error,
+                    "next_attempt_at": datetime.now(timezone.utc) + timedelta(seconds=delay),
+                }
+            await self._finish(record, new_values)
+        finally:
+            self._semaphore.release()
+
+    async def _finish(self, record: dict, new_values: dict):
+        '''
+        Record the outcome of a send, unless the payload was replaced while it was on the wire:
+        the new one is then made due now
+        '''
+        updated = await self.store.find_one_and_update(
+            self.collection_name,
+            {"_id": record["_id"], "payload_hash": record.get("payload_hash")},
+            new_values
+        )
+        if updated is None:
+            await self.store.find_one_and_update(
+                self.collection_name,
+                {"_id": record["_id"], "status": "pending"},
+                {"next_attempt_at": datetime.now(timezone.utc)}
+            )
+            self._wakeup.set()
+
+    async def pending_count(self):
+        return await self.store.count_documents(self.collection_name, {"status": {"$in": ["pending", "sending"]}})
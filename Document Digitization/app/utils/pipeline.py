@@ -0,0 +1,147 @@
+import random
+import asyncio
+
+from utils.config import logger
+from utils.metrics import metrics
+
+def backoff_delay(attempt: int, multiplier: float, maximum: float):
+    '''
+    Random exponential backoff, same policy as tenacity's wait_random_exponential
+    '''
+    return random.uniform(0, min(maximum, multiplier * 2 ** attempt))
+
+class Job:
+    """
+    One unit of work travelling through a StagedPipeline.
+    'state' carries the outputs of the stages done so far, 'result' is returned to the submitter,
+    'error' is the (stage name, exception) the job finished on, if it failed.
+    """
+    def __init__(self, state: dict, resources=None):
+        self.state = state
+        self.resources = resources
+        self.result = None
+        self.error = None
+        self.attempts = {}
+        self.future = asyncio.get_running_loop().create_future()
+
+class Stage:
+    """
+    A pipeline stage: 'handler(job)' runs on 'concurrency' workers fed by a bounded queue.
+    The handler returns the name of the next stage, or None when the job is finished.
+    """
+    def __init__(self, name: str, handler, concurrency: int, queue_size: int):
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+
+class StagedPipeline:
+    """
+    Stages connected by bounded asyncio queues, each with its own worker pool.
+
+    A full queue blocks the upstream worker (or the submitter for the first stage), so a slow
+    stage applies backpressure instead of buffering without limit, while the other stages keep
+    working on other jobs. When a handler raises, 'error_handler(job, stage_name, exc)' decides
+    what happens next: it returns (next_stage, delay_seconds) to re-queue the job, or None once
+    the job is finished (job.result set).
+    """
+    def __init__(self, stages: list, error_handler):
+        self.stages = {stage.name: stage for stage in stages}
+        self.first_stage = stages[0].name
+        self.error_handler = error_handler
+        self._workers = []
+        self._timers = set()
+
+    def start(self):
+        for stage in self.stages.values():
+            for _ in range(stage.concurrency):
+                self._workers.append(asyncio.create_task(self._worker(stage)))
+        logger.info(f"Pipeline started: {self.stats()}")
+        return self
+
+    async def stop(self):
+        for task in self._workers + list(self._timers):
+            task.cancel()
+        await asyncio.gather(*self._workers, *self._timers, return_exceptions=True)
+        self._workers = []
+        self._timers = set()
+
+    async def submit(self, job: Job):
+        '''
+        Queue a job on the first stage and wait for its result
+        '''
+        await self._enqueue(self.first_stage, job)
+        return await job.future
+
+    async def _enqueue(self, stage_name: str, job: Job):
+        stage = self.stages[stage_name]
+        await stage.queue.put(job)
+        metrics.set_gauge("pipeline_queue_depth", stage.queue.qsize(), stage=stage_name)
+
+    async def _enqueue_later(self, stage_name: str, job: Job, delay: float):
+        await asyncio.sleep(delay)
+        await self._enqueue(stage_name, job)
+
+    def _finish(self, job: Job, exc: Exception = None):
+        if job.future.done():
+            return
+        if exc is not None:
+            job.future.set_exception(exc)
+        else:
+            job.future.set_result(job.result)
+
+    async def _worker(self, stage: Stage):
+        while True:
+            job = await stage.queue.get()
+            metrics.set_gauge("pipeline_queue_depth", stage.queue.qsize(), stage=stage.name)
+            stage.in_flight += 1
+            metrics.set_gauge("pipeline_in_flight", stage.in_flight, stage=stage.name)
+            next_stage, retried = None, False
+            try:
+                with metrics.timer(f"stage_{stage.name}"):
+                    next_stage = await stage.handler(job)
+                stage.processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                stage.failed += 1
+                try:
+                    decision = await self.error_handler(job, stage.name, exc)
+                except Exception as handler_exc:
+                    logger.error(f"Exception in pipeline error handler: {handler_exc}")
+                    self._finish(job, handler_exc)
+                    decision = None
+                if decision is not None:
+                    (next_stage, delay), retried = decision, True
+                else:
+                    job.error = (stage.name, exc)
+            finally:
+                stage.in_flight -= 1
+                metrics.set_gauge("pipeline_in_flight", stage.in_flight, stage=stage.name)
+                stage.queue.task_done()
+
+            if next_stage is None:
+                self._finish(job)
+            elif retried:
+                # wait outside the worker so the stage keeps serving other jobs, and so a
+                # retry sent upstream never blocks this worker on a full queue
+                timer = asyncio.create_task(self._enqueue_later(next_stage, job, delay))
+                self._timers.add(timer)
+                timer.add_done_callback(self._timers.discard)
+            else:
+                await self._enqueue(next_stage, job)
+
+    def stats(self):
+        return {
+            name: {
+                "queue_depth": stage.queue.qsize(),
+                "in_flight": stage.in_flight,
+                "concurrency": stage.concurrency,
+                "processed": stage.processed,
+                "failed": stage.failed,
+            }
+            for name, stage in self.stages.items()
+        }
@@ -0,0 +1,201 @@
+import aiohttp
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+
+from utils import config
+from utils.config import logger
+from utils.mongodb import MongoDB, AsyncMongoDB
+from utils.extraction_cache import ExtractionCache
+from utils.ocr_cache import OcrResultCache
+from utils.outbox import AppianOutbox
+from utils.adaptive import AdaptiveLimiter
+from utils.checkpointing import CheckpointCoalescer
+from utils.dead_letter import DeadLetterStore
+
+class Resources:
+    """
+    Process-wide clients shared by every event handled by the consumer.
+
+    Created once in consumer.main() so connection pools, keep-alive connections and TLS sessions
+    are reused across documents instead of being rebuilt per event or per batch.
+    - session: pooled aiohttp ClientSession used for the OCR and Appian calls
+    - mongo: single MongoDB client
+    - status_store: AsyncMongoDB over 'mongo', the non-blocking API used from the event loop
+    - s3_client: single boto3 S3 client
+    - s3_executor: thread pool of the blocking S3 calls, sized to the client's connection pool
+      instead of sharing the default executor with PDF splitting and the embedding cache
+    - extraction_cache: ExtractionCache on the status store, None when disabled
+    - ocr_cache: in-process OcrResultCache (single flight per file), None when disabled
+    - outbox: AppianOutbox delivering extraction results in the background
+    - limiters: AdaptiveLimiter per throttled downstream service ("azure_read", "azure_openai")
+    - checkpoints: CheckpointCoalescer batching the partition checkpoint writes
+    - dead_letters: DeadLetterStore of the failed events, None when disabled
+    """
+    def __init__(self):
+        self.session = None
+        self.mongo = None
+        self.status_store = None
+        self.s3_client = None
+        self.s3_executor = None
+        self.extraction_cache = None
+        self.ocr_cache = None
+        self.outbox = None
+        self.limiters = {}
+        self.checkpoints = None
+        self.dead_letters = None
+        self._s3_in_flight = 0
+        self._s3_calls = 0
+
+    async def startup(self):
+        logger.info("Starting shared resources...")
+        self.checkpoints = CheckpointCoalescer(
+            max_events=config.checkpoint_flush_events,
+            interval=config.checkpoint_flush_interval,
+        ).start()
+        connector = aiohttp.TCPConnector(
+            limit=config.http_pool_limit,
+            limit_per_host=config.http_pool_limit_per_host,
+            keepalive_timeout=config.http_keepalive_timeout,
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=config.http_request_timeout),
+        )
+
+        self.mongo = MongoDB(config.mdb_db, config.mdb_conn_str, maxPoolSize=config.mdb_max_pool_size)
+        self.status_store = AsyncMongoDB(
+            self.mongo,
+            max_workers=config.mdb_executor_workers,
+            flush_interval=config.mdb_flush_interval_ms / 1000,
+            max_bulk_size=config.mdb_max_bulk_size,
+        )
+        await self.status_store.ensure_indexes(config.mdb_collection_data)
+        if config.extraction_cache_enabled:
+            self.extraction_cache = ExtractionCache(
+                self.status_store,
+                config.mdb_collection_cache,
+                ttl=config.extraction_cache_ttl,
+                max_entries=config.extraction_cache_max_entries,
+            )
+            await self.extraction_cache.ensure_indexes()
+        if config.ocr_cache_enabled:
+            self.ocr_cache = OcrResultCache(max_bytes=config.ocr_cache_max_bytes, ttl=config.ocr_cache_ttl)
+
+        if config.dead_letter_enabled:
+            self.dead_letters = DeadLetterStore(
+                self.status_store,
+                config.mdb_collection_dead_letter,
+                max_attempts=config.dead_letter_max_attempts,
+            )
+            await self.dead_letters.ensure_indexes()
+
+        self.outbox = AppianOutbox(
+            self.status_store,
+            self.session,
+            config.mdb_collection_outbox,
+            url=config.appian_api_url,
+            api_key=config.appian_api_key,
+            max_attempts=config.appian_max_attempts,
+            concurrency=config.appian_outbox_concurrency,
+            poll_interval=config.appian_outbox_poll_interval,
+            claim_timeout=config.appian_outbox_claim_timeout,
+            retry_multiplier=config.retry_exp_wait_multiplier,
+            retry_wait_max=config.retry_wait_max,
+        )
+        await self.outbox.ensure_indexes()
+        self.outbox.start()
+
+        self.limiters = {
+            name: AdaptiveLimiter(
+                name,
+                initial_limit=config.adaptive_initial_limit,
+                min_limit=config.adaptive_min_limit,
+                max_limit=max_limit,
+                backoff_factor=config.adaptive_backoff_factor,
+                latency_tolerance=config.adaptive_latency_tolerance,
+                cooldown=config.adaptive_cooldown,
+            )
+            for name, max_limit in (("azure_read", config.azure_read_max_concurrency),
+                                    ("azure_openai", config.azure_openai_max_concurrency))
+        }
+
+        self.s3_client = boto3.client(
+            's3',
+            aws_access_key_id = config.s3_access_key_id,
+            aws_secret_access_key = config.s3_secret_access_key,
+            endpoint_url = config.s3_endpoint_url,
+            config = Config(
+                max_pool_connections=config.s3_max_pool_connections,
+                s3={"addressing_style": "path"} if config.s3_endpoint_url else None
+            )
+        )
+        self.s3_client.meta.events.register('before-call.s3', self._on_s3_call_start)
+        self.s3_client.meta.events.register('after-call.s3', self._on_s3_call_end)
+        self.s3_client.meta.events.register('after-call-error.s3', self._on_s3_call_end)
+        self.s3_executor = ThreadPoolExecutor(max_workers=config.s3_executor_workers, thread_name_prefix="s3")
+        return self
+
+    async def shutdown(self):
+        logger.info(f"Closing shared resources, {self.stats()}")
+        if self.checkpoints is not None:
+            # completed events are checkpointed before the clients go away
+            await self.checkpoints.stop()
+        if self.outbox is not None:
+            await self.outbox.stop()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        if self.status_store is not None:
+            await self.status_store.close()
+        if self.mongo is not None:
+            self.mongo.close_connection()
+        if self.s3_executor is not None:
+            self.s3_executor.shutdown(wait=True)
+        if self.s3_client is not None:
+            self.s3_client.close()
+
+    async def __aenter__(self):
+        return await self.startup()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.shutdown()
+
+    def _on_s3_call_start(self, **kwargs):
+        self._s3_in_flight += 1
+        self._s3_calls += 1
+
+    def _on_s3_call_end(self, **kwargs):
+        self._s3_in_flight -= 1
+
+    def stats(self):
+        '''
+        Pool usage of each shared client
+        '''
+        http_stats = {}
+        if self.session is not None:
+            connector = self.session.connector
+            http_stats = {
+                "limit": connector.limit,
+                "limit_per_host": connector.limit_per_host,
+                "in_use": len(getattr(connector, "_acquired", ())),
+                "idle": sum(len(conns) for conns in getattr(connector, "_conns", {}).values()),
+            }
+        mongo_stats = {}
+        if self.mongo is not None and hasattr(self.mongo, "pool_stats"):
+            mongo_stats = self.mongo.pool_stats.stats()
+        if self.status_store is not None:
+            mongo_stats.update(self.status_store.stats())
+        s3_stats = {
+            "max_pool_connections": config.s3_max_pool_connections,
+            "executor_workers": config.s3_executor_workers,
+            "in_flight": self._s3_in_flight,
+            "calls": self._s3_calls,
+        }
+        stats = {"http": http_stats, "mongo": mongo_stats, "s3": s3_stats}
+        if self.limiters:
+            stats["limiters"] = {name: limiter.stats() for name, limiter in self.limiters.items()}
+        if self.extraction_cache is not None:
+            stats["extraction_cache"] = self.extraction_cache.stats()
+        if self.ocr_cache is not None:
+            stats["ocr_cache"] = self.ocr_cache.stats()
+        return stats
@@ -0,0 +1,236 @@
+import os
+import time
+import queue
+import signal
+import asyncio
+import threading
+import multiprocessing
+from collections import defaultdict
+
+from utils.config import logger
+from utils.metrics import Metrics, metrics
+from utils.health import start_http_server
+
+def worker_count(setting: int):
+    '''
+    Number of worker processes, 0 means one per CPU available to this process
+    '''
+    if setting > 0:
+        return setting
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+async def report_metrics(reports, worker_id: int, interval: float, readiness=None):
+    '''
+    Worker side: send a heartbeat with a metrics snapshot (and the result of the 'readiness'
+    coroutine, if any) to the supervisor every 'interval' seconds
+    '''
+    while True:
+        ready = (await readiness())["ok"] if readiness is not None else True
+        try:
+            reports.put_nowait({
+                "worker_id": worker_id,
+                "pid": os.getpid(),
+                "ready": ready,
+                "metrics": metrics.snapshot(),
+            })
+        except queue.Full:
+            pass
+        await asyncio.sleep(interval)
+
+class Supervisor:
+    """
+    Runs 'workers' processes of 'target(worker_id, reports, report_interval)' and keeps them running.
+
+    Each worker is a full consumer with its own event loop and clients; the Event Hub blob
+    checkpoint store balances the partitions across them. Workers report a heartbeat carrying
+    their metrics on a shared queue. A worker that exits, or stays silent for 'heartbeat_timeout'
+    seconds (blocked event loop), is restarted after an exponential backoff. The supervisor logs
+    the health of the workers and their metrics merged into one registry, and serves both on the
+    metrics endpoint in place of the workers (see serve_http()).
+    """
+    def __init__(self, target, workers: int, report_interval: float, heartbeat_timeout: float,
+                 restart_backoff_max: float, shutdown_timeout: float):
+        self.target = target
+        self.workers = workers
+        self.report_interval = report_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.restart_backoff_max = restart_backoff_max
+        self.shutdown_timeout = shutdown_timeout
+        # spawned workers import the consumer fresh: own clients, own lease owner id
+        self._context = multiprocessing.get_context("spawn")
+        self.reports = self._context.Queue(maxsize=workers * 4)
+        self.processes = {}
+        self.restarts = defaultdict(int)
+        self.last_report = {}
+        # the metrics endpoint reads 'processes' and 'last_report' from its own thread
+        self._lock = threading.Lock()
+        self._started_at = {}
+        self._restart_at = {}
+        self._backoff = {}
+        self._stopping = False
+
+    def _start(self, worker_id: int):
+        process = self._context.Process(
+            target=self.target,
+            args=(worker_id, self.reports, self.report_interval),
+            name=f"consumer-worker-{worker_id}",
+        )
+        process.start()
+        with self._lock:
+            self.processes[worker_id] = process
+            self.last_report.pop(worker_id, None)
+        self._started_at[worker_id] = time.monotonic()
+        logger.info(f"Started consumer worker {worker_id} (pid {process.pid})")
+
+    def _schedule_restart(self, worker_id: int):
+        self.restarts[worker_id] += 1
+        now = time.monotonic()
+        # the backoff doubles while a worker keeps failing early, and starts over once it ran a while
+        if now - self._started_at[worker_id] > self.heartbeat_timeout:
+            delay = 1
+        else:
+            delay = min(self.restart_backoff_max, self._backoff.get(worker_id, 0.5) * 2)
+        self._backoff[worker_id] = delay
+        self._restart_at[worker_id] = now + delay
+        with self._lock:
+            del self.processes[worker_id]
+        logger.info(f"Restarting consumer worker {worker_id} in {delay:g}s")
+
+    def _receive_reports(self, timeout: float):
+        try:
+            report = self.reports.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while True:
+            process = self.processes.get(report["worker_id"])
+            # ignore the last words of a worker that was already replaced
+            if process is not None and process.pid == report["pid"]:
+                report["received"] = time.monotonic()
+                with self._lock:
+                    self.last_report[report["worker_id"]] = report
+            try:
+                report = self.reports.get_nowait()
+            except queue.Empty:
+                return
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for worker_id, process in list(self.processes.items()):
+            if process.is_alive():
+                report = self.last_report.get(worker_id)
+                last_seen = report["received"] if report else self._started_at[worker_id]
+                if now - last_seen <= self.heartbeat_timeout:
+                    continue
+                logger.error(f"Consumer worker {worker_id} (pid {process.pid}) silent for "
+                             f"{now - last_seen:.0f}s, killing it")
+                process.kill()
+                process.join()
+            else:
+                logger.error(f"Consumer worker {worker_id} (pid {process.pid}) exited with code {process.exitcode}")
+            self._schedule_restart(worker_id)
+
+        for worker_id, restart_at in list(self._restart_at.items()):
+            if now >= restart_at:
+                del self._restart_at[worker_id]
+                self._start(worker_id)
+
+    def health(self):
+        '''
+        Liveness of every worker, healthy when all of them run and report on time
+        '''
+        now = time.monotonic()
+        with self._lock:
+            processes, last_report = dict(self.processes), dict(self.last_report)
+        workers = {}
+        for worker_id in range(self.workers):
+            process = processes.get(worker_id)
+            report = last_report.get(worker_id)
+            workers[worker_id] = {
+                "pid": process.pid if process is not None else None,
+                "alive": process is not None and process.is_alive(),
+                "restarts": self.restarts[worker_id],
+                "last_report_age": round(now - report["received"], 1) if report else None,
+                "ready": bool(report and report.get("ready")),
+            }
+        healthy = all(
+            worker["alive"] and worker["last_report_age"] is not None
+            and worker["last_report_age"] <= self.heartbeat_timeout
+            for worker in workers.values()
+        )
+        return {"healthy": healthy, "ready": healthy and all(w["ready"] for w in workers.values()),
+                "workers": workers}
+
+    def aggregate(self):
+        '''
+        Metrics of all the workers merged into one registry
+        '''
+        merged = Metrics()
+        with self._lock:
+            reports = list(self.last_report.values())
+        for report in reports:
+            merged.merge(report["metrics"])
+        return merged
+
+    def serve_http(self, host: str, port: int):
+        '''
+        Serve the merged metrics and the health of the workers from a background thread
+        '''
+        async def liveness():
+            # the supervisor is alive while it runs, dead workers are restarted rather than reported
+            return {"ok": not self._stopping, "workers": len(self.processes)}
+
+        async def readiness():
+            status = self.health()
+            return {"ok": status["ready"], **status}
+
+        def serve():
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(start_http_server(
+                host, port, lambda: self.aggregate().prometheus(), liveness, readiness
+            ))
+            loop.run_forever()
+
+        threading.Thread(target=serve, name="supervisor-http", daemon=True).start()
+
+    def _stop(self, signum, frame):
+        logger.info(f"Supervisor received signal {signum}, stopping workers")
+        self._stopping = True
+
+    def _shutdown(self):
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.shutdown_timeout
+        for worker_id, process in self.processes.items():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.error(f"Consumer worker {worker_id} (pid {process.pid}) did not stop, killing it")
+                process.kill()
+                process.join()
+        self.reports.close()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        logger.info(f"Supervisor starting {self.workers} consumer workers")
+        for worker_id in range(self.workers):
+            self._start(worker_id)
+
+        next_log = time.monotonic() + self.report_interval
+        try:
+            while not self._stopping:
+                self._receive_reports(timeout=1)
+                if self._stopping:
+                    break
+                self._check_workers()
+                if time.monotonic() >= next_log:
+                    next_log = time.monotonic() + self.report_interval
+                    merged = self.aggregate()
+                    logger.info(f"Supervisor health: {self.health()}")
+                    logger.info(f"Supervisor totals: processed={merged.counter_total('events_processed'):.0f} "
+                                f"failed={merged.counter_total('events_failed'):.0f} stages={merged.summary()}")
+        finally:
+            self._shutdown()